@@ -14,9 +14,9 @@ with gzip.open(in_filepath, 'rt') as in_f, gzip.open(out_filepath,'wt') as out_f
     write('\t'.join('#CHROM POS ID REF ALT INFO'.split()))
 
     header = next(in_f).rstrip('\n')
-    assert header.split('\t') == ['chrom', 'pos', 'ref', 'alt', 'rsids', 'nearest_genes']
+    assert header.split('\t')[:6] == ['chrom', 'pos', 'ref', 'alt', 'rsids', 'nearest_genes']  # `consequence` might follow
 
     for idx,line in enumerate(in_f):
-        chrom,pos,ref,alt,rsids,nearest_genes = line.rstrip('\n').split('\t')
+        chrom,pos,ref,alt,rsids,nearest_genes = line.rstrip('\n').split('\t')[:6]
         variant_id = f'{chrom}:{pos}:{ref}:{alt}'
         write('\t'.join([chrom, pos, variant_id, ref, alt, f'nearest_genes={nearest_genes}']))
@@ -6,9 +6,10 @@ SCRIPTDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 set -x
 
 ## This script should get run from the directory that contains `generated-by-pheweb`.
-## It needs `generated-by-pheweb/sites/sites.tsv`, so it should get run after `pheweb add-genes` and its preceeding steps.
+## It needs `generated-by-pheweb/sites/sites.tsv`, so it should get run after `pheweb annotate-sites` and its preceeding steps.
 ## You can see the list of steps with `pheweb process -h`.
-## Then you should be able to continue with the rest of the steps.  I think `pheweb process` should pick up at the right spot.
+## Then set `vep_consequences_file` in `config.py` to the path of `out-raw-vep.tsv` and run `pheweb process` again.
+## `pheweb annotate-sites` will re-make `sites.tsv` with a `consequence` column, and then the later steps will re-run.
 ## To use these VEP consequences to filter the filterable manhattan plot, set `show_manhattan_filter_consequence = True` in `config.py`.
 
 ## Uncomment your build:
@@ -60,10 +61,4 @@ else
     done
 fi
 
-"$python_exe" "$SCRIPTDIR/merge.py" generated-by-pheweb/sites/sites.tsv out-raw-vep.tsv sites-vep.tsv
-
-
-echo "Now check that sites-vep.tsv looks good."
-echo 'It should have the same variants as `generated-by-pheweb/sites/sites.tsv`.'
-echo "It should have the same columns, plus 'consequence'."
-echo 'Then run `mv sites-vep.tsv generated-by-pheweb/sites/sites.tsv`.'
+echo "Now set \`vep_consequences_file = '$PWD/out-raw-vep.tsv'\` in config.py and run \`pheweb process\`."
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+'''
+This script measures how many rows/sec `AssocFileReader._parse_variant` can parse.
+It compares looking up `parse_utils.parser_for_field` for each value (the old way)
+against the per-file row parser from `parse_utils.make_row_parser()`.
+
+Run it from the root of the repo: `python3 etc/benchmark-row-parser.py [num_rows]`
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pheweb import parse_utils  # noqa: E402
+
+
+def make_rows(num_rows):
+    rng = random.Random(0)
+    rows = []
+    for i in range(num_rows):
+        af = rng.random()
+        rows.append([
+            str(rng.randint(1, 22)), str(rng.randint(1, 250_000_000)), rng.choice('ACGT'), rng.choice('ACGT'),
+            '{:.4g}'.format(rng.random() ** 8), '{:.5f}'.format(rng.gauss(0, 1)), '{:.5f}'.format(rng.random()),
+            '{:.5f}'.format(af), '{:.1f}'.format(af * 20_000), rng.choice(['NA', '{:.4f}'.format(rng.random())]),
+        ])
+    return rows
+
+colidx_for_field = {field: idx for idx, field in enumerate(['chrom', 'pos', 'ref', 'alt', 'pval', 'beta', 'sebeta', 'af', 'ac', 'r2'])}
+
+
+def parse_with_parser_for_field(rows):
+    for values in rows:
+        variant = {}
+        for field, colidx in colidx_for_field.items():
+            if colidx is not None:
+                variant[field] = parse_utils.parser_for_field[field](values[colidx])
+
+def parse_with_row_parser(rows):
+    parse_row = parse_utils.make_row_parser(colidx_for_field)
+    for values in rows:
+        parse_row(values)
+
+
+def time_it(func, rows, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - start)
+    return len(rows) / best
+
+
+if __name__ == '__main__':
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rows = make_rows(num_rows)
+    old_rate = time_it(parse_with_parser_for_field, rows)
+    new_rate = time_it(parse_with_row_parser, rows)
+    print('parser_for_field: {:>10,.0f} rows/sec'.format(old_rate))
+    print('make_row_parser:  {:>10,.0f} rows/sec'.format(new_rate))
+    print('speedup: {:.2f}x'.format(new_rate / old_rate))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+'''
+This script measures how many variants/sec `sites.merge()` can push through `VariantListMerger` for different numbers of input files.
+It compares the heap-based `VariantListMerger` against a sorted list with `bisect` and `.pop(0)` (the way it used to work).
+
+Run it from the root of the repo: `python3 etc/benchmark-variant-list-merger.py [num_variants_per_file]`
+'''
+
+import bisect
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pheweb.load.sites import VariantListMerger  # noqa: E402
+
+
+class BisectVariantListMerger(VariantListMerger):
+    def __init__(self):
+        self._q = []
+    def insert(self, variant, reader_id):
+        for key in [key for key in variant.keys() if key not in ('chrom', 'pos', 'ref', 'alt')]:
+            del variant[key]
+        key = self._key_from_variant(variant)
+        idx = bisect.bisect_left(self._q, (key,))
+        if idx == len(self._q) or self._q[idx][0] != key:
+            self._q.insert(idx, (key, variant, [reader_id]))
+        else:
+            if variant != self._q[idx][1]: raise Exception()
+            self._q[idx][2].append(reader_id)
+    def pop(self):
+        return self._q.pop(0)[1:3]
+    def __len__(self):
+        return len(self._q)
+
+
+def make_files(num_files, num_variants_per_file):
+    rng = random.Random(0)
+    shared = rng.sample(range(1, 10**8), num_variants_per_file * 4 // 5)  # most variants are in most files
+    files = []
+    for _ in range(num_files):
+        positions = sorted(set(pos for pos in shared if rng.random() < 0.8) | set(rng.sample(range(1, 10**8), num_variants_per_file // 5)))
+        files.append([{'chrom': '1', 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': 0.5} for pos in positions])
+    return files
+
+def merge(merger_class, files):
+    # This is the loop from `sites.merge()`, without reading or writing files
+    readers = [iter([dict(v) for v in f]) for f in files]
+    vlm = merger_class()
+    for reader_id, reader in enumerate(readers):
+        vlm.insert(next(reader), reader_id)
+    num_variants = 0
+    while vlm:
+        v, reader_ids = vlm.pop()
+        num_variants += 1
+        for reader_id in reader_ids:
+            new_v = next(readers[reader_id], None)
+            if new_v is not None: vlm.insert(new_v, reader_id)
+    return num_variants
+
+
+if __name__ == '__main__':
+    num_variants_per_file = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for num_files in [8, 64, 256, 1024]:
+        files = make_files(num_files, num_variants_per_file)
+        num_input_variants = sum(len(f) for f in files)
+        rates = []
+        for merger_class in [BisectVariantListMerger, VariantListMerger]:
+            start = time.perf_counter()
+            merge(merger_class, files)
+            rates.append(num_input_variants / (time.perf_counter() - start))
+        print('{:>4} files: bisect {:>10,.0f} variants/sec   heap {:>10,.0f} variants/sec   speedup {:.2f}x'.format(num_files, *rates, rates[1] / rates[0]))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+'''
+This script compares reading variants as dicts against reading them as `__slots__` records (`conf.variant_records`)
+on the two steps that stream the most variants through `VariantFileReader`:
+  - `sites`: merging several `parsed/*` files with `sites.merge()`
+  - `augment-phenos`: joining `sites.tsv` with a `parsed/*` file with `augment_phenos.convert()`
+For each, it reports the time, the peak memory traced by `tracemalloc`, and the number of memory blocks
+allocated while holding one variant from every reader (ie, what the merge keeps in its queue).
+
+Run it from the root of the repo: `python3 etc/benchmark-variant-records.py [num_variants] [num_phenos]`
+'''
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pheweb import conf  # noqa: E402
+from pheweb.file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath  # noqa: E402
+from pheweb.load import sites, augment_phenos  # noqa: E402
+
+
+def make_data(data_dir, num_variants, num_phenos):
+    conf.overrides['data_dir'] = data_dir
+    rng = random.Random(0)
+    cpras = sorted({(rng.choice(['1', '2', '3']), rng.randint(1, 10**8), rng.choice('ACGT'), rng.choice('ACGT')) for _ in range(num_variants)},
+                   key=lambda cpra: (int(cpra[0]),) + cpra[1:])
+    for phenocode in range(num_phenos):
+        with VariantFileWriter(get_pheno_filepath('parsed', str(phenocode), must_exist=False)) as writer:
+            for chrom, pos, ref, alt in cpras:
+                if rng.random() < 0.8:
+                    writer.write({'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt, 'pval': rng.random(), 'beta': rng.gauss(0, 1),
+                                  'sebeta': rng.random(), 'af': rng.random() / 2, 'ac': rng.randint(1, 1000), 'r2': rng.random()})
+    with VariantFileWriter(get_filepath('sites', must_exist=False)) as writer:
+        for chrom, pos, ref, alt in cpras:
+            writer.write({'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt, 'rsids': 'rs{}'.format(pos), 'nearest_genes': 'ABC1'})
+
+
+def run_merge(num_phenos):
+    files_to_merge = [{'type': 'input', 'filepath': get_pheno_filepath('parsed', str(phenocode))} for phenocode in range(num_phenos)]
+    for _ in sites.merge(files_to_merge, get_filepath('sites', must_exist=False) + '.bench'): pass
+
+def run_augment(num_phenos):
+    augment_phenos.convert({'phenocode': '0'})
+
+def count_blocks_held(num_phenos):
+    '''Counts the blocks allocated while holding the first variant of every parsed file at once, like `sites.merge()` does'''
+    filepaths = [get_pheno_filepath('parsed', str(phenocode)) for phenocode in range(num_phenos)]
+    readers = [VariantFileReader(filepath, records=conf.should_use_variant_records()) for filepath in filepaths]
+    iterators = [iter(reader.__enter__()) for reader in readers]
+    held = [[next(iterator) for _ in range(1)] for iterator in iterators]  # warm up the readers before we start counting
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    held = [[next(iterator) for _ in range(1000)] for iterator in iterators]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    for reader in readers: reader.__exit__(None, None, None)
+    num_held = sum(len(h) for h in held)
+    return sum(stat.size_diff for stat in stats) / num_held, sum(stat.count_diff for stat in stats) / num_held
+
+
+def measure(func, num_phenos):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(num_phenos)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    func(num_phenos)  # time again without tracemalloc slowing down every allocation
+    return min(elapsed, time.perf_counter() - start), peak
+
+
+if __name__ == '__main__':
+    num_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    num_phenos = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_data(data_dir, num_variants, num_phenos)
+        for name, func in [('sites merge', run_merge), ('augment-phenos', run_augment)]:
+            for records in [False, True]:
+                conf.overrides['variant_records'] = records
+                elapsed, peak = measure(func, num_phenos)
+                print('{:<15} {:<8} {:6.2f} sec  peak {:8,.0f} KB'.format(name, 'records' if records else 'dicts', elapsed, peak / 1024))
+        for records in [False, True]:
+            conf.overrides['variant_records'] = records
+            bytes_per_variant, blocks_per_variant = count_blocks_held(num_phenos)
+            print('held variant   {:<8} {:6.0f} bytes  {:4.1f} blocks'.format('records' if records else 'dicts', bytes_per_variant, blocks_per_variant))
@@ -38,8 +38,8 @@ for submodule in '''
  download_genes
  download_genes_from_scratch
  make_gene_aliases_sqlite3
- add_rsids
- add_genes
+ make_rsids_index
+ annotate_sites
  make_cpras_rsids_sqlite3
  augment_phenos
  pheno_correlation
@@ -63,6 +63,8 @@ for submodule in '''
     handlers[submodule.replace('_', '-')] = functools.partial(f, submodule)
 handlers['process'] = handlers['process-assoc-files']
 handlers['parse'] = handlers['parse-input-files']
+handlers['add-rsids'] = handlers['annotate-sites']
+handlers['add-genes'] = handlers['annotate-sites']
 
 def serve(argv:List[str]) -> None:
     from pheweb.serve.run import run
@@ -130,6 +130,10 @@ def get_hg_build_number() -> int:
 def get_grch_build_number() -> int:
     hg = get_hg_build_number()
     return hg if hg >= 38 else 18 + hg
+def get_vep_consequences_filepath() -> Optional[str]:
+    filepath = _get_config_optional_str('vep_consequences_file')  # the VEP output made by `etc/annotate_vep/run.sh`, for `annotate-sites` to add `consequence` from
+    if filepath is None: return None
+    return os.path.abspath(os.path.expanduser(filepath))
 
 def get_num_procs(cmd:Optional[str] = None) -> int:
     import multiprocessing
@@ -142,11 +146,21 @@ def get_num_procs(cmd:Optional[str] = None) -> int:
     except Exception: pass
     n_cpus = multiprocessing.cpu_count()
     return 1 if n_cpus==1 else int(n_cpus * 3/4)
+def get_bgzf_decompression_threads() -> int: return _get_config_int('bgzf_decompression_threads', 4)  # 0 means decompress with python's gzip module
+def get_bgzf_compression_threads() -> int: return _get_config_int('bgzf_compression_threads', 4)  # 0 means compress on the thread that's writing
+def get_bgzf_compression_level() -> int: return _get_config_int('bgzf_compression_level', 5)  # for the BGZF files that pheweb writes, from 0 (none) to 9 (slowest)
+def get_matrix_max_open_files() -> int: return _get_config_int('matrix_max_open_files', 1000)  # with more new phenotypes than this, `pheweb matrix` merges them in blocks first
 
 
 
 ## Parsing config
 def get_assoc_min_maf() -> float: return _get_config_float('assoc_min_maf', 0)
+def get_assoc_parse_block_size() -> int: return _get_config_int('assoc_parse_block_size', 10_000)  # 0 means parse one line at a time
+def get_assoc_parse_shard_size() -> int: return _get_config_int('assoc_parse_shard_size', 2**30)  # 0 means never split one input file across processes
+def should_use_binary_variant_files() -> bool: return _get_config_bool('binary_variant_files', False)  # write parsed/* and pheno_bin/* in PheWeb's binary variant format
+def get_assoc_sort_run_size() -> int: return _get_config_int('assoc_sort_run_size', 2_000_000)  # number of variants that `parse-input-files --sort` holds in memory
+def should_use_variant_records() -> bool: return _get_config_bool('variant_records', False)  # have `sites` and `augment-phenos` read variants as `__slots__` records instead of dicts
+def should_use_sparse_matrix() -> bool: return _get_config_bool('sparse_matrix', False)  # write only the phenotypes that have each variant on its line of matrix.tsv.gz
 def get_field_aliases() -> Dict[str,str]:
     return overrides.get('field_aliases', parse_utils.default_field_aliases)
 
@@ -5,6 +5,7 @@ from . import parse_utils
 
 import io
 import os
+import shutil
 import csv
 from contextlib import contextmanager
 import json
@@ -13,8 +14,12 @@ import datetime
 from boltons.fileutils import AtomicSaver, mkdir_p
 import pysam
 import itertools, random
+import array
+import collections.abc
+import functools
+import operator
 from pathlib import Path
-from typing import List, Callable, Dict, Union, Iterator, Optional, Any
+from typing import List, Callable, Dict, Union, Iterator, Generator, Optional, Any, Tuple, BinaryIO
 
 
 def get_generated_path(*path_parts:str) -> str:
@@ -39,13 +44,15 @@ _single_filepaths: Dict[str,Callable[[],str]] = {
     'rsids': (lambda: get_generated_path('resources/rsids-v{}-hg{}.tsv.gz'.format(dbsnp_version, conf.get_hg_build_number()))),
     'rsids-hg19': (lambda: get_generated_path('resources/rsids-v{}-hg19.tsv.gz'.format(dbsnp_version))),
     'rsids-hg38': (lambda: get_generated_path('resources/rsids-v{}-hg38.tsv.gz'.format(dbsnp_version))),
+    'rsids-index': (lambda: get_generated_path('resources/rsids-v{}-hg{}-index'.format(dbsnp_version, conf.get_hg_build_number()))),
     'genes': (lambda: get_generated_path('resources/genes-v{}-hg{}.bed'.format(genes_version, conf.get_hg_build_number()))),
     'genes-hg19': (lambda: get_generated_path('resources/genes-v{}-hg19.bed'.format(genes_version))),
     'genes-hg38': (lambda: get_generated_path('resources/genes-v{}-hg38.bed'.format(genes_version))),
     'gene-aliases-sqlite3': (lambda: get_generated_path('resources/gene_aliases-v{}.sqlite3'.format(genes_version))),
     # simple:
     'unanno': (lambda: get_generated_path('sites/sites-unannotated.tsv')),
-    'sites-rsids': (lambda: get_generated_path('sites/sites-rsids.tsv')),
+    'unanno-manifest': (lambda: get_generated_path('sites/sites-unannotated-manifest.json')),
+    'vep-consequences': (lambda: get_generated_path('sites/vep-consequences.tsv')),
     'sites': (lambda: get_generated_path('sites/sites.tsv')),
     'best-phenos-by-gene-sqlite3': (lambda: get_generated_path('best-phenos-by-gene.sqlite3')),
     'best-phenos-by-gene-old-json': (lambda: get_generated_path('best-phenos-by-gene.json')),
@@ -62,6 +69,7 @@ _single_filepaths: Dict[str,Callable[[],str]] = {
     # directories for pheno filepaths:
     'parsed': (lambda: get_generated_path('parsed')),
     'pheno_gz': (lambda: get_generated_path('pheno_gz')),
+    'pheno_bin': (lambda: get_generated_path('pheno_bin')),
     'best_of_pheno': (lambda: get_generated_path('best_of_pheno')),
     'manhattan': (lambda: get_generated_path('manhattan')),
     'qq': (lambda: get_generated_path('qq')),
@@ -77,16 +85,22 @@ _pheno_filepaths: Dict[str,Callable[[str],str]] = {
     'parsed': (lambda phenocode: get_generated_path('parsed', phenocode)),
     'pheno_gz': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz'.format(phenocode))),
     'pheno_gz_tbi': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz.tbi'.format(phenocode))),
+    'pheno_bin': (lambda phenocode: get_generated_path('pheno_bin', phenocode)),
     'best_of_pheno': (lambda phenocode: get_generated_path('best_of_pheno', phenocode)),
     'manhattan': (lambda phenocode: get_generated_path('manhattan', '{}.json'.format(phenocode))),
     'qq': (lambda phenocode: get_generated_path('qq', '{}.json'.format(phenocode))),
 }
 
+def get_augmented_pheno_filepath(phenocode:str, *, must_exist:bool = True) -> str:
+    '''The per-pheno file for manhattan, qq, and best_of_pheno to read: `pheno_bin` if `binary_variant_files` is set, otherwise `pheno_gz`'''
+    return get_pheno_filepath('pheno_bin' if conf.should_use_binary_variant_files() else 'pheno_gz', phenocode, must_exist=must_exist)
+
 
 def make_basedir(path:Union[str,Path]) -> None:
     mkdir_p(os.path.dirname(path))
 
-def get_tmp_path(arg:Union[Path,str]) -> str:
+def get_tmp_path(arg:Union[Path,str], *, reuse:bool = False) -> str:
+    '''If `reuse`, this returns the same path even if it already exists, so that the caller can replace what an interrupted run left there.'''
     if isinstance(arg, Path): arg = str(arg)
     if arg.startswith(get_generated_path()):
         mkdir_p(get_generated_path('tmp'))
@@ -98,7 +112,7 @@ def get_tmp_path(arg:Union[Path,str]) -> str:
         mkdir_p(get_generated_path('tmp'))
         ret = get_generated_path('tmp', arg)
     assert ret != arg, (ret, arg)
-    while os.path.exists(ret):
+    while not reuse and os.path.exists(ret):
         ret = '{}/{}-{}'.format(os.path.dirname(ret), random.choice('123456789'), os.path.basename(ret))
     return ret
 
@@ -123,7 +137,8 @@ csv.register_dialect(
 ## Readers
 
 @contextmanager
-def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = False):
+def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = False, records:bool = False, columns:Optional[List[str]] = None,
+                      chrom:Optional[str] = None):
     '''
     Reads variants (as dictionaries) from an internal file.  Iterable.  Exposes `.fields`.
 
@@ -131,7 +146,32 @@ def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = F
             print(reader.fields)
             for variant in reader:
                 print(variant)
+
+    With `records=True`, each variant is a `__slots__` record (see `make_variant_record_class()`) instead of a dict.
+    Records support the same `variant['pval']`, `.get()`, `.update()`, `del`, etc as dicts, but use less memory.
+
+    With `columns=['chrom', 'pos', 'pval']`, each variant only has those fields (or whichever of them are in the file),
+    and the other columns aren't parsed (or, when possible, even split apart).
+    `reader.get_full_variant(variant)` returns a dict with all of the fields of a variant from that reader, for when you need a few of them.
+
+    With `chrom='2'`, only the variants on that chromosome are read, by seeking to them with the file's chromosome index (see `get_chrom_index()`).
     '''
+    if isinstance(filepath, Path): filepath = str(filepath)
+    assert columns is None or not (only_per_variant_fields or records), "`columns` can't be combined with `only_per_variant_fields` or `records`"
+    chrom_offset, chrom_num_variants = 0, 0
+    if chrom is not None:
+        chrom_index = get_chrom_index(filepath)
+        if chrom_index is None: raise PheWebError("The file {!r} doesn't have an up-to-date chromosome index, so it can't be read by chromosome".format(filepath))
+        for indexed_chrom, chrom_offset, chrom_num_variants in chrom_index:
+            if indexed_chrom == chrom: break
+        else:
+            chrom_num_variants = 0
+    if is_binary_variant_file(filepath):
+        with open(filepath, 'rb') as binary_f:
+            binary_reader = _bvfr(binary_f, filepath, only_per_variant_fields, records, columns)
+            if chrom is not None: binary_reader._seek(chrom_offset, chrom_num_variants)
+            yield binary_reader
+        return
     with read_maybe_gzip(filepath) as f:
         reader:Iterator[List[str]] = csv.reader(f, dialect='pheweb-internal-dialect')
         try: fields = next(reader)
@@ -140,36 +180,290 @@ def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = F
             fields[0] = fields[0][1:]
         for field in fields:
             assert field in parse_utils.per_variant_fields or field in parse_utils.per_assoc_fields, field
-        if only_per_variant_fields:
-            yield _vfr_only_per_variant_fields(fields, reader)
+        if chrom is not None:
+            f.seek(chrom_offset)
+            reader = itertools.islice(csv.reader(f, dialect='pheweb-internal-dialect'), chrom_num_variants)
+        if columns is not None:
+            yield _vfr_columns(fields, f if chrom is None else itertools.islice(f, chrom_num_variants), columns)
+        elif only_per_variant_fields:
+            yield _vfr_only_per_variant_fields(fields, reader, records)
         else:
-            yield _vfr(fields, reader)
+            yield _vfr(fields, reader, records)
 class _vfr:
-    def __init__(self, fields:List[str], reader:Iterator[List[str]]):
+    def __init__(self, fields:List[str], reader:Iterator[List[str]], records:bool = False):
         self.fields = fields
         self._reader = reader
+        self._records = records
     def __iter__(self) -> Iterator[Dict[str,Any]]:
         return self._get_variants()
     def _get_variants(self) -> Iterator[Dict[str,Any]]:
         parsers: List[Callable[[str],Any]] = [parse_utils.reader_for_field[field] for field in self.fields]
+        if self._records:
+            record_class = make_variant_record_class(self.fields)
+            for unparsed_variant in self._reader:
+                assert len(unparsed_variant) == len(self.fields), (unparsed_variant, self.fields)
+                yield record_class([parser(value) for parser,value in zip(parsers, unparsed_variant)])
+            return
         for unparsed_variant in self._reader:
             assert len(unparsed_variant) == len(self.fields), (unparsed_variant, self.fields)
             variant = {field: parser(value) for parser,field,value in zip(parsers, self.fields, unparsed_variant)}
             yield variant
 class _vfr_only_per_variant_fields:
-    def __init__(self, fields:List[str], reader:Iterator[List[str]]):
+    def __init__(self, fields:List[str], reader:Iterator[List[str]], records:bool = False):
         self._all_fields = fields
         self._extractors = [(parse_utils.reader_for_field[field], field, colidx) for colidx,field in enumerate(fields) if field in parse_utils.per_variant_fields]
         self.fields = [e[1] for e in self._extractors]
         self._reader = reader
+        self._records = records
     def __iter__(self) -> Iterator[Dict[str,Any]]:
         return self._get_variants()
     def _get_variants(self) -> Iterator[Dict[str,Any]]:
+        if self._records:
+            record_class = make_variant_record_class(self.fields)
+            for unparsed_variant in self._reader:
+                assert len(unparsed_variant) == len(self._all_fields), (unparsed_variant, self._all_fields)
+                yield record_class([parser(unparsed_variant[colidx]) for parser,field,colidx in self._extractors])
+            return
         for unparsed_variant in self._reader:
             assert len(unparsed_variant) == len(self._all_fields), (unparsed_variant, self._all_fields)
             variant = {field: parser(unparsed_variant[colidx]) for parser,field,colidx in self._extractors}
             yield variant
 
+class _PartialVariant(dict):
+    '''A variant from `VariantFileReader(..., columns=[...])`, which remembers where it came from so that `reader.get_full_variant()` can parse the rest of it'''
+    __slots__ = ('_source',)
+    _source: Any  # the line (or the chunk offset and row) of the variant, or where `augment_phenos.join_lines()` wrote it
+class _vfr_columns:
+    '''
+    Reads only the columns in `columns`.  Each line is only split as far as the last of those columns.
+    Lines with a `"` or `\\` might have quoted or escaped tabs, so those are split by `csv` like usual.
+    '''
+    def __init__(self, fields:List[str], f, columns:List[str]):
+        self._all_fields = fields
+        self._all_parsers = [parse_utils.reader_for_field[field] for field in fields]
+        self._extractors = [(parse_utils.reader_for_field[field], field, colidx) for colidx,field in enumerate(fields) if field in columns]
+        self.fields = [e[1] for e in self._extractors]
+        self._num_splits = max((e[2] for e in self._extractors), default=-1) + 1
+        self._num_values = min(self._num_splits + 1, len(fields))  # the last value is the unsplit rest of the line
+        self._f = f
+    def __iter__(self) -> Iterator[Dict[str,Any]]:
+        return self._get_variants()
+    def _get_variants(self) -> Iterator[Dict[str,Any]]:
+        extractors, num_splits, num_values = self._extractors, self._num_splits, self._num_values
+        for line in self._f:
+            if line.endswith('\n'): line = line[:-1]
+            if '"' in line or '\\' in line:
+                values = self._split_with_csv(line)
+            else:
+                values = line.split('\t', num_splits)
+                if len(values) != num_values:
+                    raise PheWebError("The line {!r} doesn't have the fields {!r}".format(line, self._all_fields))
+            variant = _PartialVariant((field, parser(values[colidx])) for parser,field,colidx in extractors)
+            variant._source = line
+            yield variant
+    def _split_with_csv(self, line:str) -> List[str]:
+        values = next(csv.reader([line], dialect='pheweb-internal-dialect'))
+        if len(values) != len(self._all_fields): raise PheWebError("The line {!r} doesn't have the fields {!r}".format(line, self._all_fields))
+        return values
+    def get_full_variant(self, variant:Dict[str,Any]) -> Dict[str,Any]:
+        full_variant = {field: parser(value) for parser,field,value in zip(self._all_parsers, self._all_fields, self._split_with_csv(variant._source))}  # type: ignore
+        full_variant.update(variant)  # keep anything that the caller added
+        return full_variant
+
+
+class _VariantRecord(collections.abc.MutableMapping):
+    '''
+    A dict-like variant that keeps the fields from its file's header in `__slots__`.
+    Keys that aren't in the header (eg, `chrom_idx`) go into a small dict that's only created when needed.
+    Subclasses are made by `make_variant_record_class()`.
+    '''
+    __slots__ = ('_extra',)
+    _extra: Optional[Dict[str,Any]]
+    _fields: Tuple[str,...] = ()
+    _slot_for_field: Dict[str,str] = {}
+    _get_slots: Callable[[Any],Tuple[Any,...]]
+    def __getitem__(self, key:str) -> Any:
+        slot = self._slot_for_field.get(key)
+        if slot is not None:
+            try: return getattr(self, slot)
+            except AttributeError: raise KeyError(key) from None
+        if self._extra is None: raise KeyError(key)
+        return self._extra[key]
+    def __setitem__(self, key:str, value:Any) -> None:
+        slot = self._slot_for_field.get(key)
+        if slot is not None: setattr(self, slot, value)
+        elif self._extra is None: self._extra = {key: value}
+        else: self._extra[key] = value
+    def __delitem__(self, key:str) -> None:
+        slot = self._slot_for_field.get(key)
+        if slot is not None:
+            try: delattr(self, slot)
+            except AttributeError: raise KeyError(key) from None
+        elif self._extra is None: raise KeyError(key)
+        else: del self._extra[key]
+    def __contains__(self, key:object) -> bool:
+        slot = self._slot_for_field.get(key)  # type: ignore
+        if slot is not None: return hasattr(self, slot)
+        return self._extra is not None and key in self._extra
+    def get(self, key:str, default:Any = None) -> Any:
+        slot = self._slot_for_field.get(key)
+        if slot is not None: return getattr(self, slot, default)
+        if self._extra is None: return default
+        return self._extra.get(key, default)
+    def _asdict(self) -> Dict[str,Any]:
+        try: d = dict(zip(self._fields, self._get_slots(self)))
+        except AttributeError:  # some field has been deleted
+            d = {field: getattr(self, slot) for field, slot in self._slot_for_field.items() if hasattr(self, slot)}
+        if self._extra is not None: d.update(self._extra)
+        return d
+    # These return views of a snapshot, which is all that PheWeb needs and is much faster than going through `__getitem__`.
+    def keys(self): return self._asdict().keys()
+    def values(self): return self._asdict().values()
+    def items(self): return self._asdict().items()
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._asdict())
+    def __len__(self) -> int:
+        return len(self._asdict())
+    def __eq__(self, other:object) -> bool:
+        if isinstance(other, _VariantRecord): return self._asdict() == other._asdict()
+        if isinstance(other, collections.abc.Mapping): return self._asdict() == dict(other.items())
+        return NotImplemented
+    __hash__ = None  # type: ignore
+    def __repr__(self) -> str:
+        return repr(self._asdict())
+    def __reduce__(self):
+        return (dict, (self._asdict(),))  # the class is made at runtime, so unpickle as a plain dict
+    def copy(self) -> Dict[str,Any]:
+        return self._asdict()
+
+def _attrgetter_tuple(names:Tuple[str,...]) -> Callable[[Any],Tuple[Any,...]]:
+    if not names: return lambda obj: ()
+    getter = operator.attrgetter(*names)
+    if len(names) == 1: return lambda obj: (getter(obj),)
+    return getter
+@functools.lru_cache(maxsize=None)
+def _make_variant_record_class(fields:Tuple[str,...]) -> type:
+    slots = tuple('_f{}'.format(i) for i in range(len(fields)))
+    namespace:Dict[str,Any] = {
+        '__slots__': slots,
+        '_fields': fields,
+        '_slot_for_field': dict(zip(fields, slots)),
+        '_get_slots': staticmethod(_attrgetter_tuple(slots)),
+    }
+    # Like `collections.namedtuple`, build `__init__` from source so that filling the slots is just one unpacking assignment.
+    source = 'def __init__(self, values):\n    {} = values\n    self._extra = None\n'.format(''.join('self.{}, '.format(slot) for slot in slots) or '_')
+    exec(source, namespace)
+    return type('VariantRecord', (_VariantRecord,), namespace)
+def make_variant_record_class(fields:List[str]) -> type:
+    '''Returns a class whose instances are made like `cls([chrom, pos, ...])` with one value per field and act like `dict(zip(fields, values))`'''
+    return _make_variant_record_class(tuple(fields))
+
+
+# PheWeb's binary variant format, written by `VariantFileWriter(..., binary=True)`:
+#  - `_binary_magic`
+#  - a header: a uint32 length and then JSON like {"fields": ["chrom", "pos", ...], "kinds": ["str", "int", ...]}
+#  - chunks of up to `_bvfw.max_chunk_size` variants, each from a single chromosome.  Each chunk has:
+#    - a uint32 length and then JSON like {"num_variants": 123, "columns": [{"nbytes": 984, "null_nbytes": 0, "dictionary": [...]}, ...]}
+#    - for each column, `nbytes` of little-endian values and then `null_nbytes` of a uint8 mask of which values are ''.
+#      Values are float64 for "float" fields, int64 for "int" fields, and uint32 indexes into `dictionary` for "str" fields.
+_binary_magic = b'\x93PHEWEB\x01'
+_binary_dtype_for_kind = {'float': '<f8', 'int': '<i8', 'str': '<u4'}
+def is_binary_variant_file(filepath:str) -> bool:
+    with open(filepath, 'rb', buffering=0) as f:
+        return f.read(len(_binary_magic)) == _binary_magic
+def _binary_kind_for_field(field:str) -> str:
+    field_type = parse_utils.fields[field]['type'] if field in parse_utils.fields else str
+    if field_type is float: return 'float'
+    if field_type in (int, parse_utils.scientific_int): return 'int'
+    return 'str'
+def _read_binary_json(f, filepath:str) -> Optional[Dict[str,Any]]:
+    length_bytes = f.read(4)
+    if not length_bytes: return None
+    length = int.from_bytes(length_bytes, 'little')
+    data = f.read(length)
+    if len(length_bytes) != 4 or len(data) != length: raise PheWebError("The binary variant file {!r} is truncated".format(filepath))
+    return json.loads(data)
+
+class _bvfr:
+    '''Reads variants from PheWeb's binary variant format, converting a whole column of a chunk at once instead of parsing each value'''
+    def __init__(self, f, filepath:str, only_per_variant_fields:bool, records:bool = False, columns:Optional[List[str]] = None):
+        self._f = f
+        self._records = records
+        self._columns = columns
+        self._filepath = filepath
+        f.read(len(_binary_magic))
+        header = _read_binary_json(f, filepath)
+        if header is None: raise PheWebError("It looks like the file {} is empty".format(filepath))
+        self._all_fields:List[str] = header['fields']
+        self._kinds:List[str] = header['kinds']
+        for field in self._all_fields:
+            assert field in parse_utils.per_variant_fields or field in parse_utils.per_assoc_fields, field
+        if columns is not None:
+            self._colidxs = [colidx for colidx, field in enumerate(self._all_fields) if field in columns]
+        else:
+            self._colidxs = [colidx for colidx, field in enumerate(self._all_fields) if not only_per_variant_fields or field in parse_utils.per_variant_fields]
+        self.fields = [self._all_fields[colidx] for colidx in self._colidxs]
+        self._full_chunk:Optional[Tuple[int,List[List[Any]]]] = None  # the last chunk that `get_full_variant()` read
+        self._num_variants_left:Optional[int] = None  # set by `_seek()` to stop at the end of a chromosome
+    def __iter__(self) -> Iterator[Dict[str,Any]]:
+        return self._get_variants()
+    def _get_variants(self) -> Iterator[Dict[str,Any]]:
+        fields = self.fields
+        if self._records:
+            record_class = make_variant_record_class(fields)
+            for offset, num_variants, columns in self._get_chunks():
+                yield from map(record_class, zip(*columns))
+            return
+        if self._columns is not None:
+            for offset, num_variants, columns in self._get_chunks():
+                for row_idx, values in enumerate(zip(*columns) if columns else itertools.repeat((), num_variants)):
+                    variant = _PartialVariant(zip(fields, values))
+                    variant._source = (offset, row_idx)
+                    yield variant
+            return
+        for offset, num_variants, columns in self._get_chunks():
+            for values in zip(*columns):
+                yield dict(zip(fields, values))
+    def get_full_variant(self, variant:Dict[str,Any]) -> Dict[str,Any]:
+        offset, row_idx = variant._source  # type: ignore
+        if self._full_chunk is None or self._full_chunk[0] != offset:
+            position = self._f.tell()
+            self._f.seek(offset)
+            self._full_chunk = (offset, self._read_chunk(list(range(len(self._all_fields))))[1]) # type: ignore
+            self._f.seek(position)
+        full_variant = {field: column[row_idx] for field, column in zip(self._all_fields, self._full_chunk[1])}
+        full_variant.update(variant)  # keep anything that the caller added
+        return full_variant
+    def _seek(self, offset:int, num_variants:int) -> None:
+        '''Only read the `num_variants` variants in the chunks starting at `offset`'''
+        self._f.seek(offset)
+        self._num_variants_left = num_variants
+    def _get_chunks(self) -> Iterator[Tuple[int,int,List[List[Any]]]]:
+        while self._num_variants_left is None or self._num_variants_left > 0:
+            offset = self._f.tell()
+            num_variants, columns = self._read_chunk(self._colidxs)
+            if num_variants == 0: return
+            if self._num_variants_left is not None: self._num_variants_left -= num_variants
+            yield (offset, num_variants, columns)
+    def _read_chunk(self, colidxs:List[int]) -> Tuple[int,List[List[Any]]]:
+        import numpy as np
+        chunk = _read_binary_json(self._f, self._filepath)
+        if chunk is None: return (0, [])
+        columns:Dict[int,List[Any]] = {}
+        for colidx, (kind, column) in enumerate(zip(self._kinds, chunk['columns'])):
+            if colidx not in colidxs:
+                self._f.seek(column['nbytes'] + column['null_nbytes'], 1)
+                continue
+            values = np.frombuffer(self._f.read(column['nbytes']), dtype=_binary_dtype_for_kind[kind])
+            if kind == 'str':
+                values = np.array(column['dictionary'], dtype=object)[values]
+            values = values.tolist()
+            if column['null_nbytes']:
+                for idx in np.flatnonzero(np.frombuffer(self._f.read(column['null_nbytes']), dtype=np.uint8)).tolist():
+                    values[idx] = ''
+            if len(values) != chunk['num_variants']: raise PheWebError("The binary variant file {!r} is corrupt".format(self._filepath))
+            columns[colidx] = values
+        return (chunk['num_variants'], [columns[colidx] for colidx in colidxs])
 
 @contextmanager
 def IndexedVariantFileReader(phenocode:str):
@@ -185,7 +479,7 @@ def IndexedVariantFileReader(phenocode:str):
     with pysam.TabixFile(filepath, parser=None) as tabix_file:
         yield _ivfr(tabix_file, colidxs)
 class _ivfr:
-    def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int]):
+    def __init__(self, _tabix_file:Optional[pysam.TabixFile], _colidxs:Dict[str,int]):
         self._tabix_file=_tabix_file
         self._colidxs=_colidxs
 
@@ -197,7 +491,8 @@ class _ivfr:
             try:
                 variant[field] = parser(val)
             except Exception as exc:
-                raise PheWebError('ERROR: Failed to parse the value {!r} for field {!r} in file {!r}'.format(val, field, self._tabix_file.filename)) from exc
+                filename = self._tabix_file.filename if self._tabix_file is not None else None
+                raise PheWebError('ERROR: Failed to parse the value {!r} for field {!r} in file {!r}'.format(val, field, filename)) from exc
         return variant
 
     def get_region(self, chrom:str, start:int, end:int) -> Iterator[Dict[str,Any]]:
@@ -207,6 +502,7 @@ class _ivfr:
               'chrom': 'X', 'pos': 43254, ...,
             }, ...]
         '''
+        assert self._tabix_file is not None, 'a matrix reader without a TabixFile can only get single variants'
         if start < 1: start = 1
         if start >= end: return []
         if chrom not in self._tabix_file.contigs: return []
@@ -222,7 +518,7 @@ class _ivfr:
         for variant_row in reader:
             yield self._parse_variant_row(variant_row)
 
-    def get_variant(self, chrom:str, pos:int, ref:str, alt:int) -> Optional[Dict[str,Any]]:
+    def get_variant(self, chrom:str, pos:int, ref:str, alt:str) -> Optional[Dict[str,Any]]:
         x = self.get_region(chrom, pos, pos+1)
         for variant in x:
             if variant['pos'] != pos:
@@ -233,9 +529,25 @@ class _ivfr:
         return None
 
 
+# A sparse matrix.tsv.gz has this line before its header, and then each line only has the per-variant fields and,
+# for each phenotype that has the variant, the index of the phenotype (in the header) and its per-assoc fields.
+_sparse_matrix_meta_line = '##pheweb_matrix_format=sparse'
+
+def read_matrix_header(filepath:str) -> Tuple[bool, List[str]]:
+    '''Returns whether `matrix.tsv.gz` is sparse, and its column names (without the "#")'''
+    with read_gzip(filepath) as f:
+        line = next(f).rstrip('\n')
+        is_sparse = line == _sparse_matrix_meta_line
+        if is_sparse: line = next(f).rstrip('\n')
+    colnames = line.split('\t')
+    assert colnames[0].startswith('#'), colnames
+    colnames[0] = colnames[0][1:]
+    return is_sparse, colnames
+
 class MatrixReader:
     def __init__(self):
         self._filepath = get_generated_path('matrix.tsv.gz')
+        self._file_ids = self._get_file_ids()  # before reading anything, so that a matrix replaced while we read is noticed
 
         phenos:List[Dict[str,Any]] = get_phenolist()
         phenocodes:List[str] = [pheno['phenocode'] for pheno in phenos]
@@ -244,11 +556,8 @@ class MatrixReader:
             for pheno in phenos
         }
 
-        with read_gzip(self._filepath) as f:
-            reader = csv.reader(f, dialect='pheweb-internal-dialect')
-            colnames = next(reader)
-        assert colnames[0].startswith('#'), colnames
-        colnames[0] = colnames[0][1:]
+        self._is_sparse, colnames = read_matrix_header(self._filepath)
+        self._cpra_index = get_cpra_index(self._filepath)
 
         self._colidxs:Dict[str,int] = {} # maps field -> column_index
         self._colidxs_for_pheno:Dict[str,Dict[str,int]] = {} # maps phenocode -> field -> column_index
@@ -265,23 +574,52 @@ class MatrixReader:
                 assert field in parse_utils.fields, (field)
                 self._colidxs[field] = colnum
 
+    def _get_file_ids(self) -> List[Optional[Tuple[int,int,int]]]:
+        ret:List[Optional[Tuple[int,int,int]]] = []
+        for filepath in [self._filepath, self._filepath + '.cpra']:
+            try: stat = os.stat(filepath)
+            except FileNotFoundError: ret.append(None)
+            else: ret.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return ret
+    def is_up_to_date(self) -> bool:
+        '''Returns whether `matrix.tsv.gz` and `matrix.tsv.gz.cpra` are still the files that this reader was made from'''
+        return self._get_file_ids() == self._file_ids
+
     def get_phenocodes(self) -> List[str]:
         return list(self._colidxs_for_pheno)
 
     @contextmanager
     def context(self):
         with pysam.TabixFile(self._filepath, parser=None) as tabix_file:
-            yield _mr(tabix_file, self._colidxs, self._colidxs_for_pheno, self._info_for_pheno)
+            yield self._get_mr(tabix_file)
+    def _get_mr(self, tabix_file:Optional[pysam.TabixFile]) -> '_mr':
+        mr_class = _sparse_mr if self._is_sparse else _mr
+        return mr_class(tabix_file, self._colidxs, self._colidxs_for_pheno, self._info_for_pheno, self._cpra_index)
+
+    def get_variant(self, chrom:str, pos:int, ref:str, alt:str) -> Optional[Dict[str,Any]]:
+        '''Finds one variant with `matrix.tsv.gz.cpra` (without opening the `.tbi`), or with tabix if the matrix doesn't have an up-to-date one'''
+        if self._cpra_index is None:
+            with self.context() as mr:
+                return mr.get_variant(chrom, pos, ref, alt)
+        return self._get_mr(None).get_variant(chrom, pos, ref, alt)
 class _mr(_ivfr):
-    def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int], _colidxs_for_pheno:Dict[str,Dict[str,int]], _info_for_pheno:Dict[str,Dict[str,Any]]):
-        self._tabix_file=_tabix_file
+    def __init__(self, _tabix_file:Optional[pysam.TabixFile], _colidxs:Dict[str,int], _colidxs_for_pheno:Dict[str,Dict[str,int]], _info_for_pheno:Dict[str,Dict[str,Any]],
+                 _cpra_index:Optional['_CpraIndex'] = None):
+        self._tabix_file=_tabix_file  # only `None` if `_cpra_index` isn't, and then only `get_variant()` works
         self._colidxs=_colidxs
         self._colidxs_for_pheno=_colidxs_for_pheno
         self._info_for_pheno=_info_for_pheno
+        self._cpra_index=_cpra_index
+        # In the header, the columns of each phenotype are contiguous, so `_MatrixPhenos` only needs the first column of each phenotype in a row.
+        self._fields_for_pheno = {phenocode: sorted(colidxs, key=colidxs.__getitem__) for phenocode, colidxs in _colidxs_for_pheno.items()}
+        self._pval_offset_for_pheno = {phenocode: fields.index('pval') for phenocode, fields in self._fields_for_pheno.items()}
+        self._pheno_columns = [(phenocode, min(colidxs.values()), len(colidxs)) for phenocode, colidxs in _colidxs_for_pheno.items()]
 
     def _parse_field(self, variant_row:List[str], field:str, phenocode:Optional[str] = None) -> Any:
         colidx = self._colidxs[field] if phenocode is None else self._colidxs_for_pheno[phenocode][field]
-        val = variant_row[colidx]
+        return self._parse_value(variant_row[colidx], field, phenocode)
+
+    def _parse_value(self, val:str, field:str, phenocode:Optional[str] = None) -> Any:
         parser = parse_utils.reader_for_field[field]
         try:
             return parser(val)  # type: ignore
@@ -291,18 +629,73 @@ class _mr(_ivfr):
             raise PheWebError(error_message) from exc
 
     def _parse_variant_row(self, variant_row:List[str]) -> Dict[str,Any]:
-        variant:Dict[str,Any] = {'phenos': {}}
-        for field in self._colidxs:
-            variant[field] = self._parse_field(variant_row, field)
-        for phenocode, fields in self._colidxs_for_pheno.items():
-            if any(variant_row[self._colidxs_for_pheno[phenocode][field]] != '' for field in fields):
-                p = {}
-                for field in fields:
-                    p[field] = self._parse_field(variant_row, field, phenocode)
-                    p.update(self._info_for_pheno[phenocode])
-                    variant['phenos'][phenocode] = p
+        variant:Dict[str,Any] = {field: self._parse_field(variant_row, field) for field in self._colidxs}
+        first_colidxs = {phenocode: first_colidx for phenocode, first_colidx, num_fields in self._pheno_columns
+                         if any(variant_row[first_colidx:first_colidx+num_fields])}  # a phenotype without the variant has only empty cells
+        variant['phenos'] = _MatrixPhenos(self, variant_row, first_colidxs)
+        return variant
+
+    def get_variant(self, chrom:str, pos:int, ref:str, alt:str) -> Optional[Dict[str,Any]]:
+        if self._cpra_index is None: return super().get_variant(chrom, pos, ref, alt)
+        chrom_colidx, pos_colidx, ref_colidx, alt_colidx = (self._colidxs[field] for field in ['chrom', 'pos', 'ref', 'alt'])
+        reader:Iterator[List[str]] = csv.reader(self._cpra_index.get_lines(chrom, pos), dialect='pheweb-internal-dialect')
+        for variant_row in reader:  # the lines at `pos` are contiguous
+            if variant_row[chrom_colidx] != chrom or int(variant_row[pos_colidx]) != pos: return None
+            if variant_row[ref_colidx] == ref and variant_row[alt_colidx] == alt:
+                return self._parse_variant_row(variant_row)
+        return None
+
+class _sparse_mr(_mr):
+    '''Reads a sparse matrix, where each row is the per-variant fields and then `pheno_index, *per_assoc_fields` for each phenotype that has the variant'''
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._num_variant_fields = len(self._colidxs)
+        self._phenocodes = list(self._colidxs_for_pheno)  # in the order of the header
+
+    def _parse_variant_row(self, variant_row:List[str]) -> Dict[str,Any]:
+        variant:Dict[str,Any] = {field: self._parse_field(variant_row, field) for field in self._colidxs}
+        first_colidxs:Dict[str,int] = {}
+        idx = self._num_variant_fields
+        while idx < len(variant_row):
+            phenocode = self._phenocodes[int(variant_row[idx])]
+            first_colidxs[phenocode] = idx + 1
+            idx += 1 + len(self._fields_for_pheno[phenocode])
+        variant['phenos'] = _MatrixPhenos(self, variant_row, first_colidxs)
         return variant
 
+class _MatrixPhenos(collections.abc.Mapping):
+    '''
+    The phenotypes that have a variant in `matrix.tsv.gz`, like {phenocode: {'pval': 0.01, ..., and the phenotype's info from pheno-list.json}}.
+    Each phenotype's cells are only parsed when it's accessed, and `iter_pvals()` only parses the pvals.
+    '''
+    def __init__(self, mr:_mr, variant_row:List[str], first_colidxs:Dict[str,int]):
+        self._mr = mr
+        self._variant_row = variant_row
+        self._first_colidxs = first_colidxs  # maps phenocode -> the column of its first field in `variant_row`
+        self._phenos:Dict[str,Dict[str,Any]] = {}
+    def __getitem__(self, phenocode:str) -> Dict[str,Any]:
+        pheno = self._phenos.get(phenocode)
+        if pheno is None:
+            first_colidx = self._first_colidxs[phenocode]
+            fields = self._mr._fields_for_pheno[phenocode]
+            pheno = {field: self._mr._parse_value(val, field, phenocode) for field, val in zip(fields, self._variant_row[first_colidx:first_colidx+len(fields)])}
+            pheno.update(self._mr._info_for_pheno[phenocode])
+            self._phenos[phenocode] = pheno
+        return pheno
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._first_colidxs)
+    def __len__(self) -> int:
+        return len(self._first_colidxs)
+    def iter_pvals(self, below:float = float('inf')) -> Iterator[Tuple[str,float]]:
+        '''Yields (phenocode, pval) for each phenotype with pval < `below`, without parsing any other fields'''
+        for phenocode, first_colidx in self._first_colidxs.items():
+            pval = self._mr._parse_value(self._variant_row[first_colidx + self._mr._pval_offset_for_pheno[phenocode]], 'pval', phenocode)
+            if pval < below: yield (phenocode, pval)
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
 
 def with_chrom_idx(variants:Iterator[Dict[str,Any]]) -> Iterator[Dict[str,Any]]:
     for v in variants:
@@ -313,11 +706,143 @@ def with_chrom_idx(variants:Iterator[Dict[str,Any]]) -> Iterator[Dict[str,Any]]:
 @contextmanager
 def read_gzip(filepath):  # mypy doesn't like it
     # hopefully faster than `gzip.open(filepath, 'rt')` -- TODO: find out whether it is
-    with gzip.GzipFile(filepath, 'rb') as f: # leave in binary mode (default), let TextIOWrapper decode
+    num_threads = conf.get_bgzf_decompression_threads()
+    if num_threads > 0 and is_bgzf(filepath):
+        f = _BgzfReader(filepath, num_threads)
+    else:
+        f = gzip.GzipFile(filepath, 'rb') # leave in binary mode (default), let TextIOWrapper decode
+    with f:
         with io.BufferedReader(f, buffer_size=2**18) as g: # 256KB buffer
             with io.TextIOWrapper(g) as h: # bytes -> unicode
                 yield h
 
+def is_bgzf(filepath:str) -> bool:
+    '''Checks whether the first gzip member has the "BC" extra subfield that BGZF blocks have'''
+    with open(filepath, 'rb', buffering=0) as f:
+        header = f.read(16)
+    return (len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04' and
+            header[10:12] == b'\x06\x00' and header[12:14] == b'BC' and header[14:16] == b'\x02\x00')
+
+class _BgzfReader(io.RawIOBase):
+    '''
+    Reads the decompressed bytes of a BGZF file (like `gzip.GzipFile`), but inflates blocks on a pool of threads.
+    zlib releases the GIL, so the threads run in parallel with each other and with whoever is reading the lines.
+    Blocks are always returned in order.
+    '''
+    _blocks_per_task = 16  # each block is <64KB, so this keeps the overhead of each task small
+    def __init__(self, filepath:str, num_threads:int, start_offset:int = 0):
+        self._filepath = filepath
+        self._f = open(filepath, 'rb')
+        self._f.seek(start_offset)
+        self._chunks:Generator[bytes,None,None] = self._get_decompressed_chunks(num_threads)
+        self._chunk = memoryview(b'')
+        self._offset = 0
+    def readable(self) -> bool: return True
+    def readinto(self, b) -> int:
+        while self._offset >= len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None: return 0
+            self._chunk, self._offset = memoryview(chunk), 0
+        n = min(len(b), len(self._chunk) - self._offset)
+        b[:n] = self._chunk[self._offset:self._offset+n]
+        self._offset += n
+        return n
+    def close(self) -> None:
+        if not self.closed:
+            self._chunks.close() # waits for any running tasks
+            self._f.close()
+        super().close()
+
+    def _get_decompressed_chunks(self, num_threads:int) -> Generator[bytes,None,None]:
+        import concurrent.futures, collections
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+            pending: collections.deque = collections.deque()
+            block_iterator = self._read_blocks()
+            while True:
+                blocks = list(itertools.islice(block_iterator, self._blocks_per_task))
+                if not blocks: break
+                pending.append(executor.submit(self._inflate_blocks, blocks))
+                if len(pending) > 2 * num_threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _read_blocks(self) -> Iterator[bytes]:
+        # Yields the raw bytes of each BGZF block, header included
+        while True:
+            header = self._f.read(18)
+            if not header: return
+            offset = self._f.tell() - len(header)
+            if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[10:14] != b'\x06\x00BC':
+                raise PheWebError("The file {!r} looks like BGZF but has a block that isn't BGZF at offset {}".format(self._filepath, offset))
+            block_size = int.from_bytes(header[16:18], 'little') + 1
+            rest = self._f.read(block_size - 18)
+            if len(rest) != block_size - 18:
+                raise PheWebError("The file {!r} has a truncated BGZF block at offset {}".format(self._filepath, offset))
+            yield header + rest
+
+    def _inflate_blocks(self, blocks:List[bytes]) -> bytes:
+        import zlib
+        out = []
+        for block in blocks:
+            try:
+                data = zlib.decompress(block[18:-8], wbits=-15)
+            except zlib.error as exc:
+                raise PheWebError("The file {!r} is corrupt: a BGZF block failed to decompress".format(self._filepath)) from exc
+            crc, size = int.from_bytes(block[-8:-4], 'little'), int.from_bytes(block[-4:], 'little')
+            if len(data) != size or zlib.crc32(data) != crc:
+                raise PheWebError("The file {!r} is corrupt: a BGZF block failed its CRC or length check".format(self._filepath))
+            out.append(data)
+        return b''.join(out)
+
+def get_bgzf_shards(filepath:str, shard_size:int) -> List[Dict[str,Any]]:
+    '''
+    Splits a BGZF file into shards of about `shard_size` compressed bytes that start at block boundaries, for `read_bgzf_shard()`.
+    Each shard owns the lines that start inside its blocks, so a shard may end partway through its last line.
+    '''
+    blocks = []  # [(offset, decompressed_size)]
+    with open(filepath, 'rb') as f:
+        offset = 0
+        while True:
+            f.seek(offset)
+            header = f.read(18)
+            if not header: break
+            if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[10:14] != b'\x06\x00BC':
+                raise PheWebError("The file {!r} looks like BGZF but has a block that isn't BGZF at offset {}".format(filepath, offset))
+            block_size = int.from_bytes(header[16:18], 'little') + 1
+            f.seek(offset + block_size - 4)
+            blocks.append((offset, int.from_bytes(f.read(4), 'little')))
+            offset += block_size
+    shards: List[Dict[str,Any]] = []
+    for i, (offset, decompressed_size) in enumerate(blocks):
+        # Start a new shard only after a non-empty block, so that `read_bgzf_shard()` can check whether that block ended a line.
+        if not shards or (offset - shards[-1]['start'] >= shard_size and blocks[i-1][1] > 0 and decompressed_size > 0):
+            prev_start, prev_length = blocks[i-1] if shards else (None, 0)
+            shards.append({'start': offset, 'length': 0, 'prev_start': prev_start, 'prev_length': prev_length})
+        shards[-1]['length'] += decompressed_size
+    return shards
+
+@contextmanager
+def read_bgzf_shard(filepath:str, shard:Dict[str,Any]):
+    '''Yields an iterator over the lines (as `str`) of one shard from `get_bgzf_shards()`'''
+    start_offset = shard['start'] if shard['prev_start'] is None else shard['prev_start']
+    with _BgzfReader(filepath, max(1, conf.get_bgzf_decompression_threads()), start_offset) as raw_f:
+        with io.BufferedReader(raw_f, buffer_size=2**18) as f:
+            remaining = shard['length']
+            if shard['prev_start'] is not None:
+                prev_block = f.read(shard['prev_length'])
+                if not prev_block.endswith(b'\n'):
+                    remaining -= len(f.readline()) # the rest of this line belongs to the previous shard
+            yield _read_lines_starting_before(f, remaining)
+def _read_lines_starting_before(f, num_bytes:int) -> Iterator[str]:
+    import locale
+    encoding = locale.getpreferredencoding(False) # the same as `io.TextIOWrapper`
+    while num_bytes > 0:
+        line = f.readline()
+        if not line: return
+        num_bytes -= len(line)
+        yield line.decode(encoding)
+
 @contextmanager
 def read_maybe_gzip(filepath:Union[str,Path]):
     if isinstance(filepath, Path): filepath = str(filepath)
@@ -337,7 +862,8 @@ def read_maybe_gzip(filepath:Union[str,Path]):
 ## Writers
 
 @contextmanager
-def VariantFileWriter(filepath:str, allow_extra_fields:bool = True, use_gzip:bool = False):
+def VariantFileWriter(filepath:str, allow_extra_fields:bool = True, use_gzip:bool = False, binary:bool = False, indexed:bool = False,
+                      chrom_index:bool = False):
     '''
     Writes variants (represented by dictionaries) to an internal file.
 
@@ -345,13 +871,44 @@ def VariantFileWriter(filepath:str, allow_extra_fields:bool = True, use_gzip:boo
             writer.write({'chrom': '2', 'pos': 47, ...})
 
     Each variant/association/hit/loci written must have a subset of the keys of the first one.
+    If `binary` is True, the file is in PheWeb's binary variant format, which `VariantFileReader` reads without parsing each value.
+    If `indexed` is True, the file is BGZF and `{filepath}.tbi` is written too, just like `convert_VariantFile_to_IndexedVariantFile()` makes,
+    but without a temporary file or re-reading anything.  Variants must be sorted and each chromosome must be contiguous.
+    If `chrom_index` is True, `{filepath}.chroms` is written too, so that `VariantFileReader(filepath, chrom=...)` can seek to each chromosome.
+    Each chromosome must be contiguous.
     '''
+    assert not (chrom_index and (indexed or use_gzip)), "`chrom_index` only works with uncompressed files"
     part_file = get_tmp_path(filepath)
     make_basedir(filepath)
-    if use_gzip:
+    if indexed:
         with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
-            with gzip.open(f, 'wt', compresslevel=2) as f_gzip:
-                yield _vfw(f_gzip, allow_extra_fields, filepath)
+            bgzf_f = _BgzfWriter(f)
+            writer = _ivfw(bgzf_f, allow_extra_fields, filepath)
+            yield writer
+            final_offset = bgzf_f.tell()
+            bgzf_f.close()
+            index = writer.get_index(final_offset)
+        # Write the index after the data so that it's newer, because htslib warns about indexes that are older than their data.
+        with AtomicSaver(filepath + '.tbi', text_mode=False, part_file=get_tmp_path(filepath + '.tbi'), overwrite_part=True, rm_part_on_exc=False) as f:
+            bgzf_f = _BgzfWriter(f)
+            bgzf_f.write_bytes(index)
+            bgzf_f.close()
+    elif binary:
+        with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
+            binary_writer = _bvfw(f, allow_extra_fields, filepath)
+            yield binary_writer
+            binary_writer.flush()
+        if chrom_index: write_chrom_index(filepath, binary_writer.chrom_index)
+    elif use_gzip:
+        with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
+            bgzf_f = _BgzfWriter(f)
+            yield _vfw(bgzf_f, allow_extra_fields, filepath)
+            bgzf_f.close()
+    elif chrom_index:
+        with AtomicSaver(filepath, text_mode=True, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
+            chrom_index_writer = _cvfw(f, allow_extra_fields, filepath)
+            yield chrom_index_writer
+        write_chrom_index(filepath, chrom_index_writer.chrom_index)
     else:
         with AtomicSaver(filepath, text_mode=True, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
             yield _vfw(f, allow_extra_fields, filepath)
@@ -362,22 +919,490 @@ class _vfw:
         self._filepath = filepath
     def write(self, variant:Dict[str,Any]) -> None:
         if not hasattr(self, '_writer'):
-            fields:List[str] = []
-            for field in parse_utils.fields:
-                if field in variant: fields.append(field)
-            extra_fields = list(set(variant.keys()) - set(fields))
-            if extra_fields:
-                if not self._allow_extra_fields:
-                    raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
-                                    extra_fields, fields, self._filepath))
-                fields += extra_fields
-            self._writer = csv.DictWriter(self._f, fieldnames=fields, dialect='pheweb-internal-dialect')
-            self._writer.writeheader()
+            self._write_header(variant)
         self._writer.writerow(variant)
+    def _write_header(self, variant:Dict[str,Any]) -> None:
+        fields:List[str] = []
+        for field in parse_utils.fields:
+            if field in variant: fields.append(field)
+        extra_fields = list(set(variant.keys()) - set(fields))
+        if extra_fields:
+            if not self._allow_extra_fields:
+                raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
+                                extra_fields, fields, self._filepath))
+            fields += extra_fields
+        self._writer = csv.DictWriter(self._f, fieldnames=fields, dialect='pheweb-internal-dialect')
+        self._writer.writeheader()
     def write_all(self, variants:Iterator[Dict[str,Any]]) -> None:
         for v in variants:
             self.write(v)
 
+class _cvfw(_vfw):
+    '''Keeps track of the offset and number of variants of each chromosome, for `write_chrom_index()`'''
+    def __init__(self, f, allow_extra_fields:bool, filepath:str):
+        super().__init__(f, allow_extra_fields, filepath)
+        self.chrom_index:List[List[Any]] = []  # like [[chrom, offset, num_variants], ...]
+    def write(self, variant:Dict[str,Any]) -> None:
+        if not self.chrom_index or variant['chrom'] != self.chrom_index[-1][0]:
+            if not hasattr(self, '_writer'): self._write_header(variant)
+            self.chrom_index.append([variant['chrom'], self._f.tell(), 0])
+        self._writer.writerow(variant)
+        self.chrom_index[-1][2] += 1
+
+class _ivfw(_vfw):
+    '''Writes to a `_BgzfWriter` and builds a tabix index of the lines as it goes'''
+    def __init__(self, f, allow_extra_fields:bool, filepath:str):
+        super().__init__(f, allow_extra_fields, filepath)
+        self._indexer:Optional[_TabixIndexer] = None
+    def write(self, variant:Dict[str,Any]) -> None:
+        if self._indexer is None:
+            self._write_header(variant)
+            self._indexer = _TabixIndexer(self._f.tell(), self._filepath)
+        self._writer.writerow(variant)
+        pos = int(variant['pos'])
+        self._indexer.push(str(variant['chrom']), pos - 1, pos, self._f.tell())
+    def get_index(self, final_offset:int) -> bytes:
+        '''Returns the `.tbi` for the lines written so far, after `self._f` (a `_BgzfWriter`) has been closed'''
+        if self._indexer is None: return _TabixIndexer(0, self._filepath).finish(0)
+        return self._indexer.finish(final_offset, self._f.get_virtual_offset)
+
+class _BgzfWriter:
+    '''
+    A minimal text file (for `csv`) that writes BGZF blocks to the binary file `f`, like `bgzip`.
+    Blocks are compressed on a pool of threads (zlib releases the GIL) and are always written in order.
+    A block's compressed size isn't known until it's compressed, so `.tell()` returns (the index of the current block << 16) | (the offset within its
+    uncompressed data), and `.get_virtual_offset()` turns that into a real BGZF virtual offset after the block has been written (eg, after `.close()`).
+    '''
+    block_size = 0xff00  # the most uncompressed data that htslib puts in a block
+    _blocks_per_task = 16
+    def __init__(self, f, compresslevel:Optional[int] = None, num_threads:Optional[int] = None):
+        import concurrent.futures, collections
+        self._f = f
+        self._compresslevel = conf.get_bgzf_compression_level() if compresslevel is None else compresslevel
+        self._num_threads = conf.get_bgzf_compression_threads() if num_threads is None else num_threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._num_threads) if self._num_threads > 0 else None
+        self._pending: collections.deque = collections.deque()
+        self._buf = bytearray()
+        self._blocks:List[bytes] = []  # full blocks that haven't been sent to be compressed yet
+        self._num_blocks = 0
+        self._block_addresses = [0]  # the offset of each block that has been written, followed by the end of the last one
+    def write(self, text:str) -> int:
+        self.write_bytes(text.encode())
+        return len(text)
+    def write_bytes(self, data:bytes) -> None:
+        self._buf += data
+        while len(self._buf) >= self.block_size:
+            self._blocks.append(bytes(self._buf[:self.block_size]))
+            del self._buf[:self.block_size]
+            self._num_blocks += 1
+            if len(self._blocks) >= self._blocks_per_task: self._submit_blocks()
+    def tell(self) -> int:
+        return (self._num_blocks << 16) | len(self._buf)
+    def get_virtual_offset(self, offset:int) -> int:
+        return (self._block_addresses[offset >> 16] << 16) | (offset & 0xffff)
+    def close(self) -> None:
+        if self._buf:
+            self._blocks.append(bytes(self._buf))
+            self._buf = bytearray()
+            self._num_blocks += 1
+        if self._blocks: self._submit_blocks()
+        while self._pending:
+            self._write_blocks(self._pending.popleft().result())
+        if self._executor is not None: self._executor.shutdown()
+        self._f.write(_bgzf_eof_block)
+    def _submit_blocks(self) -> None:
+        blocks, self._blocks = self._blocks, []
+        if self._executor is None:
+            self._write_blocks(_make_bgzf_blocks(blocks, self._compresslevel))
+            return
+        self._pending.append(self._executor.submit(_make_bgzf_blocks, blocks, self._compresslevel))
+        while len(self._pending) > 2 * self._num_threads:
+            self._write_blocks(self._pending.popleft().result())
+    def _write_blocks(self, blocks:List[bytes]) -> None:
+        for block in blocks:
+            self._f.write(block)
+            self._block_addresses.append(self._block_addresses[-1] + len(block))
+
+_bgzf_eof_block = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+def _make_bgzf_blocks(blocks:List[bytes], compresslevel:int) -> List[bytes]:
+    return [_make_bgzf_block(data, compresslevel) for data in blocks]
+def _make_bgzf_block(data:bytes, compresslevel:int) -> bytes:
+    import zlib
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + (len(cdata) + 25).to_bytes(2, 'little')  # BSIZE is the block size minus 1
+    return header + cdata + zlib.crc32(data).to_bytes(4, 'little') + len(data).to_bytes(4, 'little')
+
+class _TabixIndexer:
+    '''
+    Builds a `.tbi` index while lines are written.  It's equivalent to what `pysam.tabix_index(seq_col=0, start_col=1, end_col=1, line_skip=1)` makes,
+    and htslib reads it the same way, but the bytes differ (eg, in the order of bins and in the linear index of empty windows).
+    This follows `hts_idx_push()` and `hts_idx_finish()` in htslib's `hts.c`, with the same binning scheme (14-bit windows, 5 levels).
+    '''
+    _min_shift, _n_lvls = 14, 5
+    _meta_bin = 37450  # the pseudo-bin that holds each chromosome's offsets and number of lines
+    def __init__(self, first_offset:int, filepath:str):
+        self._filepath = filepath
+        self._names:List[str] = []
+        self._bins:List[Dict[int,List[Tuple[int,int]]]] = []  # for each chromosome, {bin: [(start_offset, end_offset), ...]}
+        self._linear:List[List[Optional[int]]] = []  # for each chromosome, the offset of the first line touching each 16kb window
+        self._last_chrom:Optional[str] = None
+        self._last_bin:Optional[int] = None
+        self._last_beg = 0
+        self._last_off = self._save_off = self._off_beg = first_offset
+        self._save_bin:Optional[int] = None
+        self._save_tid = -1  # the chromosome of `_save_bin`
+        self._n_mapped = 0
+    def push(self, chrom:str, beg:int, end:int, offset:int) -> None:
+        '''Adds a line covering the 0-based half-open interval [beg, end) that ends at virtual offset `offset`'''
+        if chrom != self._last_chrom:
+            if chrom in self._names:
+                raise PheWebError("The chromosome {!r} isn't contiguous in {!r}, so it can't be tabix-indexed".format(chrom, self._filepath))
+            self._names.append(chrom)
+            self._bins.append({})
+            self._linear.append([])
+            self._last_chrom, self._last_bin = chrom, None
+        elif beg < self._last_beg:
+            raise PheWebError("The variants in {!r} aren't sorted ({}:{} came after {}:{}), so it can't be tabix-indexed".format(
+                self._filepath, chrom, beg + 1, chrom, self._last_beg + 1))
+        if end > 1 << 29:
+            raise PheWebError("The position {}:{} in {!r} is too large for a tabix index".format(chrom, end, self._filepath))
+        linear = self._linear[-1]
+        first_window, last_window = beg >> self._min_shift, (end - 1) >> self._min_shift
+        if len(linear) <= last_window: linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(first_window, last_window + 1):
+            if linear[window] is None: linear[window] = self._last_off
+        bin_ = 4681 + first_window if first_window == last_window else self._reg2bin(beg, end)  # 4681 is the first bin of 16kb windows
+        if bin_ != self._last_bin:
+            if self._save_bin is not None:
+                self._bins[self._save_tid].setdefault(self._save_bin, []).append((self._save_off, self._last_off))
+                if self._last_bin is None:  # the previous line finished a chromosome
+                    self._bins[self._save_tid][self._meta_bin] = [(self._off_beg, self._last_off), (self._n_mapped, 0)]
+                    self._n_mapped = 0
+                    self._off_beg = self._last_off
+            self._save_off = self._last_off
+            self._save_bin = self._last_bin = bin_
+            self._save_tid = len(self._names) - 1
+        self._n_mapped += 1
+        self._last_off = offset
+        self._last_beg = beg
+    def finish(self, final_offset:int, get_virtual_offset:Callable[[int],int] = (lambda offset: offset)) -> bytes:
+        '''Returns the `.tbi` (before BGZF compression).  `get_virtual_offset` converts the offsets that were passed in into real virtual offsets.'''
+        import struct
+        if self._save_bin is not None:
+            self._bins[self._save_tid].setdefault(self._save_bin, []).append((self._save_off, final_offset))
+            self._bins[self._save_tid][self._meta_bin] = [(self._off_beg, final_offset), (self._n_mapped, 0)]
+        for bins in self._bins:
+            for bin_, chunks in bins.items():
+                if bin_ == self._meta_bin:  # its second "chunk" is the number of lines
+                    bins[bin_] = [(get_virtual_offset(chunks[0][0]), get_virtual_offset(chunks[0][1])), chunks[1]]
+                else:
+                    bins[bin_] = [(get_virtual_offset(start), get_virtual_offset(end)) for start, end in chunks]
+        self._linear = [[None if offset is None else get_virtual_offset(offset) for offset in linear] for linear in self._linear]
+        names = b''.join(name.encode() + b'\0' for name in self._names)
+        # the header holds tabix's conf: preset=generic, seq_col, start_col, end_col (1-based), meta_char, line_skip
+        out = [b'TBI\x01', struct.pack('<7i', len(self._names), 0, 1, 2, 2, ord('#'), 1), struct.pack('<i', len(names)), names]
+        for bins, linear in zip(self._bins, self._linear):
+            offset0 = bins[self._meta_bin][0][0]
+            for window in range(len(linear)):  # fill in empty windows like `update_loff()`
+                if linear[window] is None: linear[window] = linear[window - 1] if window > 0 else offset0
+            bins = self._compress_binning(bins)
+            out.append(struct.pack('<i', len(bins)))
+            for bin_, chunks in sorted(bins.items()):
+                out.append(struct.pack('<Ii', bin_, len(chunks)))
+                out.extend(struct.pack('<QQ', start, end) for start, end in chunks)
+            out.append(struct.pack('<i', len(linear)))
+            out.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+        out.append(struct.pack('<Q', 0))  # no lines without coordinates
+        return b''.join(out)
+    def _compress_binning(self, bins:Dict[int,List[Tuple[int,int]]]) -> Dict[int,List[Tuple[int,int]]]:
+        # Like `compress_binning()`: merge bins whose chunks span <64KB of compressed data into their parent bins,
+        # and then merge adjacent chunks that start in the same BGZF block.
+        bins = {bin_: list(chunks) for bin_, chunks in bins.items()}
+        for level in range(self._n_lvls, 0, -1):
+            first_bin_in_level = ((1 << (3 * level)) - 1) // 7
+            for bin_ in sorted(bins):
+                if bin_ == self._meta_bin or bin_ < first_bin_in_level: continue
+                chunks = bins[bin_]
+                if level < self._n_lvls: chunks.sort()
+                parent = (bin_ - 1) >> 3
+                if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 and parent in bins:
+                    bins[parent].extend(chunks)
+                    del bins[bin_]
+        if 0 in bins: bins[0].sort()
+        for bin_, chunks in bins.items():
+            if bin_ == self._meta_bin: continue
+            merged = [chunks[0]]
+            for start, end in chunks[1:]:
+                if merged[-1][1] >> 16 >= start >> 16: merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else: merged.append((start, end))
+            bins[bin_] = merged
+        return bins
+    def _reg2bin(self, beg:int, end:int) -> int:
+        end -= 1
+        shift, offset = self._min_shift, ((1 << (3 * self._n_lvls + 3)) - 1) // 7
+        for level in range(self._n_lvls, 0, -1):
+            offset -= 1 << (3 * level)
+            if beg >> shift == end >> shift: return offset + (beg >> shift)
+            shift += 3
+        return 0
+
+class TabixIndexWriter:
+    '''
+    Builds a `.tbi` for a BGZF variant file that's written by something else (ie, the c++ in `augment_phenos`), without reading that file.
+    Offsets are like `_BgzfWriter.tell()`: (the index of a block << 16) | (the offset within its uncompressed data), so every block but the last must hold
+    `_BgzfWriter.block_size` bytes.  Once the compressed size of each block has been added, `.get_virtual_offset()` turns them into real virtual offsets.
+    '''
+    def __init__(self, filepath:str, header_end:int):
+        self._indexer = _TabixIndexer(header_end, filepath)
+        self._last_offset = header_end
+        self._block_addresses = [0]  # the offset of each block that has been written, followed by the end of the last one
+    def push(self, chrom:str, pos:int, line_end:int) -> int:
+        '''Adds the next line, which has the variant at `chrom:pos` and ends at `line_end`.  Returns the offset where that line starts.'''
+        self._indexer.push(chrom, pos - 1, pos, line_end)
+        line_start, self._last_offset = self._last_offset, line_end
+        return line_start
+    def add_block_sizes(self, block_sizes:List[int]) -> None:
+        for block_size in block_sizes: self._block_addresses.append(self._block_addresses[-1] + block_size)
+    def get_virtual_offset(self, offset:int) -> int:
+        return (self._block_addresses[offset >> 16] << 16) | (offset & 0xffff)
+    def write(self, tbi_filepath:str) -> None:
+        '''Writes the `.tbi`, after the variant file has been finished and the sizes of all of its blocks have been added'''
+        index = self._indexer.finish(self._last_offset, self.get_virtual_offset)
+        with open(tbi_filepath, 'wb') as f:
+            bgzf_f = _BgzfWriter(f)
+            bgzf_f.write_bytes(index)
+            bgzf_f.close()
+
+def get_tabix_chrom_offsets(filepath:str) -> Dict[str,int]:
+    '''Returns the virtual offset of the first line of each chromosome in the BGZF file `filepath`, from its `.tbi`'''
+    import struct
+    with gzip.open(filepath + '.tbi', 'rb') as f:
+        tbi = f.read()
+    if tbi[:4] != b'TBI\x01': raise PheWebError("{!r} isn't a tabix index".format(filepath + '.tbi'))
+    num_chroms, names_length = struct.unpack_from('<i', tbi, 4)[0], struct.unpack_from('<i', tbi, 32)[0]
+    names = tbi[36:36 + names_length].split(b'\0')[:num_chroms]
+    offset = 36 + names_length
+    ret:Dict[str,int] = {}
+    for name in names:
+        first_offset = None
+        num_bins, = struct.unpack_from('<i', tbi, offset)
+        offset += 4
+        for _ in range(num_bins):
+            bin_, num_chunks = struct.unpack_from('<Ii', tbi, offset)
+            offset += 8
+            if bin_ != _TabixIndexer._meta_bin and num_chunks > 0:
+                chunk_start, = struct.unpack_from('<Q', tbi, offset)  # chunks are sorted, so the first one starts first
+                if first_offset is None or chunk_start < first_offset: first_offset = chunk_start
+            offset += 16 * num_chunks
+        num_windows, = struct.unpack_from('<i', tbi, offset)
+        offset += 4 + 8 * num_windows
+        if first_offset is not None: ret[name.decode()] = first_offset
+    return ret
+
+class _bvfw(_vfw):
+    max_chunk_size = 100_000
+    def __init__(self, f, allow_extra_fields:bool, filepath:str):
+        super().__init__(f, allow_extra_fields, filepath)
+        self.chrom_index:List[List[Any]] = []  # like `_cvfw.chrom_index`, with the offset of each chromosome's first chunk
+    def write(self, variant:Dict[str,Any]) -> None:
+        if not hasattr(self, '_fields'):
+            self._fields:List[str] = [field for field in parse_utils.fields if field in variant]
+            extra_fields = list(set(variant.keys()) - set(self._fields))
+            if extra_fields:
+                if not self._allow_extra_fields:
+                    raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
+                                    extra_fields, self._fields, self._filepath))
+                self._fields += extra_fields
+            self._kinds = [_binary_kind_for_field(field) for field in self._fields]
+            self._write_json({'fields': self._fields, 'kinds': self._kinds}, header=_binary_magic)
+            self._chunk:List[Dict[str,Any]] = []
+        elif not variant.keys() <= set(self._fields):
+            raise ValueError("dict contains fields not in fieldnames: {}".format(', '.join(repr(k) for k in variant.keys() - set(self._fields))))
+        if self._chunk and (len(self._chunk) >= self.max_chunk_size or variant.get('chrom') != self._chunk[0].get('chrom')):
+            self.flush()
+        self._chunk.append(variant)
+    def flush(self) -> None:
+        import numpy as np
+        if not getattr(self, '_chunk', None): return
+        columns, payloads = [], []
+        for field, kind in zip(self._fields, self._kinds):
+            values = [v.get(field, '') for v in self._chunk]
+            is_null = [value == '' or value is None for value in values]
+            column:Dict[str,Any] = {}
+            if kind == 'str':
+                codes:Dict[str,int] = {}
+                values = [codes.setdefault('' if value is None else str(value), len(codes)) for value in values]
+                column['dictionary'] = list(codes)
+                is_null = []
+            elif any(is_null):
+                values = [0 if null else value for value, null in zip(values, is_null)]
+            payload = np.array(values, dtype=_binary_dtype_for_kind[kind]).tobytes()
+            null_payload = np.array(is_null, dtype=np.uint8).tobytes() if any(is_null) else b''
+            column.update(nbytes=len(payload), null_nbytes=len(null_payload))
+            columns.append(column)
+            payloads.extend([payload, null_payload])
+        chrom = self._chunk[0].get('chrom')
+        if not self.chrom_index or chrom != self.chrom_index[-1][0]:
+            self.chrom_index.append([chrom, self._f.tell(), 0])
+        self.chrom_index[-1][2] += len(self._chunk)
+        self._write_json({'num_variants': len(self._chunk), 'columns': columns})
+        for payload in payloads: self._f.write(payload)
+        self._chunk = []
+    def _write_json(self, data:Dict[str,Any], header:bytes = b'') -> None:
+        encoded = json.dumps(data, separators=(',', ':')).encode()
+        self._f.write(header + len(encoded).to_bytes(4, 'little') + encoded)
+
+# `{filepath}.chroms` is JSON like [["1", 1234, 500], ["2", 98765, 400], ...], with the offset of the first line (or binary chunk)
+# of each chromosome in `filepath` and how many variants it has.  It's written after `filepath`, so an index older than its file is stale.
+def get_chrom_index(filepath:str) -> Optional[List[Tuple[str,int,int]]]:
+    '''Returns the chromosome index of `filepath`, or `None` if it doesn't have an up-to-date one'''
+    index_filepath = filepath + '.chroms'
+    if not os.path.exists(index_filepath) or os.stat(index_filepath).st_mtime < os.stat(filepath).st_mtime: return None
+    with open(index_filepath) as f:
+        return [tuple(entry) for entry in json.load(f)]  # type: ignore
+def write_chrom_index(filepath:str, chrom_index:List[List[Any]]) -> None:
+    chroms = [entry[0] for entry in chrom_index]
+    if len(set(chroms)) != len(chroms):
+        raise PheWebError("The chromosomes in {!r} aren't contiguous, so it can't have a chromosome index: {!r}".format(filepath, chroms))
+    write_json(filepath=filepath + '.chroms', data=chrom_index)
+def make_chrom_index(filepath:str) -> None:
+    '''Writes the chromosome index of an existing (uncompressed, text) variant file, by reading the first column of every line'''
+    chrom_index:List[List[Any]] = []
+    with open(filepath, 'rb') as f:
+        offset = len(f.readline())
+        for line in f:
+            chrom = line[:line.index(b'\t')].decode()
+            if not chrom_index or chrom != chrom_index[-1][0]:
+                chrom_index.append([chrom, offset, 0])
+            chrom_index[-1][2] += 1
+            offset += len(line)
+    write_chrom_index(filepath, chrom_index)
+
+def get_cpra_index(filepath:str) -> Optional['_CpraIndex']:
+    '''Returns the cpra index of the BGZF variant file `filepath` (ie, `matrix.tsv.gz`), or `None` if it doesn't have an up-to-date one'''
+    index_filepath = filepath + '.cpra'
+    if not os.path.exists(index_filepath) or os.stat(index_filepath).st_mtime < os.stat(filepath).st_mtime: return None
+    return _CpraIndex(filepath)
+def write_cpra_index(filepath:str, keys:Any, offsets:Any) -> None:
+    import numpy as np
+    with AtomicSaver(filepath + '.cpra', part_file=get_tmp_path(filepath + '.cpra'), overwrite_part=True) as f:
+        np.save(f, np.array([keys, offsets], dtype=np.int64))
+def make_cpra_index(filepath:str) -> None:
+    '''Writes the cpra index of an existing BGZF variant file (or a BGZF fragment of one), by reading the first two columns of every line'''
+    import numpy as np
+    keys, offsets = array.array('q'), array.array('q')
+    def add_line(line:bytes, virtual_offset:int) -> None:
+        if line.startswith(b'#'): return
+        chrom_end = line.index(b'\t')
+        chrom = line[:chrom_end].decode()
+        if chrom not in chrom_order: raise PheWebError("The file {!r} has the unknown chromosome {!r}".format(filepath, chrom))
+        key = chrom_order[chrom] << 32 | int(line[chrom_end+1:line.index(b'\t', chrom_end+1)])
+        if keys and key <= keys[-1]:
+            if key == keys[-1]: return  # only the first line at each position is indexed
+            raise PheWebError("The file {!r} isn't sorted, so it can't have a cpra index (at {!r})".format(filepath, line[:100]))
+        keys.append(key)
+        offsets.append(virtual_offset)
+    with open(filepath, 'rb') as f:
+        partial_line, partial_line_offset = b'', 0
+        for block_offset, data in _read_bgzf_blocks(f, filepath):
+            start = 0
+            if partial_line:
+                end = data.find(b'\n')
+                if end == -1:
+                    partial_line += data
+                    continue
+                add_line(partial_line + data[:end], partial_line_offset)
+                start = end + 1
+            while True:
+                end = data.find(b'\n', start)
+                if end == -1: break
+                add_line(data[start:end], block_offset << 16 | start)
+                start = end + 1
+            if start < len(data): partial_line, partial_line_offset = data[start:], block_offset << 16 | start
+            else: partial_line = b''
+        if partial_line: add_line(partial_line, partial_line_offset)
+    write_cpra_index(filepath, np.frombuffer(keys, dtype=np.int64), np.frombuffer(offsets, dtype=np.int64))
+
+class _CpraIndex:
+    '''
+    Finds variants in `matrix.tsv.gz` with `matrix.tsv.gz.cpra`, which is a memory-mapped numpy array with two rows:
+    the sorted `chrom_idx << 32 | pos` of each position that has variants, and the BGZF virtual offset of the first line at that position.
+    So a lookup is a binary search and then (usually) decompressing one block.
+    '''
+    def __init__(self, filepath:str):
+        import numpy as np
+        self._filepath = filepath
+        self._keys, self._offsets = np.load(filepath + '.cpra', mmap_mode='r')
+    def get_lines(self, chrom:str, pos:int) -> Iterator[str]:
+        '''Yields the lines starting at the first line at `pos` (or nothing, if there's no variant at `pos`)'''
+        import numpy as np
+        if chrom not in chrom_order: return
+        key = chrom_order[chrom] << 32 | pos
+        idx = int(np.searchsorted(self._keys, key))
+        if idx == len(self._keys) or self._keys[idx] != key: return
+        yield from _read_bgzf_lines(self._filepath, int(self._offsets[idx]))
+
+def _read_bgzf_lines(filepath:str, virtual_offset:int) -> Iterator[str]:
+    '''Yields the lines (without `\\n`) of the BGZF file `filepath`, starting at `virtual_offset`'''
+    with open(filepath, 'rb') as f:
+        f.seek(virtual_offset >> 16)
+        partial_line, start = b'', virtual_offset & 0xFFFF
+        for block_offset, data in _read_bgzf_blocks(f, filepath):
+            lines = (partial_line + data[start:]).split(b'\n')
+            partial_line, start = lines.pop(), 0
+            for line in lines: yield line.decode()
+        if partial_line: yield partial_line.decode()
+
+def read_variant_at(filepath:str, fields:List[str], virtual_offset:int) -> Dict[str,Any]:
+    '''Parses the variant on the line at `virtual_offset` in the BGZF variant file `filepath`, which has the fields `fields`'''
+    line = next(_read_bgzf_lines(filepath, virtual_offset), '')
+    values = next(csv.reader([line], dialect='pheweb-internal-dialect'), [])
+    if len(values) != len(fields): raise PheWebError("The line {!r} at virtual offset {} of {!r} doesn't have the fields {!r}".format(line, virtual_offset, filepath, fields))
+    return {field: parse_utils.reader_for_field[field](value) for field, value in zip(fields, values)}
+
+def _read_bgzf_blocks(f:BinaryIO, filepath:str) -> Iterator[Tuple[int,bytes]]:
+    '''Yields the file offset and the decompressed data of each BGZF block, starting at the current position of `f`'''
+    import zlib
+    while True:
+        offset = f.tell()
+        header = f.read(18)
+        if not header: return
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[10:14] != b'\x06\x00BC':
+            raise PheWebError("The file {!r} looks like BGZF but has a block that isn't BGZF at offset {}".format(filepath, offset))
+        block_size = int.from_bytes(header[16:18], 'little') + 1
+        rest = f.read(block_size - 18)
+        try:
+            data = zlib.decompress(rest[:-8], wbits=-15)
+        except zlib.error as exc:
+            raise PheWebError("The file {!r} is corrupt: the BGZF block at offset {} failed to decompress".format(filepath, offset)) from exc
+        yield (offset, data)
+
+def concatenate_variant_files(filepaths:List[str], out_filepath:str) -> None:
+    '''
+    Concatenates text variant files (eg, one per chromosome) that have the same fields, but only writes the header once.
+    If every file has a chromosome index, `out_filepath` gets one too.
+    '''
+    chrom_indexes = [get_chrom_index(filepath) for filepath in filepaths]
+    out_chrom_index:List[List[Any]] = []
+    header:Optional[str] = None
+    with AtomicSaver(out_filepath, text_mode=True, part_file=get_tmp_path(out_filepath), overwrite_part=True, rm_part_on_exc=False) as out_f:
+        for filepath, chrom_index in zip(filepaths, chrom_indexes):
+            with open(filepath) as f:
+                file_header = next(f, None)
+                if file_header is None: continue # this file has no variants
+                if header is None:
+                    header = file_header
+                    out_f.write(header)
+                elif file_header != header:
+                    raise PheWebError("Tried to concatenate files with different fields: {!r} and {!r}".format(header, file_header))
+                if chrom_index is not None:
+                    out_offset = out_f.tell() - len(header.encode())
+                    out_chrom_index.extend([chrom, out_offset + offset, num_variants] for chrom, offset, num_variants in chrom_index)
+                shutil.copyfileobj(f, out_f)
+    if all(chrom_index is not None for chrom_index in chrom_indexes):
+        write_chrom_index(out_filepath, out_chrom_index)
+
 def write_heterogenous_variantfile(filepath:str, assocs:List[Dict[str,Any]], use_gzip:bool = True) -> None:
     '''inject all necessary keys into the first association so that the writer will be made correctly'''
     if len(assocs) == 0:
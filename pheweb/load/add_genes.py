@@ -1,68 +1,67 @@
 
 '''
-This script takes a file with the columns [chrom, pos, ...] (but no headers) and adds the field `gene`.
-'''
+This module finds the nearest genes of each site in `resources/genes-*.bed`.  `annotate_sites` uses it to make `sites.tsv`, and `pheweb add-genes` runs `annotate_sites`.
+`gather_pvalues_for_each_gene` uses it to find the (padded) genes that overlap each variant.
 
-from ..utils import get_gene_tuples
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath
-from .load_utils import mtime
+Sites arrive sorted, so instead of querying an interval tree for each one, `GeneAnnotator` sweeps along each chromosome.
+For each chromosome it keeps numpy arrays of gene starts and gene ends (each sorted), and the set of genes that overlap the position it has swept to.
+Moving forward to a new position adds the genes that started since the last position and removes the ones that ended.
+Positions can go backward (eg, `gather_pvalues_for_each_gene` jumps between regions), but then the set is rebuilt.
+'''
 
-from intervaltree import IntervalTree, Interval
 import bisect
-import os
-import os.path
-import boltons.iterutils
-from typing import List,Tuple,Optional,Dict,Iterator
+from typing import List,Tuple,Optional,Dict,Iterator,Set
 Chrom = str
 GeneName = str
 
 
-class BisectFinder(object):
-    '''Given a list like [(123, 'foo'), (125, 'bar')...], BisectFinder helps you find the things before and after 124.'''
-    def __init__(self, tuples:List[Tuple[int,str]]):
-        '''tuples is like [(123, 'foo'),...]'''
-        tuples = sorted(tuples, key=lambda t:t[0])
-        self._nums, self._values = list(zip(*tuples))
-    def get_item_before(self, pos:int) -> Optional[Tuple[int,str]]:
-        '''If we get an exact match, let's return it'''
-        idx = bisect.bisect_right(self._nums, pos) - 1 # note: bisect_{left,right} just deals with ties.
-        if idx < 0: return None # It's fallen off the beginning!
-        return (self._nums[idx], self._values[idx])
-    def get_item_after(self, pos:int) -> Optional[Tuple[int,str]]:
-        if pos > self._nums[-1]: return None # it's fallen off the end!
-        idx = bisect.bisect_left(self._nums, pos)
-        return (self._nums[idx], self._values[idx])
+class _ChromSweep(object):
+    '''The genes on one chromosome, and the genes that overlap the position that the sweep is at.'''
+    def __init__(self, genes:List[Tuple[int,int,GeneName]]):
+        '''genes is like [(12321, 12345, 'APOL1'), ...]'''
+        import numpy as np
+        starts = np.array([start for start,end,gene_name in genes], dtype=np.int64)
+        ends = np.array([end for start,end,gene_name in genes], dtype=np.int64)
+        self.names = [gene_name for start,end,gene_name in genes]
+        # Stable sorts, so that ties are broken by the order of the genes file.
+        start_order = np.argsort(starts, kind='stable')
+        end_order = np.argsort(ends, kind='stable')
+        self.sorted_starts_array, self.sorted_ends_array = starts[start_order], ends[end_order]
+        self.sorted_starts, self.sorted_ends = self.sorted_starts_array.tolist(), self.sorted_ends_array.tolist()
+        self.start_order, self.end_order = start_order.tolist(), end_order.tolist()
+        self._num_started = 0  # the number of genes with start <= pos
+        self._num_ended = 0  # the number of genes with end <= pos
+        self._active: Set[int] = set()  # the genes with start <= pos < end
+        self._overlapping: Optional[List[GeneName]] = []
 
-class GeneAnnotator(object):
-    def __init__(self, interval_tuples:Iterator[Tuple[Chrom,int,int,GeneName]]):
-        '''interval_tuples is like [('22', 12321, 12345, 'APOL1'), ...]'''
-        self._its: Dict[Chrom,IntervalTree] = {}
-        gene_start_tuples_by_chrom: Dict[Chrom,List[Tuple[int,GeneName]]] = {}
-        gene_end_tuples_by_chrom: Dict[Chrom,List[Tuple[int,GeneName]]] = {}
-        for (chrom, pos_start, pos_end, gene_name) in interval_tuples:
-            if chrom not in self._its:
-                self._its[chrom] = IntervalTree()
-                gene_start_tuples_by_chrom[chrom] = []
-                gene_end_tuples_by_chrom[chrom] = []
-            self._its[chrom].add(Interval(pos_start, pos_end, gene_name))
-            gene_start_tuples_by_chrom[chrom].append((pos_start, gene_name))
-            gene_end_tuples_by_chrom[chrom].append((pos_end, gene_name))
-        self._gene_starts = {chrom:BisectFinder(tuples) for chrom,tuples in gene_start_tuples_by_chrom.items()}
-        self._gene_ends = {chrom:BisectFinder(tuples) for chrom,tuples in gene_end_tuples_by_chrom.items()}
+    def advance(self, num_started:int, num_ended:int) -> None:
+        if num_started == self._num_started and num_ended == self._num_ended: return
+        if num_started < self._num_started or num_ended < self._num_ended:
+            self._active = set(self.start_order[:num_started]).difference(self.end_order[:num_ended])
+        else:
+            self._active.update(self.start_order[self._num_started:num_started])
+            self._active.difference_update(self.end_order[self._num_ended:num_ended])
+        self._num_started, self._num_ended = num_started, num_ended
+        self._overlapping = None
 
-    def annotate_position(self, chrom:str, pos:int) -> str:
-        if chrom == 'MT': chrom = 'M'
-        if chrom not in self._its:
-            return ''
-        overlapping_genes = self._its[chrom].at(pos) if hasattr(self._its[chrom], 'at') else self._its[chrom].search(pos) # support intervaltree 2.x and 3.x
-        if overlapping_genes:
-            return ','.join(sorted(boltons.iterutils.unique_iter(og.data for og in overlapping_genes)))
-        nearest_gene_end = self._gene_ends[chrom].get_item_before(pos)
-        nearest_gene_start = self._gene_starts[chrom].get_item_after(pos)
+    def get_overlapping(self) -> List[GeneName]:
+        '''Returns the sorted, unique names of the genes that overlap the current position'''
+        if self._overlapping is None:
+            self._overlapping = sorted(set(self.names[idx] for idx in self._active))
+        return self._overlapping
+
+    def get_nearest(self, pos:int, num_started:int, num_ended:int) -> str:
+        '''Returns the gene that ends before `pos` or starts after it, whichever is closer'''
+        nearest_gene_end = nearest_gene_start = None
+        if num_ended > 0:
+            nearest_gene_end = (self.sorted_ends[num_ended-1], self.names[self.end_order[num_ended-1]])
+        idx = num_started
+        while idx > 0 and self.sorted_starts[idx-1] == pos: idx -= 1  # genes that start at `pos` count as after it
+        if idx < len(self.sorted_starts):
+            nearest_gene_start = (self.sorted_starts[idx], self.names[self.start_order[idx]])
         if nearest_gene_end is None or nearest_gene_start is None:
             if nearest_gene_end is not None: return nearest_gene_end[1]
             if nearest_gene_start is not None: return nearest_gene_start[1]
-            print('This is very surprising - {!r} {!r}'.format(chrom, pos))
             return ''
         dist_to_nearest_gene_end = abs(nearest_gene_end[0] - pos)
         dist_to_nearest_gene_start = abs(nearest_gene_start[0] - pos)
@@ -71,31 +70,49 @@ class GeneAnnotator(object):
         return nearest_gene_start[1]
 
 
-def annotate_genes(in_filepath:str, out_filepath:str) -> None:
-    '''Both args are filepaths'''
-    ga = GeneAnnotator(get_gene_tuples())
-    with VariantFileWriter(out_filepath) as out_f, \
-         VariantFileReader(in_filepath) as variants:
-        for v in variants:
-            v['nearest_genes'] = ga.annotate_position(v['chrom'], v['pos'])
-            out_f.write(v)
+class GeneAnnotator(object):
+    '''
+    Annotates positions with the genes that overlap them (comma-separated), or else the nearest gene:
 
-def run(argv:List[str]) -> None:
+        ga = GeneAnnotator(get_gene_tuples())
+        ga.annotate_positions('1', [v['pos'] for v in variants_on_chr1])  # -> ['APOL1', 'APOL1,APOL2', ...]
 
-    if '-h' in argv or '--help' in argv:
-        print('Annotate the sites file with nearest genes.  Fetches the relevant version of Gencode if not already present.')
-        exit(1)
+    It's fastest when the positions on each chromosome are sorted.
+    '''
+    def __init__(self, interval_tuples:Iterator[Tuple[Chrom,int,int,GeneName]]):
+        '''interval_tuples is like [('22', 12321, 12345, 'APOL1'), ...]'''
+        genes_by_chrom: Dict[Chrom,List[Tuple[int,int,GeneName]]] = {}
+        for (chrom, pos_start, pos_end, gene_name) in interval_tuples:
+            genes_by_chrom.setdefault(chrom, []).append((pos_start, pos_end, gene_name))
+        self._sweeps = {chrom: _ChromSweep(genes) for chrom, genes in genes_by_chrom.items()}
+
+    def _get_sweep(self, chrom:str) -> Optional[_ChromSweep]:
+        if chrom == 'MT': chrom = 'M'
+        return self._sweeps.get(chrom)
+
+    def annotate_position(self, chrom:str, pos:int) -> str:
+        sweep = self._get_sweep(chrom)
+        if sweep is None: return ''
+        return self._annotate(sweep, pos, bisect.bisect_right(sweep.sorted_starts, pos), bisect.bisect_right(sweep.sorted_ends, pos))
 
-    input_filepath = get_filepath('sites-rsids')
-    genes_filepath = get_filepath('genes', must_exist=False)
-    out_filepath = get_filepath('sites', must_exist=False)
+    def annotate_positions(self, chrom:str, positions:List[int]) -> List[str]:
+        sweep = self._get_sweep(chrom)
+        if sweep is None: return ['' for _ in positions]
+        import numpy as np
+        query = np.array(positions, dtype=np.int64)
+        nums_started = np.searchsorted(sweep.sorted_starts_array, query, side='right').tolist()
+        nums_ended = np.searchsorted(sweep.sorted_ends_array, query, side='right').tolist()
+        return [self._annotate(sweep, pos, num_started, num_ended) for pos, num_started, num_ended in zip(positions, nums_started, nums_ended)]
 
-    if not os.path.exists(genes_filepath):
-        print('Fetching genes...')
-        from . import download_genes
-        download_genes.run([])
+    def _annotate(self, sweep:_ChromSweep, pos:int, num_started:int, num_ended:int) -> str:
+        if num_started == num_ended:  # no gene overlaps `pos`, so the sweep can skip it
+            return sweep.get_nearest(pos, num_started, num_ended)
+        sweep.advance(num_started, num_ended)
+        return ','.join(sweep.get_overlapping())
 
-    if os.path.exists(out_filepath) and max(mtime(genes_filepath), mtime(input_filepath)) <= mtime(out_filepath):
-        print('gene annotation is up-to-date!')
-    else:
-        annotate_genes(input_filepath, out_filepath)
+    def get_overlapping_genes(self, chrom:str, pos:int) -> List[GeneName]:
+        '''Returns the sorted, unique names of the genes that overlap `pos`'''
+        sweep = self._get_sweep(chrom)
+        if sweep is None: return []
+        sweep.advance(bisect.bisect_right(sweep.sorted_starts, pos), bisect.bisect_right(sweep.sorted_ends, pos))
+        return sweep.get_overlapping()
@@ -1,10 +1,13 @@
 
 
 '''
-This script annotates `sites/sites-unannotated.tsv` with rsids (comma-separated) from `resources/rsids-*.tsv.gz`.  It prints output to `sites-rsids.tsv`.
+This module finds the rsids (comma-separated) of sites in `resources/rsids-*.tsv.gz`.  `annotate_sites` uses it to make `sites.tsv`, and `pheweb add-rsids` runs `annotate_sites`.
 
 It relies on both being ordered like [1-22,X,Y,MT] and having positions sorted.
 
+The first time `annotate_sites` runs (or whenever the rsids file changes), it converts the rsids file into `resources/rsids-*-index/` (see `make_rsids_index`).
+After that, it looks up the rsids for a batch of sites at a time with `numpy.searchsorted()` on the memory-mapped index.
+
 Notes:
 
 `sites/sites-unannotated.tsv` can have multi-allelic positions.
@@ -12,7 +15,7 @@ Notes:
 
 In `resources/rsids-*.tsv.gz`, sometimes `alt` contains `N`, which matches any nucleotide I think.
 
-We read one full position at a time.  When we have a position-match, we find all rsids that match a variant.
+We find all the rsids at the position of each variant, and then the ones that match the variant.
 '''
 
 # TODO: do we need to left-normalize all indels?
@@ -20,11 +23,8 @@ We read one full position at a time.  When we have a position-match, we find all
 
 
 from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, read_maybe_gzip
-from .. import conf
-from .load_utils import mtime
+from .make_rsids_index import RsidsIndex
 
-import os
 import itertools
 from typing import Iterator,Dict,Any,List
 
@@ -88,62 +88,16 @@ def are_match(seq1:str, seq2:str) -> bool:
     return False
 
 
-def run(argv:List[str]) -> None:
-
-    if '-h' in argv or '--help' in argv:
-        print('Annotate the sites file with rsids. Download the relevant version of dbSNP if not already present.')
-        exit(1)
-
-    in_filepath = get_filepath('unanno')
-    out_filepath = get_filepath('sites-rsids', must_exist=False)
-    rsids_filepath = get_filepath('rsids', must_exist=False)
-
-    if not os.path.exists(rsids_filepath):
-        print('Fetching rsids...')
-        from . import download_rsids
-        download_rsids.run([])
-
-    if os.path.exists(out_filepath) and max(mtime(in_filepath), mtime(rsids_filepath)) <= mtime(out_filepath):
-        print('rsid annotation is up-to-date!')
-        return
+def annotate_rsids(rsids_index:RsidsIndex, variants:List[Dict[str,Any]]) -> None:
+    '''Sets `rsids` on each of `variants`, which must all be on the same chromosome'''
+    for cpra, candidates in zip(variants, rsids_index.get_candidates(variants[0]['chrom'], [cpra['pos'] for cpra in variants])):
+        cpra['rsids'] = ','.join(rsid for ref, alt, rsid in candidates if cpra['ref'] == ref and are_match(cpra['alt'], alt))
 
-    with VariantFileReader(in_filepath) as in_reader, \
-         read_maybe_gzip(rsids_filepath) as rsids_f, \
-         VariantFileWriter(out_filepath) as writer:
 
-        rsid_group_reader = get_one_chr_pos_at_a_time(get_rsid_reader(rsids_f, rsids_filepath))
-        cp_group_reader = get_one_chr_pos_at_a_time(in_reader)
-
-        debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
-        if debugging_limit_num_variants: rsid_group_reader = itertools.islice(rsid_group_reader, 0, debugging_limit_num_variants)
-
-        rsid_group = next(rsid_group_reader)
-        for cp_group in cp_group_reader:
-
-            # Advance rsid_group until it is up to/past cp_group
-            while True:
-                if rsid_group[0]['chrom'] == cp_group[0]['chrom']:
-                    rsid_is_not_behind = rsid_group[0]['pos'] >= cp_group[0]['pos']
-                else:
-                    rsid_is_not_behind = chrom_order[rsid_group[0]['chrom']] >= chrom_order[cp_group[0]['chrom']]
-                if rsid_is_not_behind:
-                    break
-                else:
-                    try:
-                        rsid_group = next(rsid_group_reader)
-                    except StopIteration:
-                        break
-
-            if rsid_group[0]['chrom'] == cp_group[0]['chrom'] and rsid_group[0]['pos'] == cp_group[0]['pos']:
-                # we have rsids at this position!  will they match on ref/alt?
-                for cpra in cp_group:
-                    rsids = [rsid['rsid'] for rsid in rsid_group if cpra['ref'] == rsid['ref'] and are_match(cpra['alt'], rsid['alt'])]
-                    # if len(rsids) > 1:
-                    #     print('WARNING: the variant {chrom}-{pos}-{ref}-{alt} has multiple rsids: {rsids}'.format(**cpra, rsids=rsids))
-                    cpra['rsids'] = ','.join(rsids)
-                    writer.write(cpra)
-            else:
-                # No match, just print each cpra with an empty `rsids` column
-                for cpra in cp_group:
-                    cpra['rsids'] = ''
-                    writer.write(cpra)
+def get_batches_by_chrom(variants:Iterator[Dict[str,Any]], batch_size:int) -> Iterator[List[Dict[str,Any]]]:
+    '''Yields lists of up to `batch_size` consecutive variants that are all on the same chromosome'''
+    for chrom, chrom_variants in itertools.groupby(variants, key=lambda v: v['chrom']):
+        while True:
+            batch = list(itertools.islice(chrom_variants, batch_size))
+            if not batch: break
+            yield batch
@@ -0,0 +1,148 @@
+
+'''
+This script reads `sites/sites-unannotated.tsv` once and writes `sites/sites.tsv` with these fields added to each site:
+  - `rsids`, from `resources/rsids-*.tsv.gz` (see `add_rsids`)
+  - `nearest_genes`, from `resources/genes-*.bed` (see `add_genes`)
+  - `consequence`, only if `vep_consequences_file` is set in `config.py`, from the output of VEP (see `etc/annotate_vep/run.sh`)
+
+Each chromosome is annotated in a separate process (seeking to it with the chromosome index of `sites-unannotated.tsv`), and then they are concatenated.
+`pheweb add-rsids` and `pheweb add-genes` are aliases for this step.
+
+VEP writes one row per variant (with `--most_severe`) in the order of its input, which was made from `sites.tsv`.
+Its output gets copied to `sites/vep-consequences.tsv` (with a chromosome index) so that each process can seek to its chromosome.
+Sites that aren't in the VEP output (eg, because phenotypes were added after VEP was run) get an empty `consequence`.
+'''
+
+from .. import conf
+from ..utils import chrom_order, get_gene_tuples, PheWebError
+from ..file_utils import VariantFileReader, VariantFileWriter, read_maybe_gzip, get_filepath, get_tmp_path, get_chrom_index, make_chrom_index, concatenate_variant_files
+from .load_utils import mtime, Parallelizer
+from .make_rsids_index import RsidsIndex, is_rsids_index_up_to_date, make_rsids_index
+from .add_rsids import annotate_rsids, get_batches_by_chrom
+from .add_genes import GeneAnnotator
+
+import os
+import csv
+import contextlib
+from typing import List,Dict,Any,Iterator,Optional
+
+
+def run(argv:List[str]) -> None:
+
+    if '-h' in argv or '--help' in argv:
+        print('Annotate the sites file with rsids, nearest genes, and (optionally) VEP consequences.  Download the relevant versions of dbSNP and Gencode if not already present.')
+        exit(1)
+
+    in_filepath = get_filepath('unanno')
+    out_filepath = get_filepath('sites', must_exist=False)
+    rsids_filepath = get_filepath('rsids', must_exist=False)
+    genes_filepath = get_filepath('genes', must_exist=False)
+    vep_filepath = conf.get_vep_consequences_filepath()
+
+    if not os.path.exists(rsids_filepath):
+        print('Fetching rsids...')
+        from . import download_rsids
+        download_rsids.run([])
+    if not os.path.exists(genes_filepath):
+        print('Fetching genes...')
+        from . import download_genes
+        download_genes.run([])
+    if vep_filepath is not None and not os.path.exists(vep_filepath):
+        raise PheWebError('vep_consequences_file is set to {!r}, but that file doesn\'t exist.'.format(vep_filepath))
+
+    if is_up_to_date(out_filepath, [in_filepath, rsids_filepath, genes_filepath], vep_filepath):
+        print('site annotation is up-to-date!')
+        return
+
+    rsids_index_dirpath = get_filepath('rsids-index', must_exist=False)
+    if not is_rsids_index_up_to_date(rsids_filepath, rsids_index_dirpath):
+        make_rsids_index(rsids_filepath, rsids_index_dirpath)
+
+    vep_consequences_filepath = None
+    if vep_filepath is not None:
+        vep_consequences_filepath = get_filepath('vep-consequences', must_exist=False)
+        if not os.path.exists(vep_consequences_filepath) or mtime(vep_filepath) > mtime(vep_consequences_filepath):
+            make_vep_consequences_file(vep_filepath, vep_consequences_filepath)
+
+    chrom_index = get_chrom_index(in_filepath)
+    if chrom_index is None:
+        make_chrom_index(in_filepath)  # `sites-unannotated.tsv` was made by an old version of PheWeb
+        chrom_index = get_chrom_index(in_filepath)
+        assert chrom_index is not None
+    tasks:List[Dict[str,Any]] = [{'chrom': chrom, 'in_filepath': in_filepath, 'rsids_index_dirpath': rsids_index_dirpath, 'vep_consequences_filepath': vep_consequences_filepath,
+                                  'out_filepath': get_tmp_path('sites-chrom-{}'.format(chrom))}
+                                 for chrom, offset, num_variants in sorted(chrom_index, key=lambda entry: -entry[2])]  # start the biggest chromosomes first
+    for ret in Parallelizer().run_single_tasks(tasks, annotate_chrom, cmd='annotate-sites'): pass
+    concatenate_variant_files([task['out_filepath'] for task in sorted(tasks, key=lambda task: chrom_order[task['chrom']])], out_filepath)
+    for task in tasks:
+        os.remove(task['out_filepath'])
+        os.remove(task['out_filepath'] + '.chroms')
+
+
+def is_up_to_date(out_filepath:str, in_filepaths:List[str], vep_filepath:Optional[str]) -> bool:
+    if not os.path.exists(out_filepath): return False
+    if vep_filepath is not None: in_filepaths = in_filepaths + [vep_filepath]
+    if max(mtime(filepath) for filepath in in_filepaths) > mtime(out_filepath): return False
+    with VariantFileReader(out_filepath) as reader:
+        return ('consequence' in reader.fields) == (vep_filepath is not None)  # `vep_consequences_file` was set or unset
+
+
+def annotate_chrom(task:Dict[str,Any]) -> None:
+    rsids_index = RsidsIndex(task['rsids_index_dirpath'])
+    gene_annotator = GeneAnnotator(get_gene_tuples())
+    with contextlib.ExitStack() as stack:
+        in_reader = stack.enter_context(VariantFileReader(task['in_filepath'], chrom=task['chrom']))
+        writer = stack.enter_context(VariantFileWriter(task['out_filepath'], chrom_index=True))
+        consequence_annotator = None
+        if task['vep_consequences_filepath'] is not None:
+            consequence_annotator = ConsequenceAnnotator(iter(stack.enter_context(VariantFileReader(task['vep_consequences_filepath'], chrom=task['chrom']))))
+        for batch in get_batches_by_chrom(in_reader, batch_size=100_000):
+            annotate_rsids(rsids_index, batch)
+            for v, nearest_genes in zip(batch, gene_annotator.annotate_positions(batch[0]['chrom'], [v['pos'] for v in batch])):
+                v['nearest_genes'] = nearest_genes
+                if consequence_annotator is not None:
+                    v['consequence'] = consequence_annotator.annotate_variant(v)
+                writer.write(v)
+
+
+class ConsequenceAnnotator:
+    '''Finds the consequence of each variant in `vep_variants`, which must be sorted like the variants that get annotated (and on the same chromosome).'''
+    def __init__(self, vep_variants:Iterator[Dict[str,Any]]):
+        self._vep_variants = vep_variants
+        self._vep_v = next(vep_variants, None)
+    def annotate_variant(self, v:Dict[str,Any]) -> str:
+        key = (v['pos'], v['ref'], v['alt'])
+        while self._vep_v is not None and (self._vep_v['pos'], self._vep_v['ref'], self._vep_v['alt']) < key:
+            self._vep_v = next(self._vep_variants, None)
+        if self._vep_v is not None and (self._vep_v['pos'], self._vep_v['ref'], self._vep_v['alt']) == key:
+            return self._vep_v['consequence']
+        return ''
+
+
+def get_vep_reader(vep_f:Iterator[str], vep_filepath:str) -> Iterator[Dict[str,Any]]:
+    reader = csv.DictReader((line.lstrip('#') for line in vep_f if not line.startswith('##')), delimiter='\t')
+    missing_cols = {'Uploaded_variation', 'Consequence'} - set(reader.fieldnames or [])
+    if missing_cols:
+        raise PheWebError('The VEP output {!r} is missing the columns {!r}'.format(vep_filepath, sorted(missing_cols)))
+    for row in reader:
+        try:
+            chrom, pos, ref, alt = row['Uploaded_variation'].split(':')
+            int_pos = int(pos)
+        except ValueError:
+            raise PheWebError('In the VEP output {!r}, Uploaded_variation should look like "chrom:pos:ref:alt", but it is {!r}'.format(vep_filepath, row['Uploaded_variation']))
+        yield {'chrom': chrom, 'pos': int_pos, 'ref': ref, 'alt': alt, 'consequence': row['Consequence']}
+
+def make_vep_consequences_file(vep_filepath:str, out_filepath:str) -> None:
+    print('Reading VEP consequences from {}'.format(vep_filepath))
+    prev_key, prev_v = None, None
+    with read_maybe_gzip(vep_filepath) as vep_f, \
+         VariantFileWriter(out_filepath, chrom_index=True) as writer:
+        for v in get_vep_reader(vep_f, vep_filepath):
+            if v['chrom'] not in chrom_order:
+                raise PheWebError('The VEP output {!r} contains the unknown chromosome {!r}'.format(vep_filepath, v['chrom']))
+            key = (chrom_order[v['chrom']], v['pos'], v['ref'], v['alt'])
+            if prev_key is not None and key <= prev_key:
+                raise PheWebError(('The VEP output {!r} has {!r} after {!r}.  It should have one row per variant (so run VEP with `--most_severe`) ' +
+                                   'in the same order as sites.tsv.').format(vep_filepath, v, prev_v))
+            prev_key, prev_v = key, v
+            writer.write(v)
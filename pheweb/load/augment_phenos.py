@@ -1,21 +1,34 @@
 from ..utils import PheWebError
+from .. import conf
+from .. import parse_utils
 from ..file_utils import (
     VariantFileReader,
     VariantFileWriter,
     get_filepath,
     get_pheno_filepath,
-    with_chrom_idx,
+    get_augmented_pheno_filepath,
     get_tmp_path,
-    convert_VariantFile_to_IndexedVariantFile,
+    make_basedir,
+    is_binary_variant_file,
+    write_json,
+    with_chrom_idx,
+    read_variant_at,
+    TabixIndexWriter,
 )
-from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist
+from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist, mtime
+from .manhattan import Binner
+from .qq import QQAccumulator
+from .best_of_pheno import BestOfPheno
 
-import argparse, os
-from typing import List,Dict,Any
+import os
+import argparse
+import functools
+from contextlib import ExitStack
+from typing import List,Dict,Any,Optional,Callable,Iterator
 
 
 def run(argv:List[str]) -> None:
-    parser = argparse.ArgumentParser(description="annotate each phenotype by pulling in information from the combined sites file")
+    parser = argparse.ArgumentParser(description="annotate each phenotype by pulling in information from the combined sites file, and make its manhattan and qq plots (and best-of-pheno file, if `show_manhattan_filter_button` is set)")
     parser.add_argument('--phenos', help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)")
     args = parser.parse_args(argv)
 
@@ -35,22 +48,105 @@ def get_input_filepaths(pheno:dict) -> List[str]:
         get_filepath('sites'),
     ]
 def get_output_filepaths(pheno:dict) -> List[str]:
-    return [
+    return get_augmented_filepaths(pheno) + get_summary_filepaths(pheno)
+def get_augmented_filepaths(pheno:dict) -> List[str]:
+    filepaths = [
         get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False),
         get_pheno_filepath('pheno_gz_tbi', pheno['phenocode'], must_exist=False),
     ]
+    if conf.should_use_binary_variant_files():
+        filepaths.append(get_pheno_filepath('pheno_bin', pheno['phenocode'], must_exist=False))
+    return filepaths
+def get_summary_filepaths(pheno:dict) -> List[str]:
+    filepaths = [
+        get_pheno_filepath('manhattan', pheno['phenocode'], must_exist=False),
+        get_pheno_filepath('qq', pheno['phenocode'], must_exist=False),
+    ]
+    if conf.should_show_manhattan_filter_button():
+        filepaths.append(get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False))
+    return filepaths
 
 def convert(pheno:Dict[str,Any]) -> None:
 
     parsed_filepath = get_pheno_filepath('parsed', pheno['phenocode'])
     sites_filepath = get_filepath('sites')
     out_filepath = get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False)
-    out_unzipped_filepath = get_tmp_path(out_filepath)
 
+    if are_augmented_files_up_to_date(pheno):
+        # Only the manhattan, qq, or best-of-pheno files need to be made (eg, because `show_manhattan_filter_button` was just set).
+        summarize_augmented_pheno(pheno)
+        return
+    if not conf.should_use_binary_variant_files():
+        sites_fields, pheno_fields = _read_header(sites_filepath), _read_header(parsed_filepath)
+        fields = get_joined_fields(sites_fields, pheno_fields)
+        if fields is not None:
+            assert pheno_fields is not None
+            join_lines(pheno, sites_filepath, parsed_filepath, out_filepath, fields, pheno_fields[4:], summarize=True)
+            return
+    summarizer = PhenoSummarizer(pheno, get_full_variant=_copy_variant)
+    convert_variants(pheno, sites_filepath, parsed_filepath, out_filepath, process_variant=summarizer.process_variant)
+    summarizer.write_files()
+
+def are_augmented_files_up_to_date(pheno:Dict[str,Any]) -> bool:
+    input_mtime = max(mtime(filepath) for filepath in get_input_filepaths(pheno))
+    return all(os.path.exists(filepath) and mtime(filepath) >= input_mtime for filepath in get_augmented_filepaths(pheno))
+
+
+class PhenoSummarizer:
+    '''
+    Makes the manhattan, qq, and (if `show_manhattan_filter_button` is set) best-of-pheno files of a phenotype from one pass over its variants.
+    If variants only have `PhenoSummarizer.columns`, then `get_full_variant` gets all of their fields for the ones that end up in those files.
+    '''
+    columns = sorted(set(Binner.columns + QQAccumulator.columns + BestOfPheno.columns))
+
+    def __init__(self, pheno:Dict[str,Any], get_full_variant:Optional[Callable[[Dict[str,Any]],Dict[str,Any]]] = None):
+        self._pheno = pheno
+        self._binner = Binner(get_full_variant=get_full_variant)
+        self._qq_accumulator = QQAccumulator(pheno)
+        self._best_of_pheno = BestOfPheno(get_full_variant=get_full_variant) if conf.should_show_manhattan_filter_button() else None
+
+    def process_variant(self, variant:Dict[str,Any]) -> None:
+        self._binner.process_variant(variant)
+        self._qq_accumulator.process_variant(variant)
+        if self._best_of_pheno is not None: self._best_of_pheno.process_variant(variant)
 
-    with VariantFileReader(sites_filepath) as sites_reader, \
-         VariantFileReader(parsed_filepath) as pheno_reader, \
-         VariantFileWriter(out_unzipped_filepath, use_gzip=False) as writer:
+    def write_files(self) -> None:
+        if not self._qq_accumulator: raise PheWebError("It appears that the phenotype {!r} has no variants.".format(self._pheno['phenocode']))
+        write_json(filepath=get_pheno_filepath('manhattan', self._pheno['phenocode'], must_exist=False), data=self._binner.get_result())
+        write_json(filepath=get_pheno_filepath('qq', self._pheno['phenocode'], must_exist=False), data=self._qq_accumulator.get_result())
+        if self._best_of_pheno is not None:
+            with VariantFileWriter(get_pheno_filepath('best_of_pheno', self._pheno['phenocode'], must_exist=False)) as writer:
+                writer.write_all(self._best_of_pheno.get_result())
+
+def _copy_variant(variant:Dict[str,Any]) -> Dict[str,Any]:
+    '''Copies a variant (which might be a variant record, which can't be written as json) into a dict with its fields in the same order as `pheno_gz/*`'''
+    rest = dict(variant)
+    copy = {field: rest.pop(field) for field in parse_utils.fields if field in rest}
+    copy.update(rest)  # keys like `peak` that `Binner` adds
+    return copy
+
+def summarize_augmented_pheno(pheno:Dict[str,Any]) -> None:
+    with VariantFileReader(get_augmented_pheno_filepath(pheno['phenocode']), columns=PhenoSummarizer.columns) as variants:
+        summarizer = PhenoSummarizer(pheno, get_full_variant=variants.get_full_variant)
+        for variant in variants:
+            summarizer.process_variant(variant)
+        summarizer.write_files()  # `get_full_variant()` might need to read from the file
+
+
+def convert_variants(pheno:Dict[str,Any], sites_filepath:str, parsed_filepath:str, out_filepath:str,
+                     process_variant:Optional[Callable[[Dict[str,Any]],None]] = None) -> None:
+    '''
+    Joins the variants of `sites_filepath` and `parsed_filepath` after parsing them, which works for any kind of files.
+    Each variant that gets written is also passed to `process_variant`.
+    '''
+    records = conf.should_use_variant_records()
+    with VariantFileReader(sites_filepath, records=records) as sites_reader, \
+         VariantFileReader(parsed_filepath, records=records) as pheno_reader, \
+         VariantFileWriter(out_filepath, indexed=True) as writer, \
+         ExitStack() as exit_stack:
+        binary_writer = None
+        if conf.should_use_binary_variant_files():
+            binary_writer = exit_stack.enter_context(VariantFileWriter(get_pheno_filepath('pheno_bin', pheno['phenocode'], must_exist=False), binary=True))
         sites_variants = with_chrom_idx(iter(sites_reader))
         pheno_variants = with_chrom_idx(iter(pheno_reader))
 
@@ -59,6 +155,8 @@ def convert(pheno:Dict[str,Any]) -> None:
             pheno_variant.update(sites_variant)
             del pheno_variant['chrom_idx']
             writer.write(pheno_variant)
+            if binary_writer is not None: binary_writer.write(pheno_variant)
+            if process_variant is not None: process_variant(pheno_variant)
 
         try: pheno_variant = next(pheno_variants)
         except StopIteration: raise PheWebError("It appears that the phenotype {!r} has no variants.".format(pheno['phenocode']))
@@ -78,8 +176,121 @@ def convert(pheno:Dict[str,Any]) -> None:
                 try: sites_variant = next(sites_variants)
                 except StopIteration: raise PheWebError("The sites file ({}) ran out of variants while {} still had {}".format(sites_filepath, parsed_filepath, pheno_variant))
 
-    convert_VariantFile_to_IndexedVariantFile(out_unzipped_filepath, out_filepath)
-    os.unlink(out_unzipped_filepath)
+
+def _read_header(filepath:str) -> Optional[List[str]]:
+    '''Returns the fields of an uncompressed text variant file, or None for any other kind of file'''
+    if is_binary_variant_file(filepath): return None
+    with open(filepath, 'rb') as f:
+        line = f.readline()
+    if line.startswith(b'\x1f\x8b') or not line.endswith(b'\n'): return None  # gzipped or empty
+    return line.decode().rstrip('\n').lstrip('#').split('\t')
+
+def get_joined_fields(sites_fields:Optional[List[str]], pheno_fields:Optional[List[str]]) -> Optional[List[str]]:
+    '''
+    If each line of `pheno_gz/*` can be the line from `sites.tsv` plus the line from `parsed/*` without its chrom/pos/ref/alt,
+    returns the fields of `pheno_gz/*`.  That's the usual case, when `parsed/*` has no per-variant fields besides chrom/pos/ref/alt.
+    '''
+    cpra_fields = ['chrom', 'pos', 'ref', 'alt']
+    if sites_fields is None or pheno_fields is None: return None
+    if sites_fields[:4] != cpra_fields or pheno_fields[:4] != cpra_fields or len(sites_fields) == 4 or len(pheno_fields) == 4: return None
+    fields = sites_fields + pheno_fields[4:]
+    # These are the fields (and their order) that `VariantFileWriter` would use.
+    if [field for field in parse_utils.fields if field in fields] != fields: return None
+    return fields
+
+def join_lines(pheno:Dict[str,Any], sites_filepath:str, parsed_filepath:str, out_filepath:str, fields:List[str], assoc_fields:List[str],
+               summarize:bool = False) -> None:
+    '''
+    Joins `sites_filepath` and `parsed_filepath` in c++ without parsing or re-serializing any fields besides chrom/pos/ref/alt.
+    Each line written is the line from `sites_filepath` plus the rest of the line from `parsed_filepath` (which has the fields `assoc_fields`).
+    The c++ reports where each line ends, so `{out_filepath}.tbi` is built while the lines are written, from the chrom and pos in `parsed_filepath`.
+    If `summarize`, the manhattan, qq, and best-of-pheno files are made the same way, from `PhenoSummarizer.columns` of `parsed_filepath`
+    (which has the same variants and values), and only the variants that end up in them are read back from `out_filepath`.
+    '''
+    ffi, lib = _get_cffi_x()
+    float_columns = ''.join('1' if parse_utils.fields[field]['type'] is float else '0' for field in assoc_fields)
+    tmp_filepath = get_tmp_path(out_filepath)
+    make_basedir(out_filepath)
+    with VariantFileReader(parsed_filepath, columns=PhenoSummarizer.columns if summarize else ['chrom', 'pos']) as variants:
+        joined_lines = _JoinedLines(out_filepath, fields, iter(variants))
+        summarizer = PhenoSummarizer(pheno, get_full_variant=joined_lines.get_full_variant) if summarize else None
+        if summarizer is not None: joined_lines.process_variant = summarizer.process_variant
+        handle = ffi.new_handle(joined_lines)  # `joined_lines` must stay alive while the c++ calls back with this
+        # we don't need `ffi.new('char[]', ...)` because args are `const`
+        ret = lib.cffi_augment_pheno(sites_filepath.encode('utf8'),
+                                     parsed_filepath.encode('utf8'),
+                                     tmp_filepath.encode('utf8'),
+                                     '\t'.join(fields).encode('utf8'),
+                                     float_columns.encode('utf8'),
+                                     conf.get_bgzf_compression_threads(),
+                                     conf.get_bgzf_compression_level(),
+                                     lib.augment_pheno_on_written,
+                                     handle)
+        ret_bytes = ffi.string(ret, maxlen=1000)
+        try:
+            if joined_lines.exception is not None: raise joined_lines.exception
+            if ret_bytes != b'ok':
+                raise PheWebError('The portion of `pheweb augment-phenos` written in c++/cffi failed for the phenotype {!r} with the message {!r}'.format(pheno['phenocode'], ret_bytes))
+            joined_lines.finish(tmp_filepath + '.tbi')
+        except BaseException:
+            for filepath in [tmp_filepath, tmp_filepath + '.tbi']:
+                if os.path.exists(filepath): os.remove(filepath)
+            raise
+    os.replace(tmp_filepath, out_filepath)
+    os.replace(tmp_filepath + '.tbi', out_filepath + '.tbi')  # the index stays newer than the data, because it was made after it
+    if summarizer is not None: summarizer.write_files()  # `get_full_variant()` reads from `out_filepath`
+
+class _JoinedLines:
+    '''
+    Follows along while `cffi_augment_pheno` writes a pheno, using the variants of its parsed file, which are in the same order as the lines written.
+    Each line is added to a tabix index, and each variant is passed to `process_variant`, remembering where its line starts for `get_full_variant()`.
+    '''
+    def __init__(self, out_filepath:str, fields:List[str], variants:Iterator[Dict[str,Any]]):
+        self._out_filepath = out_filepath
+        self._fields = fields
+        self._variants = variants
+        self._index_writer:Optional[TabixIndexWriter] = None
+        self.process_variant:Optional[Callable[[Dict[str,Any]],None]] = None
+        self.exception:Optional[BaseException] = None  # exceptions can't be raised through c++, so `join_lines()` raises this instead
+    def on_written(self, line_ends:List[int], block_sizes:List[int]) -> None:
+        if self._index_writer is None:
+            self._index_writer = TabixIndexWriter(self._out_filepath, line_ends[0])  # the first offset is the end of the header
+            line_ends = line_ends[1:]
+        self._index_writer.add_block_sizes(block_sizes)
+        for line_end in line_ends:
+            try: variant = next(self._variants)
+            except StopIteration: raise PheWebError("{!r} got more lines than its parsed file has variants".format(self._out_filepath)) from None
+            line_start = self._index_writer.push(variant['chrom'], variant['pos'], line_end)
+            if self.process_variant is not None:
+                variant._source = line_start  # type: ignore
+                self.process_variant(variant)
+    def finish(self, tbi_filepath:str) -> None:
+        if next(self._variants, None) is not None: raise PheWebError("{!r} got fewer lines than its parsed file has variants".format(self._out_filepath))
+        assert self._index_writer is not None
+        self._index_writer.write(tbi_filepath)
+    def get_full_variant(self, variant:Dict[str,Any]) -> Dict[str,Any]:
+        '''Reads all of the fields of `variant` from `out_filepath`, after it's been written'''
+        assert self._index_writer is not None
+        full_variant = read_variant_at(self._out_filepath, self._fields, self._index_writer.get_virtual_offset(variant._source))  # type: ignore
+        full_variant.update(variant)  # keep anything that the caller added
+        return full_variant
+
+@functools.lru_cache(None)
+def _get_cffi_x() -> Any:
+    '''Imports the c++ code and registers `augment_pheno_on_written()`, which it calls while it writes'''
+    from .cffi._x import ffi, lib
+    @ffi.def_extern()
+    def augment_pheno_on_written(arg, line_ends, num_line_ends, block_sizes, num_block_sizes):
+        joined_lines = ffi.from_handle(arg)
+        try:
+            # an empty `std::vector` might pass NULL, which `ffi.unpack()` refuses
+            joined_lines.on_written(ffi.unpack(line_ends, num_line_ends) if num_line_ends else [],
+                                    ffi.unpack(block_sizes, num_block_sizes) if num_block_sizes else [])
+        except BaseException as exc:
+            joined_lines.exception = exc
+            return 1
+        return 0
+    return (ffi, lib)
 
 
 def _which_variant_is_bigger(v1:Dict[str,Any], v2:Dict[str,Any]) -> int:
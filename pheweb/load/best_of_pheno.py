@@ -2,12 +2,14 @@
 This script creates generated-by-pheweb/best-of-pheno/<pheno> which contains the strongest 100k associations for the phenotype.
 '''
 
-from ..file_utils import VariantFileReader, VariantFileWriter, get_pheno_filepath
+from ..file_utils import VariantFileReader, VariantFileWriter, get_pheno_filepath, get_augmented_pheno_filepath
 from ..utils import chrom_order
+from .. import parse_utils
 from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist
 
 import argparse
-from typing import List,Dict,Any
+import math
+from typing import List,Dict,Any,Optional,Callable
 
 
 NUM_VARIANTS = 100_000
@@ -20,7 +22,7 @@ def run(argv:List[str]) -> None:
     phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
 
     parallelize_per_pheno(
-        get_input_filepaths = lambda pheno: get_pheno_filepath('pheno_gz', pheno['phenocode']),
+        get_input_filepaths = lambda pheno: get_augmented_pheno_filepath(pheno['phenocode']),
         get_output_filepaths = lambda pheno: get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False),
         convert = make_bestof_file,
         cmd = 'best_of_pheno',
@@ -29,14 +31,39 @@ def run(argv:List[str]) -> None:
 
 
 def make_bestof_file(pheno:Dict[str,Any]) -> None:
-    make_bestof_file_explicit(get_pheno_filepath('pheno_gz', pheno['phenocode']),
+    make_bestof_file_explicit(get_augmented_pheno_filepath(pheno['phenocode']),
                               get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False))
 
 def make_bestof_file_explicit(in_filepath:str, out_filepath:str) -> None:
-    q = MaxPriorityQueue()
-    with VariantFileReader(in_filepath) as vfr:
+    with VariantFileReader(in_filepath, columns=BestOfPheno.columns) as vfr:
+        best_of_pheno = BestOfPheno(get_full_variant=vfr.get_full_variant)
         for v in vfr:
-            q.add_and_keep_size(v, v['pval'], NUM_VARIANTS)
-    assocs = list(q.pop_all())
-    assocs.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))
+            best_of_pheno.process_variant(v)
+        assocs = best_of_pheno.get_result()
     with VariantFileWriter(out_filepath) as vfw: vfw.write_all(assocs)
+
+
+class BestOfPheno:
+    '''
+    Keeps the strongest `NUM_VARIANTS` associations of a phenotype.
+    If variants only have `BestOfPheno.columns`, then `get_full_variant` gets all of their fields for the ones that are kept.
+    '''
+    columns = ['chrom', 'pos', 'pval']  # the fields that BestOfPheno needs from every variant
+
+    def __init__(self, get_full_variant:Optional[Callable[[Dict[str,Any]],Dict[str,Any]]] = None):
+        self._get_full_variant = get_full_variant
+        self._q = MaxPriorityQueue()
+        self._weakest_pval = math.inf  # the largest pval in `self._q`, once it's full
+
+    def process_variant(self, variant:Dict[str,Any]) -> None:
+        if variant['pval'] >= self._weakest_pval: return  # `add_and_keep_size()` would drop it
+        self._q.add_and_keep_size(variant, variant['pval'], NUM_VARIANTS)
+        if len(self._q) >= NUM_VARIANTS: self._weakest_pval = self._q.peek_priority()
+
+    def get_result(self) -> List[Dict[str,Any]]:
+        assocs = list(self._q.pop_all())
+        assocs.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))
+        if self._get_full_variant is not None:
+            assocs = [self._get_full_variant(v) for v in assocs]
+        # Variants can be shared with a `manhattan.Binner`, which adds keys like `peak`, so only keep real fields.
+        return [{field: value for field, value in v.items() if field in parse_utils.fields} for v in assocs]
@@ -12,9 +12,13 @@ ffibuilder = cffi.FFI()
 ffibuilder.set_source('pheweb.load.cffi._x',
                       src,
                       source_extension='.cpp',
-                      extra_compile_args=['--std=c++11'],
+                      extra_compile_args=['--std=c++11', '-pthread'],
+                      extra_link_args=['-pthread'],
                       libraries=['z'], # needed on Linux but not macOS
 )
 ffibuilder.cdef('''
-const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath);
+const char* cffi_make_matrix(const char *const *base_filepaths, const int64_t *base_offsets, int num_bases, const char *const *aug_filepaths, const int64_t *aug_offsets, const int *old_bases, const int *old_columns, int num_phenos, const char *chrom, const char *matrix_filepath, int sparse, int write_header, int write_eof_block, int num_threads, int compression_level);
+const char* cffi_augment_pheno(const char *sites_filepath, const char *parsed_filepath, const char *out_filepath, const char *out_header, const char *float_columns, int num_threads, int compression_level,
+                               int (*on_written)(void *, const int64_t *, int, const int64_t *, int), void *on_written_arg);
+extern "Python" int augment_pheno_on_written(void *, const int64_t *, int, const int64_t *, int);
 ''')
@@ -1,7 +1,7 @@
 
 /*
 compile with:
-  g++ -std=c++11 -lz -o x x.cpp
+  g++ -std=c++11 -pthread -lz -o x x.cpp
 */
 
 #include <cstring> // memcpy on Linux
@@ -20,7 +20,10 @@ compile with:
 #include <iomanip> // setprecision
 #include <zlib.h>
 #include <fcntl.h> // O_WRONLY &c
+#include <unistd.h> // lseek, close
+#include <stdint.h> // int64_t
 #include <exception> // do I need this?
+#include <thread>
 
 
 // ------
@@ -29,42 +32,64 @@ compile with:
 class BgzipWriter {
 // This is adapted from <https://github.com/samtools/htslib/blob/master/bgzf.c>,
 // also referencing <http://github.com/samtools/htslib/blob/master/bgzip.c>
+// Full blocks are collected into a batch of `BLOCKS_PER_THREAD * num_threads` blocks,
+// which are compressed in parallel (one std::thread per slice of the batch) and then written in order.
+// Every block but the last holds exactly BGZF_BLOCK_SIZE bytes, like `_BgzfWriter` in file_utils.py, so `tell()` returns the same kind of offset.
 public:
-    BgzipWriter(std::string filepath) {
+    BgzipWriter(std::string filepath, int num_threads = 1, int compression_level = 5, bool keep_block_sizes = false) {
         if (compressBound(BGZF_BLOCK_SIZE) > BGZF_MAX_BLOCK_SIZE) { throw std::runtime_error("[BGZF_MAX_BLOCK_SIZE is too small to hold compressed random data]"); }
+        if (compression_level < 0 || compression_level > 9) { throw std::runtime_error("[the compression level must be between 0 and 9]"); }
         _filepath = filepath;
         _file.open(filepath.c_str(), std::ios::out | std::ios::binary);
-        _uncompressed_block = new uint8_t[2*BGZF_MAX_BLOCK_SIZE];
-        _compressed_block = _uncompressed_block + BGZF_MAX_BLOCK_SIZE;
-        _uncompressed_block_size = 0;
+        _num_threads = num_threads < 1 ? 1 : num_threads;
+        _compression_level = compression_level;
+        size_t batch_size = _num_threads == 1 ? 1 : _num_threads * BLOCKS_PER_THREAD;
+        _uncompressed_blocks.resize(batch_size, std::vector<uint8_t>(BGZF_BLOCK_SIZE));
+        _uncompressed_block_sizes.resize(batch_size, 0);
+        _compressed_blocks.resize(batch_size, std::vector<uint8_t>(BGZF_MAX_BLOCK_SIZE));
+        _compressed_block_sizes.resize(batch_size, 0);
+        _num_full_blocks = 0;
+        _num_written_blocks = 0;
+        _keep_block_sizes = keep_block_sizes;
     }
     ~BgzipWriter() {
         _file.close();
-        delete _uncompressed_block;
     }
     void write(const char* src_buffer, size_t src_len) {
         while (src_len > 0) {
-            size_t copy_length = BGZF_BLOCK_SIZE - _uncompressed_block_size;
+            size_t &block_size = _uncompressed_block_sizes[_num_full_blocks];
+            size_t copy_length = BGZF_BLOCK_SIZE - block_size;
             if (copy_length > src_len) copy_length = src_len;
-            memcpy(_uncompressed_block + _uncompressed_block_size, src_buffer, copy_length);
-            _uncompressed_block_size += copy_length;
+            memcpy(_uncompressed_blocks[_num_full_blocks].data() + block_size, src_buffer, copy_length);
+            block_size += copy_length;
             src_buffer += copy_length;
             src_len -= copy_length;
-            if (_uncompressed_block_size >= BGZF_BLOCK_SIZE) {
-                if (_uncompressed_block_size > BGZF_BLOCK_SIZE) {
+            if (block_size >= BGZF_BLOCK_SIZE) {
+                if (block_size > BGZF_BLOCK_SIZE) {
                     throw std::runtime_error("[uncompressed block too long]");
                 }
-                flush_uncompressed();
+                _num_full_blocks++;
+                if (_num_full_blocks == _uncompressed_blocks.size()) flush_batch();
             }
         }
     }
     void write(const std::string src_string) {
         write(src_string.c_str(), src_string.length());
     }
-    void close() {
+    int64_t tell() {
+        // Returns (the index of the current block << 16) | (the offset within its uncompressed data).
+        // The compressed sizes of the blocks before it (in `written_block_sizes`) turn that into a real virtual offset.
+        return (int64_t)(_num_written_blocks + _num_full_blocks) << 16 | _uncompressed_block_sizes[_num_full_blocks];
+    }
+    void close(bool write_eof_block = true) {
         // Make one empty block at the end to indicate EOF (as per samtools unofficial spec)
-        if (_uncompressed_block_size) flush_uncompressed();
-        flush_uncompressed();
+        // Without it, the file is a fragment that can be concatenated with other BGZF files.
+        if (_uncompressed_block_sizes[_num_full_blocks]) {
+            _num_full_blocks++;
+            if (_num_full_blocks == _uncompressed_blocks.size()) flush_batch();
+        }
+        if (write_eof_block) _num_full_blocks++; // the empty block
+        flush_batch();
     }
 private:
      static inline void packInt16(uint8_t *buffer, uint16_t value) {
@@ -98,7 +123,7 @@ private:
         default: snprintf(buffer, sizeof(buffer), "[%d] unknown", errnum); return buffer;
         }
     }
-    static inline void bgzf_compress(uint8_t *dst, size_t &dlen, const uint8_t *src, size_t slen) {
+    static inline void bgzf_compress(uint8_t *dst, size_t &dlen, const uint8_t *src, size_t slen, int compression_level) {
         uint32_t crc;
         z_stream zs;
         std::ostringstream errstream;
@@ -110,7 +135,7 @@ private:
         zs.next_out = dst + BLOCK_HEADER_LENGTH;
         zs.avail_out = dlen - BLOCK_HEADER_LENGTH - BLOCK_FOOTER_LENGTH;
         int ret = deflateInit2(&zs,
-                               COMPRESSION_LEVEL, // compression level. default is 6
+                               compression_level, // zlib's default of 6 is 3x slower than 2.  2 is 10% slower than 1.
                                Z_DEFLATED,
                                -15, // use 2^15=32kB window and output raw (no zlib header/footer)
                                8,
@@ -138,25 +163,61 @@ private:
         packInt32((uint8_t*)&dst[dlen - 8], crc);
         packInt32((uint8_t*)&dst[dlen - 4], slen);
     }
-    // flush_uncompressed compresses _uncompressed_block into _file
-    inline void flush_uncompressed() {
+    // flush_batch compresses the first `_num_full_blocks` of `_uncompressed_blocks` and writes them into _file in order
+    void flush_batch() {
         // NOTE: for random data, the compressed data is often longer than the uncompressed.
         //       but compressed blocks cannot be more than 64KiB, because their size is two bytes.
-        //       so, if `bgzf_compress` throws `insufficient_space_exception`, rerun with each half of data.
         //       this should never happen, because our header+footer is 26 bytes, so we only need marginally compressible data.
-        size_t compressed_block_size = BGZF_MAX_BLOCK_SIZE;
-        bgzf_compress(_compressed_block, compressed_block_size, _uncompressed_block, _uncompressed_block_size);
-        _file.write( (const char*)_compressed_block, compressed_block_size);
-        _uncompressed_block_size = 0;
+        size_t num_blocks = _num_full_blocks;
+        size_t num_threads = std::min((size_t)_num_threads, num_blocks);
+        if (num_threads <= 1) {
+            compress_blocks(0, 1, num_blocks);
+        } else {
+            std::vector<std::thread> threads;
+            std::vector<std::exception_ptr> exceptions(num_threads);
+            for (size_t t = 0; t < num_threads; t++) {
+                threads.emplace_back([this, t, num_threads, num_blocks, &exceptions]() {
+                    try { compress_blocks(t, num_threads, num_blocks); }
+                    catch (...) { exceptions[t] = std::current_exception(); }
+                });
+            }
+            for (std::thread &thread : threads) thread.join();
+            for (std::exception_ptr &exc : exceptions) if (exc) std::rethrow_exception(exc);
+        }
+        for (size_t i = 0; i < num_blocks; i++) {
+            _file.write((const char*)_compressed_blocks[i].data(), _compressed_block_sizes[i]);
+            _uncompressed_block_sizes[i] = 0;
+            if (_keep_block_sizes) written_block_sizes.push_back(_compressed_block_sizes[i]);
+        }
+        _num_written_blocks += num_blocks;
+        if (num_blocks < _uncompressed_blocks.size()) _uncompressed_block_sizes[num_blocks] = 0;
+        _num_full_blocks = 0;
+    }
+    // compress_blocks compresses blocks `first`, `first+step`, `first+2*step`, ... that are less than `end`
+    void compress_blocks(size_t first, size_t step, size_t end) {
+        for (size_t i = first; i < end; i += step) {
+            size_t compressed_block_size = BGZF_MAX_BLOCK_SIZE;
+            bgzf_compress(_compressed_blocks[i].data(), compressed_block_size, _uncompressed_blocks[i].data(), _uncompressed_block_sizes[i], _compression_level);
+            _compressed_block_sizes[i] = compressed_block_size;
+        }
     }
+public:
+    std::vector<int64_t> written_block_sizes; // with `keep_block_sizes`, the compressed size of each block written, which the caller can clear after reading them
+private:
     std::string _filepath;
     std::ofstream _file;
-    uint8_t *_uncompressed_block; // 64KiB
-    uint8_t *_compressed_block; // 64KiB
-    size_t _uncompressed_block_size; // num bytes occupied
+    int _num_threads;
+    int _compression_level;
+    std::vector<std::vector<uint8_t>> _uncompressed_blocks; // each 64KiB
+    std::vector<size_t> _uncompressed_block_sizes; // num bytes occupied
+    std::vector<std::vector<uint8_t>> _compressed_blocks; // each 64KiB
+    std::vector<size_t> _compressed_block_sizes;
+    size_t _num_full_blocks; // the index of the block that is being filled
+    size_t _num_written_blocks;
+    bool _keep_block_sizes;
+    static const size_t BLOCKS_PER_THREAD = 16;
     static const size_t BGZF_BLOCK_SIZE = 0xff00; // 255*256
     static const size_t BGZF_MAX_BLOCK_SIZE = 0x10000; //64K
-    static const int COMPRESSION_LEVEL = 5; // default of 6 is 3x slower than 2.  2 is 10% slower than 1.
     static const int BLOCK_HEADER_LENGTH = 18;
     static const int BLOCK_FOOTER_LENGTH = 8;
     static constexpr const char* BLOCK_HEADER =
@@ -190,7 +251,7 @@ public:
         // ASSERT: both input & output capabilities will not be used together
     }
     int is_open() { return opened; }
-    gzstreambuf* open( const char* name, int open_mode);
+    gzstreambuf* open( const char* name, int open_mode, int64_t virtual_offset = 0);
     gzstreambuf* close();
     ~gzstreambuf() { close(); }
     virtual int     overflow( int c = EOF);
@@ -204,7 +265,7 @@ public:
     gzstreambase() { init(&buf); }
     gzstreambase( const char* name, int open_mode);
     ~gzstreambase();
-    void open( const char* name, int open_mode);
+    void open( const char* name, int open_mode, int64_t virtual_offset = 0);
     void close();
     gzstreambuf* rdbuf() { return &buf; }
 };
@@ -214,11 +275,13 @@ public:
     igzstream( const char* name, int open_mode = std::ios::in)
         : gzstreambase( name, open_mode), std::istream( &buf) {}
     gzstreambuf* rdbuf() { return gzstreambase::rdbuf(); }
-    void open( const char* name, int open_mode = std::ios::in) {
-        gzstreambase::open( name, open_mode);
+    void open( const char* name, int open_mode = std::ios::in, int64_t virtual_offset = 0) {
+        gzstreambase::open( name, open_mode, virtual_offset);
     }
 };
-gzstreambuf* gzstreambuf::open( const char* name, int open_mode) {
+gzstreambuf* gzstreambuf::open( const char* name, int open_mode, int64_t virtual_offset) {
+    // `virtual_offset` is a BGZF virtual offset to start reading at (the offset of a block << 16 | the offset within it).
+    // For an uncompressed file, it's just the byte offset << 16.
     if ( is_open())
         return (gzstreambuf*)0;
     mode = open_mode;
@@ -234,9 +297,27 @@ gzstreambuf* gzstreambuf::open( const char* name, int open_mode) {
         *fmodeptr++ = 'w';
     *fmodeptr++ = 'b';
     *fmodeptr = '\0';
-    file = gzopen( name, fmode);
+    if (virtual_offset == 0) {
+        file = gzopen( name, fmode);
+    } else {
+        // gzip reads concatenated members (ie, BGZF blocks) in a row, and reads uncompressed files as-is, so we can start at any block.
+        if ( ! (mode & std::ios::in))
+            return (gzstreambuf*)0;
+        int fd = ::open(name, O_RDONLY);
+        if (fd < 0)
+            return (gzstreambuf*)0;
+        if (lseek(fd, virtual_offset >> 16, SEEK_SET) < 0 || (file = gzdopen(fd, fmode)) == 0) {
+            ::close(fd);
+            return (gzstreambuf*)0;
+        }
+        if (gzseek(file, virtual_offset & 0xffff, SEEK_CUR) < 0) {
+            gzclose(file);
+            return (gzstreambuf*)0;
+        }
+    }
     if (file == 0)
         return (gzstreambuf*)0;
+    setg( buffer + 4, buffer + 4, buffer + 4); // drop anything that was read before this stream was reopened
     opened = 1;
     return this;
 }
@@ -310,8 +391,8 @@ gzstreambase::gzstreambase( const char* name, int mode) {
 gzstreambase::~gzstreambase() {
     buf.close();
 }
-void gzstreambase::open( const char* name, int open_mode) {
-    if ( ! buf.open( name, open_mode))
+void gzstreambase::open( const char* name, int open_mode, int64_t virtual_offset) {
+    if ( ! buf.open( name, open_mode, virtual_offset))
         clear( rdstate() | std::ios::badbit);
 }
 void gzstreambase::close() {
@@ -325,10 +406,20 @@ void gzstreambase::close() {
 // Line-by-line file-reader that can handle plaintext or gzip files
 class LineReader {
 public:
-    inline void attach(const std::string& filepath) { // immediately reads the first line
-        stream.open(filepath.c_str());
+    inline void attach(const std::string& filepath, int64_t virtual_offset = 0) { // immediately reads the first line
+        stream.open(filepath.c_str(), std::ios::in, virtual_offset);
+        if (!stream.good()) {
+            std::ostringstream errstream;
+            errstream << "[failed to open " << filepath << " at virtual offset " << virtual_offset << "]";
+            throw std::runtime_error(errstream.str().c_str());
+        }
         next();
     }
+    inline void reattach(const std::string& filepath, int64_t virtual_offset) { // starts over at `virtual_offset`, and reads the line there
+        stream.close();
+        stream.clear();
+        attach(filepath, virtual_offset);
+    }
     inline void next() {
         std::getline(stream, line); // drops the \n
         if (!line.empty() && line[line.size() - 1] == '\r') line.erase(line.size() - 1); // CR remover from <http://stackoverflow.com/a/2529011/1166306>
@@ -345,16 +436,19 @@ public:
 static inline void set_ulimit_num_files(unsigned num_files) {
   struct rlimit old_limit, new_limit;
   getrlimit(RLIMIT_NOFILE, &old_limit);
+  if (num_files <= old_limit.rlim_cur) return; // never lower the limits, because later matrices in this process (or its children) might need more files
+  std::ostringstream errstream;
   if (num_files > old_limit.rlim_max) {
-    std::cerr << "You're trying to open " << num_files << " files at once, but your ulimit only allows you to open " << old_limit.rlim_max << ".  Use administrative rights to raise your limit." << std::endl;
-    exit(1);
+    errstream << "[You're trying to open " << num_files << " files at once, but your ulimit only allows you to open " << old_limit.rlim_max << ".  "
+              << "Use administrative rights to raise your limit, or set `matrix_max_open_files` lower in config.py.]";
+    throw std::runtime_error(errstream.str().c_str());
   }
   new_limit.rlim_cur = num_files;
-  new_limit.rlim_max = num_files;
+  new_limit.rlim_max = old_limit.rlim_max;
   if (setrlimit(RLIMIT_NOFILE, &new_limit) != 0) {
-    std::cerr << "setrlimit() failed with errno=" << errno << "\n";
-    std::cerr << "current soft limit is " << old_limit.rlim_cur << ", hard limit is " << old_limit.rlim_max << ", requested new limit is " << num_files << std::endl;
-    exit(1);
+    errstream << "[setrlimit() failed with errno=" << errno << "]";
+    errstream << "[current soft limit is " << old_limit.rlim_cur << ", hard limit is " << old_limit.rlim_max << ", requested new limit is " << num_files << "]";
+    throw std::runtime_error(errstream.str().c_str());
   }
 }
 
@@ -397,19 +491,172 @@ bool endsWith (std::string const &str, std::string const &suffix) {
 // ------
 // main
 
-int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
-    BgzipWriter writer(matrix_filepath);
+static inline bool advance(LineReader& reader) {
+    // Reads the next line, returning false if there isn't one.
+    if (reader.eof()) return false;
+    reader.next();
+    return true;
+}
 
-    LineReader sites_reader;
-    sites_reader.attach(sites_filepath);
+static const std::string sparse_matrix_meta_line = "##pheweb_matrix_format=sparse";
+
+// A file whose lines are the lines of sites.tsv, in order: sites.tsv itself, or a matrix (eg, the old matrix.tsv.gz, or a matrix of some of the phenos).
+// A dense matrix has every per-assoc field of every pheno on every line (empty if the pheno doesn't have that variant).
+// A sparse matrix has the same header after the line "##pheweb_matrix_format=sparse",
+// but each line only has the per-variant fields and then, for each pheno that has the variant, its index (in the header) and its per-assoc fields.
+struct MatrixBase {
+    std::string filepath;
+    LineReader reader;
+    bool has_line;
+    bool is_sparse;
+    std::string variant_header; // the per-variant fields of the header, which are the ones without "@" (ie, all of them in sites.tsv)
+    std::vector<std::string> colnames;
+    size_t n_per_variant_fields;
+    std::vector<size_t> pheno_first_columns, pheno_num_fields; // the phenos in this file, in order
+    // The current line:
+    size_t variant_end; // where the per-variant fields end
+    std::vector<size_t> tabs; // where each tab is (and then the end of the line)
+    std::vector<size_t> pheno_starts, pheno_ends; // where the "\t<per-assoc fields>" of each pheno are
+    std::vector<size_t> pheno_line_nums; // each pheno is on the current line if this is its number
+
+    void attach(const std::string& filepath_) {
+        filepath = filepath_;
+        reader.attach(filepath);
+        is_sparse = reader.line == sparse_matrix_meta_line;
+        if (is_sparse) reader.next();
+        std::string header = reader.line;
+        if (!header.empty() && header[0] == '#') header.erase(0, 1); // matrix.tsv.gz has a commented header
+        std::istringstream header_stream(header);
+        std::string colname;
+        while (std::getline(header_stream, colname, '\t')) colnames.push_back(colname);
+        n_per_variant_fields = 0;
+        while (n_per_variant_fields < colnames.size() && colnames[n_per_variant_fields].find('@') == std::string::npos) n_per_variant_fields++;
+        variant_header = n_per_variant_fields < colnames.size() ? header.substr(0, pos_after_n_of_char(header, n_per_variant_fields, '\t') - 1) : header;
+        for (size_t col = n_per_variant_fields; col < colnames.size(); col++) {
+            if (col == n_per_variant_fields || get_phenocode(col) != get_phenocode(col - 1)) {
+                pheno_first_columns.push_back(col);
+                pheno_num_fields.push_back(0);
+            }
+            pheno_num_fields.back()++;
+        }
+        pheno_starts.resize(pheno_first_columns.size());
+        pheno_ends.resize(pheno_first_columns.size());
+        pheno_line_nums.resize(pheno_first_columns.size(), 0);
+    }
+
+    std::string get_phenocode(size_t col) { return colnames[col].substr(colnames[col].find('@') + 1); }
+
+    int get_pheno_idx(size_t first_column) { // returns the index of the pheno whose first column is `first_column`, or -1
+        std::vector<size_t>::iterator it = std::lower_bound(pheno_first_columns.begin(), pheno_first_columns.end(), first_column);
+        if (it == pheno_first_columns.end() || *it != first_column) return -1;
+        return it - pheno_first_columns.begin();
+    }
+
+    void parse_line(size_t line_num) {
+        const std::string& line = reader.line;
+        variant_end = line.size();
+        if (pheno_first_columns.empty()) return;
+        tabs.clear();
+        for (size_t k = 0; k < line.size(); k++) if (line[k] == '\t') tabs.push_back(k);
+        tabs.push_back(line.size());
+        bool ok = tabs.size() >= n_per_variant_fields;
+        if (ok) variant_end = tabs[n_per_variant_fields - 1];
+        if (ok && !is_sparse) {
+            ok = tabs.size() == colnames.size();
+            for (size_t j = 0; ok && j < pheno_first_columns.size(); j++) {
+                pheno_starts[j] = tabs[pheno_first_columns[j] - 1];
+                pheno_ends[j] = tabs[pheno_first_columns[j] + pheno_num_fields[j] - 1];
+                if (pheno_ends[j] - pheno_starts[j] > pheno_num_fields[j]) pheno_line_nums[j] = line_num; // some field isn't empty
+            }
+        } else if (ok) {
+            // after the per-variant fields, it's groups of "\t<pheno index>\t<per-assoc fields>"
+            size_t tab_idx = n_per_variant_fields - 1;
+            while (ok && tab_idx + 1 < tabs.size()) {
+                const char *idx_start = line.c_str() + tabs[tab_idx] + 1;
+                char *idx_end;
+                unsigned long j = strtoul(idx_start, &idx_end, 10);
+                ok = (idx_end > idx_start && idx_end == line.c_str() + tabs[tab_idx + 1] &&
+                      j < pheno_first_columns.size() && tab_idx + 1 + pheno_num_fields[j] < tabs.size());
+                if (ok) {
+                    pheno_starts[j] = tabs[tab_idx + 1];
+                    pheno_ends[j] = tabs[tab_idx + 1 + pheno_num_fields[j]];
+                    pheno_line_nums[j] = line_num;
+                    tab_idx += 1 + pheno_num_fields[j];
+                }
+            }
+        }
+        if (!ok) {
+            std::ostringstream errstream;
+            errstream << "[the matrix " << filepath << " has a line with the wrong number of tab-delimited fields]";
+            errstream << "[bad line = " << line << "]";
+            throw std::runtime_error(errstream.str().c_str());
+        }
+    }
+};
 
-    std::vector<std::string> aug_filepaths = glob(augmented_pheno_glob);
-    size_t N_phenos = aug_filepaths.size();
+int make_matrix(const char *const *base_filepaths, const int64_t *base_offsets, int num_bases,
+                const char *const *aug_filepaths_array, const int64_t *aug_offsets, const int *old_bases, const int *old_columns, int num_phenos,
+                const char *chrom, const char *matrix_filepath, bool sparse, bool write_header, bool write_eof_block, int num_threads, int compression_level) {
+    // The bases are files whose lines are the lines of sites.tsv, in order (see `MatrixBase`).  The first one is sites.tsv or a matrix, and the rest are matrices.
+    // The i-th pheno is either the pheno file `aug_filepaths_array[i]` (if `old_bases[i]` is -1),
+    // or one pheno in the matrix `base_filepaths[old_bases[i]]`, whose first column in its header is `old_columns[i]` (and then `aug_filepaths_array[i]` isn't used).
+    // If `chrom` is "", this merges all of the bases and the pheno files (and `base_offsets` and `aug_offsets` aren't used).
+    // Otherwise, it only merges the variants on `chrom`, which start at the virtual offset `base_offsets[b]` in each base,
+    // (or right after the header, if `base_offsets[b]` is -1 because the base only has `chrom`),
+    // and at `aug_offsets[i]` in the i-th pheno file (or -1 if that pheno has no variants on `chrom`).
+    // Files for different chromosomes, each written without `write_eof_block`, can be concatenated (and then followed by an EOF block).
+    // If `sparse`, this writes a sparse matrix (see `MatrixBase`).
+    BgzipWriter writer(matrix_filepath, num_threads, compression_level);
+    const std::string chrom_prefix = std::string(chrom) + "\t";
+    const bool only_chrom = chrom_prefix.size() > 1;
+
+    // Headers:
+    // The per-variant fields of every base must be the same, and they must begin with "chrom pos ref alt ".
+    // Every pheno file's header must begin with the per-variant fields.
+    // All fields after those will be written as "<field>@<pheno>", and the columns from the matrices keep their names.
+    size_t N_bases = num_bases;
+    std::vector<MatrixBase> bases(N_bases);
+    for (size_t b = 0; b < N_bases; b++) {
+        bases[b].attach(base_filepaths[b]);
+        if (bases[b].variant_header != bases[0].variant_header) {
+            std::ostringstream errstream;
+            errstream << "[The matrix " << bases[b].filepath << " doesn't have the same per-variant fields as " << bases[0].filepath << "]";
+            throw std::runtime_error(errstream.str().c_str());
+        }
+    }
+    const std::string& variant_header = bases[0].variant_header;
+    const size_t n_per_variant_fields = bases[0].n_per_variant_fields;
+    static const std::string cpra_header = "chrom\tpos\tref\talt\t";
+    if(0 != variant_header.compare(0, cpra_header.size(), cpra_header)) { throw std::runtime_error("[sites.tsv header doesn't begin with \"chrom\tpos\tref\talt\t\"]"); }
+
+    size_t N_phenos = num_phenos;
+    std::vector<std::string> aug_filepaths(N_phenos);
     std::vector<LineReader> aug_readers(N_phenos);
+    std::vector<bool> aug_has_line(N_phenos); // whether `aug_readers[i].line` is a variant that hasn't been written yet
     std::vector<std::string> aug_phenocodes(N_phenos);
     std::vector<unsigned> aug_n_per_assoc_fields(N_phenos); // initialized to 0s.
-    set_ulimit_num_files(N_phenos + 100); // are python files still open?
+    std::vector<int> aug_old_pheno_idx(N_phenos, -1); // which pheno of `bases[old_bases[i]]` this is, or -1 if it's a pheno file
+    std::vector<std::string> aug_sparse_prefixes(N_phenos); // "\t<i>", written before the per-assoc fields in a sparse matrix
+    size_t num_files = N_bases;
     for (size_t i = 0; i < N_phenos; i++) {
+        aug_sparse_prefixes[i] = "\t" + std::to_string(i);
+        if (old_bases[i] >= 0) {
+            if ((size_t)old_bases[i] >= N_bases || old_columns[i] < 0 || (aug_old_pheno_idx[i] = bases[old_bases[i]].get_pheno_idx(old_columns[i])) < 0) {
+                std::ostringstream errstream;
+                errstream << "[column " << old_columns[i] << " of base " << old_bases[i] << " isn't the first column of a pheno]";
+                throw std::runtime_error(errstream.str().c_str());
+            }
+            MatrixBase& base = bases[old_bases[i]];
+            aug_phenocodes[i] = base.get_phenocode(old_columns[i]);
+            aug_n_per_assoc_fields[i] = base.pheno_num_fields[aug_old_pheno_idx[i]];
+        } else {
+            num_files++;
+        }
+    }
+    set_ulimit_num_files(num_files + 100); // are python files still open?
+    for (size_t i = 0; i < N_phenos; i++) {
+        if (old_bases[i] >= 0) continue;
+        aug_filepaths[i] = aug_filepaths_array[i];
         aug_readers[i].attach(aug_filepaths[i]);
         aug_phenocodes[i] = aug_filepaths[i];
         size_t last_slash_idx = aug_phenocodes[i].find_last_of("/");
@@ -419,64 +666,115 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
         if (endsWith(aug_phenocodes[i], ".gz")) {
             aug_phenocodes[i] = aug_phenocodes[i].erase(aug_phenocodes[i].length() - 3);
         }
-    }
-
-    // Headers:
-    // sites.tsv's header must begin with "chrom pos ref alt ".
-    // Every file's header must begin with the header of sites.tsv
-    // All fields after the ones in sites.tsv will be written as "<field>@<pheno>"
-    static const std::string cpra_header = "chrom\tpos\tref\talt\t";
-    if(0 != sites_reader.line.compare(0, cpra_header.size(), cpra_header)) { throw std::runtime_error("[sites.tsv header doesn't begin with \"chrom\tpos\tref\talt\t\"]"); }
-    for (size_t i=0; i < N_phenos; i++) {
-        if(0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
+        if(0 != aug_readers[i].line.compare(0, variant_header.size(), variant_header)) {
             std::ostringstream errstream;
             errstream << "[One of the pheno files has a header that doesn't begin with the header of sites.tsv (or it failed to read).]";
             errstream << "[bad phenocode = " << aug_phenocodes[i] << "]";
             errstream << "[bad pheno file = " << aug_filepaths[i] << "]";
             errstream << "[bad pheno header = " << aug_readers[i].line << "]";
-            errstream << "[sites.tsv header = " << sites_reader.line << "]";
+            errstream << "[sites.tsv header = " << variant_header << "]";
             throw std::runtime_error(errstream.str().c_str());
         }
-    }
-    writer.write("#"); // tabix needs the header commented.
-    writer.write(sites_reader.line); // no trailing \t or \n
-    for (size_t i=0; i < N_phenos; i++) {
-        std::string per_assoc_fields = aug_readers[i].line.substr(sites_reader.line.size(), std::string::npos);
+        std::string per_assoc_fields = aug_readers[i].line.substr(variant_header.size(), std::string::npos);
         std::istringstream line_stream(per_assoc_fields);
         std::string field;
         std::getline(line_stream, field, '\t'); // consume first tab.
-        while(std::getline(line_stream, field, '\t')) {
-            writer.write("\t");
-            writer.write(field);
-            writer.write("@");
-            writer.write(aug_phenocodes[i]);
-            aug_n_per_assoc_fields[i]++;
+        while(std::getline(line_stream, field, '\t')) aug_n_per_assoc_fields[i]++;
+    }
+    if (write_header) {
+        if (sparse) {
+            writer.write(sparse_matrix_meta_line);
+            writer.write("\n");
+        }
+        writer.write("#"); // tabix needs the header commented.
+        writer.write(variant_header); // no trailing \t or \n
+        for (size_t i=0; i < N_phenos; i++) {
+            if (old_bases[i] >= 0) {
+                for (size_t j = old_columns[i]; j < old_columns[i] + aug_n_per_assoc_fields[i]; j++) {
+                    writer.write("\t");
+                    writer.write(bases[old_bases[i]].colnames[j]);
+                }
+            } else {
+                std::string per_assoc_fields = aug_readers[i].line.substr(variant_header.size(), std::string::npos);
+                std::istringstream line_stream(per_assoc_fields);
+                std::string field;
+                std::getline(line_stream, field, '\t'); // consume first tab.
+                while(std::getline(line_stream, field, '\t')) {
+                    writer.write("\t");
+                    writer.write(field);
+                    writer.write("@");
+                    writer.write(aug_phenocodes[i]);
+                }
+            }
+        }
+        writer.write("\n");
+    }
+    // advance every file to its 1st data-line (on `chrom`)
+    for (size_t b=0; b<N_bases; b++) {
+        if (only_chrom && base_offsets[b] >= 0) {
+            bases[b].reader.reattach(bases[b].filepath, base_offsets[b]);
+            bases[b].has_line = true;
+        } else {
+            bases[b].has_line = advance(bases[b].reader);
         }
     }
-    writer.write("\n");
-    const size_t n_per_variant_fields = n_fields(sites_reader.line);
-    // advance every file to its 1st data-line
-    sites_reader.next();
-    for (size_t i=0; i<N_phenos; i++) aug_readers[i].next();
+    if (only_chrom) {
+        for (size_t i=0; i<N_phenos; i++) {
+            if (old_bases[i] >= 0 || aug_offsets[i] < 0) {
+                aug_has_line[i] = false;
+            } else {
+                aug_readers[i].reattach(aug_filepaths[i], aug_offsets[i]);
+                aug_has_line[i] = true;
+            }
+        }
+    } else {
+        for (size_t i=0; i<N_phenos; i++) aug_has_line[i] = old_bases[i] < 0 && advance(aug_readers[i]);
+    }
 
     // Data:
-    // Every aug_pheno is a subsequence of sites.tsv.
-    // If a line in an aug_pheno has the same chrom-pos-ref-alt as sites.tsv, then it must have the sites.tsv line as its prefix.
+    // Every aug_pheno is a subsequence of sites.tsv (and so of the bases).
+    // If a line in an aug_pheno has the same chrom-pos-ref-alt as the bases, then it must have their per-variant fields as its prefix.
     //    (ie, it must have the same per-variant fields, in the same order.)
-    // So, we iterate over sites.tsv, printing and advancing any aug_pheno that matches CPRA, and printing '' for every field in non-matching aug_phenos.
-    while(1) {
-        writer.write(sites_reader.line);
-
-        size_t pos_after_cpra = pos_after_n_of_char(sites_reader.line, 4, '\t');
+    // So, we iterate over the bases, printing and advancing any aug_pheno that matches CPRA, and printing '' for every field in non-matching aug_phenos.
+    // The per-assoc fields of phenos from the matrices are copied as-is.
+    // When only merging `chrom`, we stop at the first line of the first base on another chromosome.
+    // (Pheno lines on other chromosomes never match, so they don't need to be checked.)
+    MatrixBase& first_base = bases[0];
+    size_t line_num = 0;
+    while(first_base.has_line && (!only_chrom || 0 == first_base.reader.line.compare(0, chrom_prefix.size(), chrom_prefix))) {
+        const std::string& base_line = first_base.reader.line;
+        line_num++;
+        size_t pos_after_cpra = pos_after_n_of_char(base_line, 4, '\t');
+        for (size_t b=0; b<N_bases; b++) {
+            if (b > 0 && (!bases[b].has_line || 0 != bases[b].reader.line.compare(0, pos_after_cpra, base_line, 0, pos_after_cpra))) {
+                std::ostringstream errstream;
+                errstream << "[The matrix " << bases[b].filepath << " doesn't have the same variants as " << first_base.filepath << "]";
+                errstream << "[expected line = " << base_line.substr(0, pos_after_cpra) << "]";
+                if (bases[b].has_line) errstream << "[bad line = " << bases[b].reader.line.substr(0, pos_after_cpra) << "]";
+                throw std::runtime_error(errstream.str().c_str());
+            }
+            bases[b].parse_line(line_num);
+        }
+        const size_t variant_end = first_base.variant_end;
+        writer.write(base_line.c_str(), variant_end);
 
         for (size_t i=0; i<N_phenos; i++) {
-            if (!aug_readers[i].eof() && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
-                if (0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
+            if (old_bases[i] >= 0) {
+                MatrixBase& base = bases[old_bases[i]];
+                size_t j = aug_old_pheno_idx[i];
+                if (base.pheno_line_nums[j] == line_num) {
+                    if (sparse) writer.write(aug_sparse_prefixes[i]);
+                    writer.write(base.reader.line.c_str() + base.pheno_starts[j], base.pheno_ends[j] - base.pheno_starts[j]);
+                } else if (!sparse) {
+                    for (size_t k=0; k<aug_n_per_assoc_fields[i]; k++) writer.write("\t");
+                }
+            } else if (aug_has_line[i] && 0 == base_line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
+                if (0 != aug_readers[i].line.compare(0, variant_end, base_line, 0, variant_end)) {
                     std::ostringstream errstream;
                     errstream << "[There's a variant in a pheno file that has different information from that same variant in sites.tsv.]";
                     errstream << "[bad phenocode = " << aug_phenocodes[i] << "]";
                     errstream << "[bad pheno line = " << aug_readers[i].line << "]";
-                    errstream << "[bad sites.tsv line = " << sites_reader.line << "]";
+                    errstream << "[bad sites.tsv line = " << base_line.substr(0, variant_end) << "]";
                     throw std::runtime_error(errstream.str().c_str());
                 }
                 if (n_fields(aug_readers[i].line) != n_per_variant_fields + aug_n_per_assoc_fields[i]) { // correct number of fields on line.
@@ -488,57 +786,219 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
                     errstream << "[num fields in header = " << n_per_variant_fields + aug_n_per_assoc_fields[i] << "]";
                     throw std::runtime_error(errstream.str().c_str());
                 }
-                writer.write(aug_readers[i].line.c_str() + sites_reader.line.size(), aug_readers[i].line.size() - sites_reader.line.size()); //write per-assoc fields
-                aug_readers[i].next();
+                if (sparse) writer.write(aug_sparse_prefixes[i]);
+                writer.write(aug_readers[i].line.c_str() + variant_end, aug_readers[i].line.size() - variant_end); //write per-assoc fields
+                aug_has_line[i] = advance(aug_readers[i]);
 
-            } else { // CPRAs don't match
+            } else if (!sparse) { // CPRAs don't match
                 // write blanks for this pheno
                 for (size_t j=0; j<aug_n_per_assoc_fields[i]; j++) writer.write("\t");
             }
         }
         writer.write("\n");
 
-        if (sites_reader.eof()) break;
-        sites_reader.next();
+        for (size_t b=0; b<N_bases; b++) bases[b].has_line = advance(bases[b].reader);
     }
 
-    writer.close();
+    writer.close(write_eof_block);
 
     return 0;
 }
 
 
 
+// ------
+// augment-phenos
+
+static inline std::string python_repr_of_integer(const std::string& digits, bool negative) {
+    // Returns what Python's `repr(float(x))` gives for the integer `x`, which is its digits plus ".0" unless it's 1e16 or bigger.
+    std::string sign = negative ? "-" : "";
+    if (digits.size() <= 15) return sign + digits + ".0"; // every integer below 1e15 is exactly a double
+    double x = strtod(digits.c_str(), NULL);
+    char buffer[64];
+    if (x < 1e16) {
+        snprintf(buffer, sizeof(buffer), "%.0f.0", x);
+        return sign + buffer;
+    }
+    for (int precision = 0; precision < 17; precision++) { // find the shortest scientific notation that round-trips
+        snprintf(buffer, sizeof(buffer), "%.*e", precision, x);
+        if (strtod(buffer, NULL) == x) break;
+    }
+    return sign + buffer;
+}
+
+static inline void append_assoc_fields(std::string& out, const std::string& line, size_t start, const std::string& float_columns) {
+    // Appends `line[start:]` (the per-assoc fields of a parsed pheno file) to `out`.
+    // parse-input-files writes floats that round to an integer (eg, a pval of 0) like "0", but VariantFileWriter writes floats like "0.0",
+    // so the fields where `float_columns` has a '1' are rewritten when they look like an integer.
+    size_t num_fields = 0;
+    while (true) {
+        size_t end = line.find('\t', start);
+        if (end == std::string::npos) end = line.size();
+        if (num_fields < float_columns.size() && float_columns[num_fields] == '1') {
+            size_t digits_start = (start < end && line[start] == '-') ? start + 1 : start;
+            bool is_integer = digits_start < end;
+            for (size_t i = digits_start; i < end && is_integer; i++) is_integer = line[i] >= '0' && line[i] <= '9';
+            if (is_integer) {
+                out += python_repr_of_integer(line.substr(digits_start, end - digits_start), digits_start != start);
+            } else {
+                out.append(line, start, end - start);
+            }
+        } else {
+            out.append(line, start, end - start);
+        }
+        num_fields++;
+        if (end == line.size()) break;
+        out += '\t';
+        start = end + 1;
+    }
+    if (num_fields != float_columns.size()) {
+        std::ostringstream errstream;
+        errstream << "[a pheno has a line with a different number of tab-delimited fields than its header]";
+        errstream << "[bad pheno line = " << line << "]";
+        throw std::runtime_error(errstream.str().c_str());
+    }
+}
+
+typedef int (*on_written_t)(void *arg, const int64_t *line_ends, int num_line_ends, const int64_t *block_sizes, int num_block_sizes);
+
+int augment_pheno(const char *sites_filepath, const char *parsed_filepath, const char *out_filepath, const char *out_header, const char *float_columns, int num_threads, int compression_level,
+                  on_written_t on_written, void *on_written_arg) {
+    // Writes each line of `parsed_filepath` with its chrom-pos-ref-alt replaced by the matching line of `sites_filepath`.
+    // Both must begin with "chrom pos ref alt " and `parsed_filepath` must be a subsequence of `sites_filepath`.
+    // `float_columns` has a '1' for each per-assoc field that is a float and a '0' for the others.
+    // Every few thousand lines (and at the end), `on_written` (if it isn't NULL) gets the `BgzipWriter::tell()` after each line (and first after the header)
+    // and the compressed sizes of the blocks written since its last call, so that the caller can build a tabix index without reading the file.
+    // If it returns non-zero, this stops.
+    BgzipWriter writer(out_filepath, num_threads, compression_level, on_written != NULL);
+    std::vector<int64_t> line_ends;
+    auto report_written = [&]() {
+        if (on_written != NULL && 0 != on_written(on_written_arg, line_ends.data(), line_ends.size(), writer.written_block_sizes.data(), writer.written_block_sizes.size())) {
+            throw std::runtime_error("[stopped by on_written]");
+        }
+        line_ends.clear();
+        writer.written_block_sizes.clear();
+    };
+    std::string float_columns_str(float_columns);
+    LineReader sites_reader;
+    sites_reader.attach(sites_filepath);
+    LineReader pheno_reader;
+    pheno_reader.attach(parsed_filepath);
+    writer.write(out_header);
+    writer.write("\n");
+    line_ends.push_back(writer.tell());
+    if (sites_reader.eof()) throw std::runtime_error("[the sites file has no variants]");
+    if (pheno_reader.eof()) throw std::runtime_error("[the pheno has no variants]");
+    sites_reader.next();
+    pheno_reader.next();
+
+    std::string out_line;
+    while (1) {
+        size_t pos_after_cpra = pheno_reader.line.find('\t');
+        for (int i = 0; i < 3 && pos_after_cpra != std::string::npos; i++) pos_after_cpra = pheno_reader.line.find('\t', pos_after_cpra + 1);
+        if (pos_after_cpra == std::string::npos) {
+            std::ostringstream errstream;
+            errstream << "[a pheno has a line with fewer than 5 fields][bad pheno line = " << pheno_reader.line << "]";
+            throw std::runtime_error(errstream.str().c_str());
+        }
+        pos_after_cpra++; // include the tab
+        // Sites that aren't in the pheno are skipped.
+        while (0 != sites_reader.line.compare(0, pos_after_cpra, pheno_reader.line, 0, pos_after_cpra)) {
+            if (sites_reader.eof()) {
+                std::ostringstream errstream;
+                errstream << "[the sites file is missing a variant that's present in the pheno, or they are sorted differently]";
+                errstream << "[pheno line = " << pheno_reader.line << "]";
+                throw std::runtime_error(errstream.str().c_str());
+            }
+            sites_reader.next();
+        }
+        out_line = sites_reader.line;
+        out_line += '\t';
+        append_assoc_fields(out_line, pheno_reader.line, pos_after_cpra, float_columns_str);
+        out_line += '\n';
+        writer.write(out_line);
+        line_ends.push_back(writer.tell());
+        if (line_ends.size() >= 4096) report_written();
+
+        if (pheno_reader.eof()) break;
+        pheno_reader.next();
+        if (sites_reader.eof()) {
+            std::ostringstream errstream;
+            errstream << "[the sites file ran out of variants while the pheno still had " << pheno_reader.line << "]";
+            throw std::runtime_error(errstream.str().c_str());
+        }
+        sites_reader.next();
+    }
+
+    writer.close();
+    report_written();
+    return 0;
+}
+
+
 // ------
 // entry points
 
-const char* make_matrix_and_return_string(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
+// The message of an exception is copied here, because `exc.what()` points into the exception, which is destroyed when the catch block ends.
+static thread_local std::string error_message;
+
+const char* make_matrix_and_return_string(const char *const *base_filepaths, const int64_t *base_offsets, int num_bases,
+                                          const char *const *aug_filepaths, const int64_t *aug_offsets, const int *old_bases, const int *old_columns, int num_phenos,
+                                         const char *chrom, const char *matrix_filepath, bool sparse, bool write_header, bool write_eof_block, int num_threads, int compression_level) {
+  try {
+    make_matrix(base_filepaths, base_offsets, num_bases, aug_filepaths, aug_offsets, old_bases, old_columns, num_phenos, chrom, matrix_filepath, sparse, write_header, write_eof_block, num_threads, compression_level);
+    return "ok";
+  } catch (const std::exception &exc) {
+    error_message = exc.what();
+    return error_message.c_str();
+  } catch (...) {
+    return "[something broke]";
+  }
+}
+
+const char* augment_pheno_and_return_string(const char *sites_filepath, const char *parsed_filepath, const char *out_filepath, const char *out_header, const char *float_columns, int num_threads, int compression_level,
+                                            on_written_t on_written, void *on_written_arg) {
   try {
-    make_matrix(sites_filepath, augmented_pheno_glob, matrix_filepath);
+    augment_pheno(sites_filepath, parsed_filepath, out_filepath, out_header, float_columns, num_threads, compression_level, on_written, on_written_arg);
     return "ok";
   } catch (const std::exception &exc) {
-    return exc.what();
+    error_message = exc.what();
+    return error_message.c_str();
   } catch (...) {
     return "[something broke]";
   }
 }
 
 extern "C" { // we need C because C++ mangles names supposedly
-  extern const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
-    return make_matrix_and_return_string(sites_filepath, augmented_pheno_glob, matrix_filepath);
+  extern const char* cffi_make_matrix(const char *const *base_filepaths, const int64_t *base_offsets, int num_bases,
+                                      const char *const *aug_filepaths, const int64_t *aug_offsets, const int *old_bases, const int *old_columns, int num_phenos,
+                                      const char *chrom, const char *matrix_filepath, int sparse, int write_header, int write_eof_block, int num_threads, int compression_level) {
+    return make_matrix_and_return_string(base_filepaths, base_offsets, num_bases, aug_filepaths, aug_offsets, old_bases, old_columns, num_phenos, chrom, matrix_filepath, sparse, write_header, write_eof_block, num_threads, compression_level);
+  }
+  extern const char* cffi_augment_pheno(const char *sites_filepath, const char *parsed_filepath, const char *out_filepath, const char *out_header, const char *float_columns, int num_threads, int compression_level,
+                                        on_written_t on_written, void *on_written_arg) {
+    return augment_pheno_and_return_string(sites_filepath, parsed_filepath, out_filepath, out_header, float_columns, num_threads, compression_level, on_written, on_written_arg);
   }
 }
 
 // for use when compiling directly (for debugging)
 int main(int argc, char **argv) {
-  if (argc == 4) {
-    const char* ret = make_matrix_and_return_string(argv[1], argv[2], argv[3]);
+  if (argc == 4 || argc == 6) {
+    int num_threads = argc == 6 ? atoi(argv[4]) : 1;
+    int compression_level = argc == 6 ? atoi(argv[5]) : 5;
+    std::vector<std::string> aug_filepaths = glob(argv[2]);
+    std::vector<const char*> aug_filepaths_array;
+    for (const std::string &filepath : aug_filepaths) aug_filepaths_array.push_back(filepath.c_str());
+    std::vector<int64_t> aug_offsets(aug_filepaths.size(), 0);
+    std::vector<int> old_bases(aug_filepaths.size(), -1), old_columns(aug_filepaths.size(), -1);
+    int64_t base_offset = 0;
+    const char* ret = make_matrix_and_return_string(&argv[1], &base_offset, 1, aug_filepaths_array.data(), aug_offsets.data(), old_bases.data(), old_columns.data(), aug_filepaths.size(), "", argv[3], false, true, true, num_threads, compression_level);
     std::cerr << ret << std::endl;
     std::string good_output = "ok";
     return (0 == good_output.compare(ret)) ? 0 : 1;
   }
   std::cout << "Usage:\n"
-            << " ./x /path/to/sites.tsv \"/path/to/pheno/*\" /path/to/matrix.tsv.gz"
+            << " ./x /path/to/sites.tsv \"/path/to/pheno/*\" /path/to/matrix.tsv.gz [num_threads compression_level]"
             << std::endl;
   return 1;
 }
@@ -9,10 +9,10 @@ This avoids reading any variant more than once.
 from ..utils import get_padded_gene_tuples
 from ..file_utils import MatrixReader, get_filepath, get_tmp_path
 from .load_utils import Parallelizer
+from .add_genes import GeneAnnotator
 
 import sqlite3, json, traceback, functools
 from pathlib import Path
-from intervaltree import IntervalTree, Interval
 from typing import List,Any,Dict,Tuple
 
 def run(argv:List[str]) -> None:
@@ -84,33 +84,36 @@ def process_regions(taskq, retq, parent_overrides) -> None:
     except Exception as exc:
         retq.put({'type':'exception', 'task':None, 'exception_str':str(exc), 'exception_tb':traceback.format_exc()})
         raise
-    tree_for_chrom = get_gene_intervaltree_for_chrom()
+    gene_annotator = get_padded_gene_annotator()
     with MatrixReader().context() as matrix_reader:
-        f = functools.partial(get_region_info, matrix_reader, tree_for_chrom)
+        f = functools.partial(get_region_info, matrix_reader, gene_annotator)
         Parallelizer._make_multiple_tasks_doer(f)(taskq, retq, parent_overrides)
 
-def get_region_info(matrix_reader, tree_for_chrom:Dict[str,IntervalTree], region:Tuple[str,int,int]) -> Dict[str,List[Dict[str,Any]]]:
+def get_region_info(matrix_reader, gene_annotator:GeneAnnotator, region:Tuple[str,int,int]) -> Dict[str,List[Dict[str,Any]]]:
     chrom, start, end = region
     best_assoc_for_pheno_gene_pair: Dict[Tuple[str,str],Dict[str,Any]] = {}
     # best_assoc_for_pheno_gene_pair is like:
     # { ('<phenocode>', '<genename>'): {'ac': 35, ... all per_pheno and per_assoc fields} }
 
     for variant in matrix_reader.get_region(chrom, start, end+1):
-        genenames: List[str] = [iv.data for iv in tree_for_chrom[variant['chrom']].at(variant['pos'])]
+        genenames: List[str] = gene_annotator.get_overlapping_genes(variant['chrom'], variant['pos'])
 
-        for phenocode, pheno in variant['phenos'].items():
-            assert isinstance(pheno['pval'], float)
-
-            # using SNP-level cases and control counts 
-            pheno = dict(pheno)  # Make a copy so we don't mutate the original
-            if 'num_cases' in variant:
-                pheno['num_cases'] = variant['num_cases']
-            if 'num_controls' in variant:
-                pheno['num_controls'] = variant['num_controls']
+        if not genenames: continue
 
+        # Only the pvals are parsed, and then each phenotype's other fields only get parsed if it's the best assoc for some gene so far.
+        for phenocode, pval in variant['phenos'].iter_pvals():
+            assert isinstance(pval, float)
+            pheno = None
             for genename in genenames:
                 pheno_gene_pair = (phenocode, genename)
-                if pheno_gene_pair not in best_assoc_for_pheno_gene_pair or pheno['pval'] < best_assoc_for_pheno_gene_pair[pheno_gene_pair]['pval']:
+                if pheno_gene_pair not in best_assoc_for_pheno_gene_pair or pval < best_assoc_for_pheno_gene_pair[pheno_gene_pair]['pval']:
+                    if pheno is None:
+                        # using SNP-level cases and control counts 
+                        pheno = dict(variant['phenos'][phenocode])  # Make a copy so we don't mutate the original
+                        if 'num_cases' in variant:
+                            pheno['num_cases'] = variant['num_cases']
+                        if 'num_controls' in variant:
+                            pheno['num_controls'] = variant['num_controls']
                     best_assoc_for_pheno_gene_pair[pheno_gene_pair] = pheno
 
     phenos_in_gene: Dict[str,List[Dict[str,Any]]] = {}
@@ -122,13 +125,8 @@ def get_region_info(matrix_reader, tree_for_chrom:Dict[str,IntervalTree], region
     return phenos_in_gene
 
 @functools.lru_cache(None)
-def get_gene_intervaltree_for_chrom() -> Dict[str,IntervalTree]:
-    tree_for_chrom = {}
-    for chrom,start,end,genename in get_padded_gene_tuples():
-        if chrom not in tree_for_chrom:
-            tree_for_chrom[chrom] = IntervalTree()
-        tree_for_chrom[chrom].add(Interval(start,end,genename))
-    return tree_for_chrom
+def get_padded_gene_annotator() -> GeneAnnotator:
+    return GeneAnnotator(get_padded_gene_tuples())
 
 def order_and_truncate_phenos(phenos: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
     # Decide how many phenotypes to show.
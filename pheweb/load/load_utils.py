@@ -2,7 +2,7 @@
 from ..utils import round_sig, get_phenolist, PheWebError, fmt_seconds
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_dated_tmp_path
+from ..file_utils import get_dated_tmp_path, get_generated_path, mkdir_p
 
 import functools
 import traceback
@@ -13,9 +13,10 @@ import multiprocessing, queue
 import random
 import sys
 import heapq
+import itertools
 from pathlib import Path
 from types import GeneratorType
-from typing import List,Set,Dict,Optional,Any,Callable,Union
+from typing import List,Set,Dict,Optional,Any,Callable,Union,Iterable,Iterator
 import re
 
 
@@ -44,6 +45,7 @@ def get_maf(variant:Dict[str,Any], pheno:Dict[str,Any]) -> Optional[float]:
         maf_sigfigs = parse_utils.fields['maf']['sigfigs']  # type:ignore
         if not isinstance(maf_sigfigs, int): raise Exception()
         return round_sig(sum(mafs)/len(mafs), maf_sigfigs)
+maf_fields = ['maf', 'af', 'mac', 'ac']  # the fields that `get_maf()` reads from a variant
 
 
 def exception_printer(f):
@@ -146,6 +148,8 @@ class MaxPriorityQueue:
     def pop(self):
         _, _, item = heapq.heappop(self._q)
         return item
+    def peek_priority(self):
+        return -self._q[0][0]
     def __len__(self):
         return len(self._q)
     def pop_all(self):
@@ -153,6 +157,41 @@ class MaxPriorityQueue:
             yield self.pop()
 
 
+def sort_externally(items:Iterable[Any], key:Callable[[Any],Any], run_size:int) -> Iterator[Any]:
+    '''
+    Like `sorted(items, key=key)` (including being stable), but only holds about `run_size` items in memory.
+    Sorted runs of `run_size` items are pickled to files in `generated-by-pheweb/tmp/` and then merged with `heapq.merge()`.
+    '''
+    import pickle, tempfile
+    item_iterator = iter(items)
+    run_filepaths:List[str] = []
+    try:
+        while True:
+            run = sorted(itertools.islice(item_iterator, run_size), key=key)
+            if not run: break
+            if not run_filepaths and len(run) < run_size: # everything fit in memory
+                yield from run
+                return
+            mkdir_p(get_generated_path('tmp'))
+            fd, run_filepath = tempfile.mkstemp(prefix='sort-run-', dir=get_generated_path('tmp'))
+            run_filepaths.append(run_filepath)
+            with open(fd, 'wb') as f:
+                for i in range(0, len(run), 10_000):
+                    pickle.dump(run[i:i+10_000], f, protocol=pickle.HIGHEST_PROTOCOL)
+            del run
+        yield from heapq.merge(*[_read_sorted_run(run_filepath) for run_filepath in run_filepaths], key=key)
+    finally:
+        for run_filepath in run_filepaths:
+            if os.path.exists(run_filepath): os.remove(run_filepath)
+def _read_sorted_run(filepath:str) -> Iterator[Any]:
+    import pickle
+    with open(filepath, 'rb') as f:
+        while True:
+            try: chunk = pickle.load(f)
+            except EOFError: return
+            yield from chunk
+
+
 class Parallelizer:
     def run_multiple_tasks(self, tasks, do_multiple_tasks, cmd=None):
         '''
@@ -0,0 +1,129 @@
+
+'''
+This script converts `resources/rsids-*.tsv.gz` into `resources/rsids-*-index/`, which `annotate_sites` uses to look up rsids without re-parsing dbSNP.
+
+For each chromosome, the index has these numpy arrays, which are memory-mapped when read:
+  - `{chrom}.pos.npy`: the position of each (ref, alt, rsid), sorted like the rsids file
+  - `{chrom}.rsid.npy`: the rsid, without its "rs" prefix
+  - `{chrom}.refalt.npy`: bytes like b"A\tGCA\tT\tC...", with the ref and alt of each row
+  - `{chrom}.refalt_offsets.npy`: where the ref of each row starts in `{chrom}.refalt.npy` (and one more for the end)
+Each alt in a comma-separated alt group gets its own row, and alts of `.` are skipped, just like `add_rsids.get_rsid_reader()`.
+`index.json` has the number of rows on each chromosome and the size and mtime of the rsids file that it was made from.
+'''
+
+from ..utils import PheWebError
+from ..file_utils import get_filepath, get_tmp_path, read_maybe_gzip, make_basedir, write_json
+
+import os
+import json
+import shutil
+from array import array
+from typing import List,Dict,Any,Optional,Tuple
+
+
+def run(argv:List[str]) -> None:
+
+    if '-h' in argv or '--help' in argv:
+        print('Make an index of the rsids file so that `pheweb annotate-sites` can look up rsids without re-reading it.')
+        exit(1)
+
+    rsids_filepath = get_filepath('rsids')
+    index_dirpath = get_filepath('rsids-index', must_exist=False)
+    if is_rsids_index_up_to_date(rsids_filepath, index_dirpath):
+        print('rsids index is up-to-date!')
+    else:
+        make_rsids_index(rsids_filepath, index_dirpath)
+
+
+def _get_source_info(rsids_filepath:str) -> Dict[str,Any]:
+    stat = os.stat(rsids_filepath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def is_rsids_index_up_to_date(rsids_filepath:str, index_dirpath:str) -> bool:
+    try:
+        with open(os.path.join(index_dirpath, 'index.json')) as f:
+            return json.load(f)['source'] == _get_source_info(rsids_filepath)
+    except (FileNotFoundError, KeyError, ValueError):
+        return False
+
+def make_rsids_index(rsids_filepath:str, index_dirpath:str) -> None:
+    import numpy as np
+    from .add_rsids import get_rsid_reader
+    print('Making rsids index at {}'.format(index_dirpath))
+    tmp_dirpath = get_tmp_path(index_dirpath, reuse=True)
+    if os.path.exists(tmp_dirpath): shutil.rmtree(tmp_dirpath)  # left behind by an interrupted build
+    os.makedirs(tmp_dirpath)
+    num_rows_for_chrom:Dict[str,int] = {}
+
+    def save_chrom(chrom:str, positions:array, rsids:array, refalt:bytearray, refalt_offsets:array) -> None:
+        refalt_offsets.append(len(refalt))
+        np.save(os.path.join(tmp_dirpath, '{}.pos.npy'.format(chrom)), np.frombuffer(positions, dtype=np.int32))
+        np.save(os.path.join(tmp_dirpath, '{}.rsid.npy'.format(chrom)), np.frombuffer(rsids, dtype=np.int64))
+        np.save(os.path.join(tmp_dirpath, '{}.refalt.npy'.format(chrom)), np.frombuffer(bytes(refalt), dtype=np.uint8))
+        np.save(os.path.join(tmp_dirpath, '{}.refalt_offsets.npy'.format(chrom)), np.frombuffer(refalt_offsets, dtype=np.int64))
+        num_rows_for_chrom[chrom] = len(positions)
+
+    with read_maybe_gzip(rsids_filepath) as rsids_f:
+        chrom = None
+        positions, rsids, refalt, refalt_offsets = array('i'), array('q'), bytearray(), array('q')
+        for rsid in get_rsid_reader(rsids_f, rsids_filepath):
+            if rsid['chrom'] != chrom:
+                if chrom is not None: save_chrom(chrom, positions, rsids, refalt, refalt_offsets)
+                chrom = rsid['chrom']
+                positions, rsids, refalt, refalt_offsets = array('i'), array('q'), bytearray(), array('q')
+            if not rsid['rsid'].startswith('rs') or not rsid['rsid'][2:].isdigit(): raise PheWebError('The rsids file {!r} has the rsid {!r}, which isn\'t like "rs1234"'.format(rsids_filepath, rsid['rsid']))
+            positions.append(rsid['pos'])
+            rsids.append(int(rsid['rsid'][2:]))
+            refalt_offsets.append(len(refalt))
+            refalt += '{}\t{}'.format(rsid['ref'], rsid['alt']).encode()
+        if chrom is not None: save_chrom(chrom, positions, rsids, refalt, refalt_offsets)
+
+    write_json(filepath=os.path.join(tmp_dirpath, 'index.json'), data={'source': _get_source_info(rsids_filepath), 'num_rows': num_rows_for_chrom})
+    make_basedir(index_dirpath)
+    if os.path.exists(index_dirpath): shutil.rmtree(index_dirpath)
+    os.rename(tmp_dirpath, index_dirpath)
+
+
+class RsidsIndex:
+    '''
+    Looks up the rsids at many positions on a chromosome at once:
+
+        index = RsidsIndex(get_filepath('rsids-index'))
+        for variant, candidates in zip(variants, index.get_candidates('1', [v['pos'] for v in variants])):
+            for ref, alt, rsid in candidates: ...
+    '''
+    def __init__(self, index_dirpath:str):
+        self._dirpath = index_dirpath
+        with open(os.path.join(index_dirpath, 'index.json')) as f:
+            self._num_rows_for_chrom:Dict[str,int] = json.load(f)['num_rows']
+        self._arrays_for_chrom:Dict[str,Tuple[Any,...]] = {}
+
+    def _get_arrays(self, chrom:str) -> Optional[Tuple[Any,...]]:
+        import numpy as np
+        if chrom not in self._num_rows_for_chrom: return None
+        if chrom not in self._arrays_for_chrom:
+            self._arrays_for_chrom[chrom] = tuple(np.load(os.path.join(self._dirpath, '{}.{}.npy'.format(chrom, name)), mmap_mode='r')
+                                                  for name in ['pos', 'rsid', 'refalt', 'refalt_offsets'])
+        return self._arrays_for_chrom[chrom]
+
+    def get_candidates(self, chrom:str, positions:List[int]) -> List[List[Tuple[str,str,str]]]:
+        '''Returns a list of (ref, alt, rsid) for each position, in the order that they're in the rsids file'''
+        import numpy as np
+        arrays = self._get_arrays(chrom)
+        if arrays is None: return [[] for _ in positions]
+        index_positions, rsids, refalt, refalt_offsets = arrays
+        query = np.array(positions, dtype=np.int64)
+        starts = np.searchsorted(index_positions, query, side='left').tolist()
+        ends = np.searchsorted(index_positions, query, side='right').tolist()
+        ret:List[List[Tuple[str,str,str]]] = []
+        for start, end in zip(starts, ends):
+            if start == end:
+                ret.append([])
+                continue
+            candidates = []
+            offsets = refalt_offsets[start:end+1].tolist()
+            for row, rsid in enumerate(rsids[start:end].tolist()):
+                ref, alt = refalt[offsets[row]:offsets[row+1]].tobytes().decode().split('\t')
+                candidates.append((ref, alt, 'rs{}'.format(rsid)))
+            ret.append(candidates)
+        return ret
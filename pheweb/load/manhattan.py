@@ -1,6 +1,7 @@
 
 '''
 This script creates json files which can be used to render Manhattan plots.
+`augment-phenos` makes these files (along with the QQ plots) while it writes each pheno, so `pheweb manhattan` only needs to run to remake them.
 '''
 
 # NOTE: `qval` means `-log10(pvalue)`
@@ -8,17 +9,16 @@ This script creates json files which can be used to render Manhattan plots.
 # TODO: optimize binning for fold@20 view.
 #       - if we knew the max_qval before we started (eg, by running qq first), it would be very easy.
 #       - at present, we set qval bin size well for the [0-40] range but not for variants above that.
-# TODO: combine with QQ?
 
 # TODO: keep 10 variants unbinned from each chrom
 
 from ..utils import chrom_order
 from .. import conf
-from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
+from ..file_utils import VariantFileReader, write_json, get_pheno_filepath, get_augmented_pheno_filepath
 from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist
 
 import math, argparse
-from typing import List,Dict,Any,Tuple
+from typing import List,Dict,Any,Tuple,Optional,Callable
 Variant = Dict[str,Any]
 
 BIN_LENGTH = int(3e6)
@@ -39,32 +39,42 @@ def run(argv:List[str]) -> None:
         phenos = phenos,
     )
 
-def get_input_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath('pheno_gz', pheno['phenocode'])]
+def get_input_filepaths(pheno:dict) -> List[str]: return [get_augmented_pheno_filepath(pheno['phenocode'])]
 def get_output_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath('manhattan', pheno['phenocode'], must_exist=False)]
 
 
 def make_manhattan_json_file(pheno:Dict[str,Any]) -> None:
-    make_manhattan_json_file_explicit(get_pheno_filepath('pheno_gz', pheno['phenocode']),
+    make_manhattan_json_file_explicit(get_augmented_pheno_filepath(pheno['phenocode']),
                                       get_pheno_filepath('manhattan', pheno['phenocode'], must_exist=False))
 def make_manhattan_json_file_explicit(in_filepath:str, out_filepath:str) -> None:
-    binner = Binner()
-    with VariantFileReader(in_filepath) as variants:
+    with VariantFileReader(in_filepath, columns=Binner.columns) as variants:
+        binner = Binner(get_full_variant=variants.get_full_variant)
         for variant in variants:
             binner.process_variant(variant)
-    data = binner.get_result()
+        data = binner.get_result()
     write_json(filepath=out_filepath, data=data)
 
 
 class Binner:
-    def __init__(self):
-        self._peak_best_variant = None
-        self._peak_last_chrpos = None
+    columns = ['chrom', 'pos', 'pval']  # the fields that Binner needs from every variant
+
+    def __init__(self, get_full_variant:Optional[Callable[[Variant],Variant]] = None):
+        # If variants only have `Binner.columns`, then `get_full_variant` gets all of their fields for the ones that end up unbinned.
+        self._get_full_variant = get_full_variant
+        self._peak_best_variant:Optional[Variant] = None
+        self._peak_last_chrpos:Optional[Tuple[str,int]] = None
         self._peak_pq = MaxPriorityQueue()
         self._unbinned_variant_pq = MaxPriorityQueue()
-        self._bins = {} # like {<chrom>: {<pos // bin_length>: [{chrom, startpos, qvals}]}}
+        self._bins:Dict[int,Dict[int,Dict[str,Any]]] = {} # like {<chrom>: {<pos // bin_length>: [{chrom, startpos, qvals}]}}
         self._qval_bin_size = 0.05 # this makes 200 bins for the minimum-allowed y-axis covering 0-10
         self._num_significant_in_current_peak = 0  # num variants stronger than manhattan_peak_variant_counting_pval_threshold
-        assert conf.get_manhattan_peak_variant_counting_pval_threshold() < conf.get_manhattan_peak_pval_threshold() # counting must be stricter than peak-extending
+        # These are read once because `process_variant()` runs for every variant.
+        self._peak_pval_threshold = conf.get_manhattan_peak_pval_threshold()
+        self._peak_variant_counting_pval_threshold = conf.get_manhattan_peak_variant_counting_pval_threshold()
+        self._peak_sprawl_dist = conf.get_manhattan_peak_sprawl_dist()
+        self._peak_max_count = conf.get_manhattan_peak_max_count()
+        self._num_unbinned = conf.get_manhattan_num_unbinned()
+        assert self._peak_variant_counting_pval_threshold < self._peak_pval_threshold # counting must be stricter than peak-extending
 
     def process_variant(self, variant:Variant) -> None:
         '''
@@ -86,13 +96,13 @@ class Binner:
             elif qval > 20:
                 self._qval_bin_size = 0.1 # this makes 200-400 bins for a y-axis extending up to 20-40.
 
-        if variant['pval'] < conf.get_manhattan_peak_pval_threshold(): # part of a peak
+        if variant['pval'] < self._peak_pval_threshold: # part of a peak
             if self._peak_best_variant is None: # open a new peak
                 self._peak_best_variant = variant
                 self._peak_last_chrpos = (variant['chrom'], variant['pos'])
-                self._num_significant_in_current_peak = 1 if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold() else 0
-            elif self._peak_last_chrpos[0] == variant['chrom'] and self._peak_last_chrpos[1] + conf.get_manhattan_peak_sprawl_dist() > variant['pos']: # extend current peak
-                if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold(): self._num_significant_in_current_peak += 1
+                self._num_significant_in_current_peak = 1 if variant['pval'] < self._peak_variant_counting_pval_threshold else 0
+            elif self._peak_last_chrpos is not None and self._peak_last_chrpos[0] == variant['chrom'] and self._peak_last_chrpos[1] + self._peak_sprawl_dist > variant['pos']: # extend current peak
+                if variant['pval'] < self._peak_variant_counting_pval_threshold: self._num_significant_in_current_peak += 1
                 self._peak_last_chrpos = (variant['chrom'], variant['pos'])
                 if variant['pval'] >= self._peak_best_variant['pval']:
                     self._maybe_bin_variant(variant)
@@ -101,7 +111,7 @@ class Binner:
                     self._peak_best_variant = variant
             else: # close old peak and open new peak
                 self._peak_best_variant['num_significant_in_peak'] = self._num_significant_in_current_peak
-                self._num_significant_in_current_peak = 1 if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold() else 0
+                self._num_significant_in_current_peak = 1 if variant['pval'] < self._peak_variant_counting_pval_threshold else 0
                 self._maybe_peak_variant(self._peak_best_variant)
                 self._peak_best_variant = variant
                 self._peak_last_chrpos = (variant['chrom'], variant['pos'])
@@ -110,11 +120,11 @@ class Binner:
 
     def _maybe_peak_variant(self, variant:Variant) -> None:
         self._peak_pq.add_and_keep_size(variant, variant['pval'],
-                                        size=conf.get_manhattan_peak_max_count(),
+                                        size=self._peak_max_count,
                                         popped_callback=self._maybe_bin_variant)
     def _maybe_bin_variant(self, variant:Variant) -> None:
         self._unbinned_variant_pq.add_and_keep_size(variant, variant['pval'],
-                                                    size=conf.get_manhattan_num_unbinned(),
+                                                    size=self._num_unbinned,
                                                     popped_callback=self._bin_variant)
     def _bin_variant(self, variant:Variant) -> None:
         chrom_idx = chrom_order[variant['chrom']]
@@ -138,6 +148,8 @@ class Binner:
         for peak in peaks: peak['peak'] = True
         unbinned_variants = list(self._unbinned_variant_pq.pop_all())
         unbinned_variants = sorted(unbinned_variants + peaks, key=(lambda variant: variant['pval']))
+        if self._get_full_variant is not None:
+            unbinned_variants = [self._get_full_variant(variant) for variant in unbinned_variants]
 
         # unroll dict-of-dict-of-array `bins` into array `variant_bins`
         variant_bins = []
@@ -1,21 +1,34 @@
 
-# TODO: Parallelize by chromosome.
-#  Spawn a pheweb process to do each chromosome.  Each one must do:
-#  + For every `pheno_gz/*.gz` and `sites/sites.tsv`, find the byte offset to the block that begins our chromosome.
-#  + Now cffi down into a function just like our normal one, but which starts at that offset, discards variants until it hits the target chromosome, merges, and then exits.
-#  + Don't append an empty block in `BgzipWriter:close()`.
-#  When all the child processes are done, the main thread needs to concatenate all the single-chrom matrix files and then append an empty bgzip block to signal EOF.
+'''
+This script joins `sites/sites.tsv` with every `pheno_gz/*.gz` to make `matrix.tsv.gz`, which has one row per site and a group of columns for each phenotype.
 
+Each chromosome is joined in a separate process, which seeks to it in `sites.tsv` (with its chromosome index) and in each `pheno_gz/*.gz` (with its `.tbi`).
+Each process writes a BGZF fragment without the empty EOF block, so the fragments can be concatenated in chromosome order and then get a single EOF block.
+If some `pheno_gz/*.gz` doesn't have an up-to-date `.tbi` (which `pheweb augment-phenos` makes), the whole matrix is joined in one process instead.
 
+If `sites.tsv` hasn't changed since the old matrix was made, the old matrix is joined instead of `sites.tsv`.
+Then the columns of phenotypes whose `pheno_gz/*.gz` hasn't changed are copied from it, so only new (or changed) phenotypes are read,
+and phenotypes that were removed from `pheno-list.json` are dropped.
+
+Each process only opens `matrix_max_open_files` files (default 1000).  If there are more new phenotypes than that,
+blocks of them are first joined with `sites.tsv` into sparse sub-matrices (one file per chromosome) in parallel, and blocks of those into bigger ones, etc,
+and then the final join reads the sub-matrices' columns like it reads the old matrix's columns.
+
+Each process of the final join also indexes its fragment, and those indexes are concatenated into `matrix.tsv.gz.cpra`,
+which maps each position to the virtual offset of its first line so that `/variant/<query>` doesn't need tabix (see `file_utils.get_cpra_index()`).
+'''
+
+from .. import conf
 from ..utils import get_phenolist, PheWebError
-from ..file_utils import MatrixReader, get_tmp_path, get_filepath, get_pheno_filepath
-from .load_utils import mtime
+from ..file_utils import read_matrix_header, get_tmp_path, get_filepath, get_pheno_filepath, get_chrom_index, make_chrom_index, get_tabix_chrom_offsets, get_cpra_index, make_cpra_index, write_cpra_index, _bgzf_eof_block
+from .load_utils import mtime, Parallelizer
 from .cffi._x import ffi, lib
 
 import os
 import glob
+import shutil
 import pysam
-from typing import List
+from typing import List,Dict,Any,Optional,Tuple
 
 
 def clear_out_junk() -> None:
@@ -27,32 +40,194 @@ def clear_out_junk() -> None:
             print("Removing {} to help matrix glob".format(filepath))
             os.remove(filepath)
 
-def should_run() -> bool:
+def get_pheno_columns(colnames:List[str]) -> Dict[str,int]:
+    '''Returns the first column of each phenotype in the header of `matrix.tsv.gz`'''
+    pheno_columns:Dict[str,int] = {}
+    for colnum, colname in enumerate(colnames):
+        if '@' in colname:
+            pheno_columns.setdefault(colname.split('@', 1)[1], colnum)
+    return pheno_columns
+
+def get_old_columns(phenocodes:List[str]) -> Optional[Dict[str,int]]:
+    '''
+    Returns the first column in the old matrix of each phenotype whose columns can be copied from it,
+    or `None` if the old matrix is up-to-date.
+    '''
     sites_filepath = get_filepath('sites')
     matrix_gz_filepath = get_filepath('matrix', must_exist=False)
 
-    if not os.path.exists(matrix_gz_filepath): return True
-
-    # If the matrix's columns don't match the phenos in pheno-list, rebuild.
-    cur_phenocodes = set(pheno['phenocode'] for pheno in get_phenolist())
+    if not os.path.exists(matrix_gz_filepath): return {}
     try:
-        matrix_phenocodes = set(MatrixReader().get_phenocodes())
+        matrix_is_sparse, matrix_colnames = read_matrix_header(matrix_gz_filepath)
+        matrix_pheno_columns = get_pheno_columns(matrix_colnames)
     except Exception:
-        return True # if something broke, let's just rebuild the matrix.
-    if matrix_phenocodes != cur_phenocodes:
-        print('re-running because cur matrix has wrong phenos.')
-        print('- phenos in pheno-list.json but not matrix.tsv.gz:', ', '.join(repr(p) for p in cur_phenocodes - matrix_phenocodes))
-        print('- phenos in matrix.tsv.gz but not pheno-list.json:', ', '.join(repr(p) for p in matrix_phenocodes - cur_phenocodes))
-        return True
-
-    # If pheno_gz or sites.tsv are newer than matrix, rebuild.
-    infilepaths = [get_pheno_filepath('pheno_gz', phenocode) for phenocode in cur_phenocodes] + [sites_filepath]
-    infile_modtime = max(mtime(filepath) for filepath in infilepaths)
-    if infile_modtime > mtime(matrix_gz_filepath):
-        print('rerunning because some input files are newer than matrix.tsv.gz')
-        return True
-
-    return False
+        return {} # if something broke, let's just rebuild the matrix.
+    if mtime(sites_filepath) > mtime(matrix_gz_filepath):
+        print('rebuilding because sites.tsv is newer than matrix.tsv.gz')
+        return {}
+
+    # Phenos whose pheno_gz is newer than the matrix must be re-read.
+    cur_phenocodes = set(phenocodes)
+    old_columns = {phenocode: column for phenocode, column in matrix_pheno_columns.items()
+                   if phenocode in cur_phenocodes and mtime(get_pheno_filepath('pheno_gz', phenocode)) <= mtime(matrix_gz_filepath)}
+    if len(old_columns) == len(phenocodes) == len(matrix_pheno_columns):
+        if matrix_is_sparse == conf.should_use_sparse_matrix(): return None
+        print('rewriting matrix.tsv.gz because `sparse_matrix` changed')
+        return old_columns
+    print('updating matrix.tsv.gz:')
+    print('- reusing {} phenos'.format(len(old_columns)))
+    print('- reading {} new or changed phenos:'.format(len(phenocodes) - len(old_columns)), ', '.join(repr(p) for p in phenocodes if p not in old_columns))
+    print('- dropping {} phenos:'.format(len(set(matrix_pheno_columns) - cur_phenocodes)), ', '.join(repr(p) for p in matrix_pheno_columns if p not in cur_phenocodes))
+    return old_columns
+
+def has_up_to_date_tbi(filepath:str) -> bool:
+    tbi_filepath = filepath + '.tbi'
+    return os.path.exists(tbi_filepath) and mtime(tbi_filepath) >= mtime(filepath)
+
+def get_seek_offsets(base_filepath:str, pheno_gz_filepaths:List[str]) -> Optional[Dict[str,Dict[str,int]]]:
+    '''Returns the virtual offset of each chromosome in `sites.tsv`, `base_filepath` and each of `pheno_gz_filepaths`, or `None` if one of them can't be seeked into'''
+    sites_filepath = get_filepath('sites')
+    chrom_index = get_chrom_index(sites_filepath)
+    assert chrom_index is not None
+    seek_offsets = {sites_filepath: {chrom: offset << 16 for chrom, offset, num_variants in chrom_index}}  # `sites.tsv` isn't compressed, so its virtual offsets are just shifted
+    for filepath in pheno_gz_filepaths + ([] if base_filepath == sites_filepath else [base_filepath]):
+        if not has_up_to_date_tbi(filepath):
+            print('{} has no up-to-date .tbi, so the matrix won\'t be made one chromosome at a time'.format(filepath))
+            return None
+        seek_offsets[filepath] = get_tabix_chrom_offsets(filepath)
+    return seek_offsets
+
+def get_tasks(chroms:List[Tuple[str,int]], bases:List[Dict[str,str]], phenos:List[Dict[str,Any]], seek_offsets:Optional[Dict[str,Dict[str,int]]],
+              sparse:bool, out_filepaths:Dict[str,str]) -> List[Dict[str,Any]]:
+    '''
+    Returns a task for each chromosome that merges the phenotypes in `phenos` into `out_filepaths[chrom]`.
+    Each base is like {chrom: filepath}, and the first one is `sites.tsv` or the old matrix.  The rest are matrices of some phenotypes that only have `chrom`.
+    Each phenotype is like {'pheno_gz_filepath': filepath} or like {'base': 1, 'column': 6} (ie, the columns of the phenotype in a base, starting at column 6).
+    '''
+    return [{'chrom': chrom, 'num_variants': num_variants,
+             'base_filepaths': [base[chrom] for base in bases],
+             # The first base is seeked into, and the others start right after their header
+             'base_offsets': [seek_offsets[bases[0][chrom]][chrom] if seek_offsets is not None else 0] + [-1] * (len(bases) - 1),
+             'pheno_gz_filepaths': [pheno.get('pheno_gz_filepath', '') for pheno in phenos],
+             'pheno_gz_offsets': [seek_offsets[pheno['pheno_gz_filepath']].get(chrom, -1) if seek_offsets is not None and 'pheno_gz_filepath' in pheno else 0
+                                  for pheno in phenos],
+             'old_bases': [pheno.get('base', -1) for pheno in phenos],
+             'old_columns': [pheno.get('column', -1) for pheno in phenos],
+             'sparse': sparse, 'write_header': i == 0, 'write_eof_block': chrom == '', 'out_filepath': out_filepaths[chrom], 'make_cpra_index': False}
+            for i, (chrom, num_variants) in enumerate(chroms)]
+
+def run_tasks(tasks:List[Dict[str,Any]]) -> None:
+    num_threads = conf.get_bgzf_compression_threads() if min(conf.get_num_procs('matrix'), len(tasks)) == 1 else 1
+    for task in tasks: task['num_threads'] = num_threads
+    if len(tasks) == 1:
+        make_matrix(tasks[0])
+    else:
+        biggest_first = sorted(tasks, key=lambda task: -task['num_variants'])
+        for ret in Parallelizer().run_single_tasks(biggest_first, make_matrix, cmd='matrix'): pass
+
+def make_matrix(task:Dict[str,Any]) -> None:
+    # the `char[]`s must be kept alive until `lib.cffi_make_matrix()` returns
+    base_filepaths = [ffi.new('char[]', filepath.encode('utf8')) for filepath in task['base_filepaths']]
+    pheno_gz_filepaths = [ffi.new('char[]', filepath.encode('utf8')) for filepath in task['pheno_gz_filepaths']]
+    ret = lib.cffi_make_matrix(ffi.new('char*[]', base_filepaths), ffi.new('int64_t[]', task['base_offsets']), len(base_filepaths),
+                               ffi.new('char*[]', pheno_gz_filepaths), ffi.new('int64_t[]', task['pheno_gz_offsets']),
+                               ffi.new('int[]', task['old_bases']), ffi.new('int[]', task['old_columns']), len(pheno_gz_filepaths),
+                               task['chrom'].encode('utf8'), task['out_filepath'].encode('utf8'),
+                               task['sparse'], task['write_header'], task['write_eof_block'],
+                               task['num_threads'], conf.get_bgzf_compression_level())
+    ret_bytes = ffi.string(ret, maxlen=1000)
+    if ret_bytes != b'ok':
+        raise PheWebError('The portion of `pheweb matrix` written in c++/cffi failed with the message ' + repr(ret_bytes))
+    if task['make_cpra_index']:
+        make_cpra_index(task['out_filepath'])
+
+def build_matrix(base_filepath:str, pheno_gz_filepaths:List[str], old_columns:List[int], out_filepath:str) -> None:
+    '''
+    Writes the matrix of the phenotypes in `pheno_gz_filepaths` to `out_filepath`.
+    If `old_columns[i]` isn't -1, then the i-th phenotype is copied from the old matrix `base_filepath`, starting at column `old_columns[i]`.
+
+    If there are more new phenotypes than each process can read at once (`matrix_max_open_files`),
+    then blocks of them are merged into sub-matrices in parallel (and blocks of those into bigger ones, etc) before the final merge.
+    Sub-matrices are sparse, and have a separate file for each chromosome.
+    '''
+    sites_filepath = get_filepath('sites')
+    chrom_index = get_chrom_index(sites_filepath)
+    if chrom_index is None:
+        make_chrom_index(sites_filepath)  # `sites.tsv` was made by an old version of PheWeb
+        chrom_index = get_chrom_index(sites_filepath)
+        assert chrom_index is not None
+    new_pheno_gz_filepaths = [filepath for filepath, old_column in zip(pheno_gz_filepaths, old_columns) if old_column < 0]
+    seek_offsets = get_seek_offsets(base_filepath, new_pheno_gz_filepaths)
+    chroms = [(chrom, num_variants) for chrom, offset, num_variants in chrom_index] if seek_offsets is not None else [('', 0)]
+    if seek_offsets is not None and base_filepath != sites_filepath and set(seek_offsets[base_filepath]) != set(chrom for chrom, _ in chroms):
+        raise PheWebError("{!r} doesn't have the same chromosomes as {!r}".format(base_filepath, sites_filepath))
+    def get_fragment_filepaths(name:str) -> Dict[str,str]:
+        return {chrom: get_tmp_path('matrix-{}{}.gz'.format(name, '-chrom-'+chrom if chrom else '')) for chrom, _ in chroms}
+
+    # Each source is a pheno_gz file, or a sub-matrix (with a file for each chromosome) of the phenotypes of several sources.
+    sources:List[Dict[str,Any]] = [{'pheno_gz_filepath': filepath, 'phenocodes': [os.path.basename(filepath)[:-3]]} for filepath in new_pheno_gz_filepaths]
+    max_sources = conf.get_matrix_max_open_files() - 1  # each process also reads `sites.tsv` or the old matrix
+    if max_sources < 2: raise PheWebError('`matrix_max_open_files` must be at least 3, but it is {}'.format(max_sources + 1))
+    level = 0
+    while len(sources) > max_sources:
+        level += 1
+        blocks = [sources[idx:idx+max_sources] for idx in range(0, len(sources), max_sources)]
+        print('merging {} sources into {} sub-matrices'.format(len(sources), len(blocks)))
+        sub_matrices:List[Dict[str,Any]] = []
+        tasks:List[Dict[str,Any]] = []
+        for block_num, block in enumerate(blocks):
+            sub_matrix:Dict[str,Any] = {'fragment_filepaths': get_fragment_filepaths('level{}-block{}'.format(level, block_num)),
+                                        'phenocodes': [phenocode for source in block for phenocode in source['phenocodes']]}
+            bases = [{chrom: sites_filepath for chrom, _ in chroms}] + [source['fragment_filepaths'] for source in block if 'fragment_filepaths' in source]
+            block_tasks = get_tasks(chroms, bases, get_phenos(block, first_base=1), seek_offsets, True, sub_matrix['fragment_filepaths'])
+            for task in block_tasks: task['write_header'] = True  # every fragment of a sub-matrix needs its header, because it's read by itself
+            tasks.extend(block_tasks)
+            sub_matrices.append(sub_matrix)
+        run_tasks(tasks)
+        for source in sources:
+            for filepath in source.get('fragment_filepaths', {}).values(): os.remove(filepath)
+        for sub_matrix in sub_matrices:
+            sub_matrix['columns'] = get_pheno_columns(read_matrix_header(sub_matrix['fragment_filepaths'][chroms[0][0]])[1])
+        sources = sub_matrices
+
+    # The final merge copies the old columns from the old matrix (base 0) and everything else from `sources`
+    phenos_by_phenocode = {phenocode: pheno for phenocode, pheno in zip((phenocode for source in sources for phenocode in source['phenocodes']), get_phenos(sources, first_base=1))}
+    phenos = [{'base': 0, 'column': old_column} if old_column >= 0 else phenos_by_phenocode[os.path.basename(filepath)[:-3]]
+              for filepath, old_column in zip(pheno_gz_filepaths, old_columns)]
+    bases = [{chrom: base_filepath for chrom, _ in chroms}] + [source['fragment_filepaths'] for source in sources if 'fragment_filepaths' in source]
+    out_filepaths = get_fragment_filepaths('final') if chroms != [('', 0)] else {'': out_filepath}
+    tasks = get_tasks(chroms, bases, phenos, seek_offsets, conf.should_use_sparse_matrix(), out_filepaths)
+    for task in tasks: task['make_cpra_index'] = True  # each process indexes its own fragment
+    run_tasks(tasks)
+    for source in sources:
+        for filepath in source.get('fragment_filepaths', {}).values(): os.remove(filepath)
+    if chroms != [('', 0)]:
+        import numpy as np
+        cpra_keys, cpra_offsets = [], []
+        with open(out_filepath, 'wb') as out_f:
+            for chrom, _ in chroms:
+                keys, offsets = np.load(out_filepaths[chrom] + '.cpra')
+                cpra_keys.append(keys)
+                cpra_offsets.append(offsets + (out_f.tell() << 16))  # the virtual offsets of the fragment move by its position in the matrix
+                with open(out_filepaths[chrom], 'rb') as f:
+                    shutil.copyfileobj(f, out_f)
+            out_f.write(_bgzf_eof_block)
+        write_cpra_index(out_filepath, np.concatenate(cpra_keys), np.concatenate(cpra_offsets))
+        for filepath in out_filepaths.values():
+            os.remove(filepath)
+            os.remove(filepath + '.cpra')
+
+def get_phenos(sources:List[Dict[str,Any]], first_base:int) -> List[Dict[str,Any]]:
+    '''Returns the phenotypes of `sources`, in order, for `get_tasks()`, if the sub-matrices among them are bases `first_base`, `first_base+1`, etc'''
+    phenos:List[Dict[str,Any]] = []
+    base = first_base
+    for source in sources:
+        if 'pheno_gz_filepath' in source:
+            phenos.append({'pheno_gz_filepath': source['pheno_gz_filepath']})
+        else:
+            phenos.extend({'base': base, 'column': source['columns'][phenocode]} for phenocode in source['phenocodes'])
+            base += 1
+    return phenos
 
 def run(argv:List[str]) -> None:
 
@@ -61,24 +236,25 @@ def run(argv:List[str]) -> None:
         exit(1)
 
     matrix_gz_filepath = get_filepath('matrix', must_exist=False)
-    if should_run():
+    old_columns_for_pheno = get_old_columns([pheno['phenocode'] for pheno in get_phenolist()])
+    if old_columns_for_pheno is not None:
         clear_out_junk()
 
         sites_filepath = get_filepath('sites')
-        pheno_gz_glob = get_filepath('pheno_gz')+'/*.gz'
+        pheno_gz_filepaths = sorted(glob.glob(get_filepath('pheno_gz')+'/*.gz'))
         matrix_gz_tmp_filepath = get_tmp_path(matrix_gz_filepath)
-
-        # we don't need `ffi.new('char[]', ...)` because args are `const`
-        ret = lib.cffi_make_matrix(sites_filepath.encode('utf8'),
-                                   pheno_gz_glob.encode('utf8'),
-                                   matrix_gz_tmp_filepath.encode('utf8'))
-        ret_bytes = ffi.string(ret, maxlen=1000)
-        if ret_bytes != b'ok':
-            raise PheWebError('The portion of `pheweb matrix` written in c++/cffi failed with the message ' + repr(ret_bytes))
+        old_columns = [old_columns_for_pheno.get(os.path.basename(filepath)[:-3], -1) for filepath in pheno_gz_filepaths]
+        base_filepath = matrix_gz_filepath if old_columns_for_pheno else sites_filepath
+        build_matrix(base_filepath, pheno_gz_filepaths, old_columns, matrix_gz_tmp_filepath)
         os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
+        os.rename(matrix_gz_tmp_filepath + '.cpra', matrix_gz_filepath + '.cpra')
     else:
         print('matrix is up-to-date!')
 
+    if get_cpra_index(matrix_gz_filepath) is None:
+        print('making the cpra index of matrix')  # `matrix.tsv.gz` was made by an old version of PheWeb
+        make_cpra_index(matrix_gz_filepath)
+
     matrix_tbi_filepath = matrix_gz_filepath + '.tbi'
     if not os.path.exists(matrix_tbi_filepath) or mtime(matrix_tbi_filepath) < mtime(matrix_gz_filepath):
         print('tabixing matrix')
@@ -1,29 +1,42 @@
 
 from ..utils import get_phenolist, PheWebError
 from .. import conf
-from ..file_utils import VariantFileWriter, write_json, get_generated_path, get_filepath, get_pheno_filepath
+from ..file_utils import VariantFileReader, VariantFileWriter, write_json, get_generated_path, get_filepath, get_pheno_filepath, get_tmp_path, is_bgzf, get_bgzf_shards, write_chrom_index
 from .read_input_file import PhenoReader
-from .load_utils import parallelize_per_pheno, indent, get_phenos_subset
+from .load_utils import parallelize_per_pheno, PerPhenoParallelizer, Parallelizer, indent, get_phenos_subset
 
+import os
 import itertools
+import functools
 import argparse
-from typing import List,Dict,Any,Iterator
+from boltons.fileutils import AtomicSaver
+from typing import List,Dict,Any,Iterator,Optional
 
 
 def run(argv:List[str]) -> None:
     parser = argparse.ArgumentParser(description="import input files into a nice format")
     parser.add_argument('--phenos', help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)")
+    parser.add_argument('--sort', action='store_true', help="Sort variants (using temporary files in generated-by-pheweb/tmp/) instead of requiring input files to be sorted by chromosome and position")
     args = parser.parse_args(argv)
 
     phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
 
+    # Large phenotypes get split into shards that are parsed in parallel, and everything else gets one process per phenotype.
+    shards_for_phenocode = {}
+    for pheno in ([] if args.sort else phenos):
+        if PerPhenoParallelizer().should_process_pheno(pheno, get_input_filepaths, get_output_filepaths):
+            shards = get_shards(pheno)
+            if shards is not None: shards_for_phenocode[pheno['phenocode']] = shards
+
     results_by_phenocode = parallelize_per_pheno(
         get_input_filepaths = get_input_filepaths,
         get_output_filepaths = get_output_filepaths,
-        convert = convert,
+        convert = functools.partial(convert, sort=args.sort),
         cmd = 'parse-input-files',
-        phenos = phenos,
+        phenos = [pheno for pheno in phenos if pheno['phenocode'] not in shards_for_phenocode],
     )
+    if shards_for_phenocode:
+        results_by_phenocode.update(convert_in_shards([pheno for pheno in phenos if pheno['phenocode'] in shards_for_phenocode], shards_for_phenocode))
 
     failed_results = {phenocode:value for phenocode,value in results_by_phenocode.items() if not value['succeeded']}
     if failed_results:
@@ -59,11 +72,11 @@ def write_failures(filepath:str, failed_results:Dict[str,Any]):
             f.write('=== Error for phenocode {} ===\n{}\n\n'.format(phenocode, d['exception_tb']))
 
 
-def convert(pheno:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
+def convert(pheno:Dict[str,Any], sort:bool = False) -> Iterator[Dict[str,Any]]:
     # suppress Exceptions so that we can report back on which phenotypes succeeded and which didn't.
     try:
-        with VariantFileWriter(get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False)) as writer:
-            pheno_reader = PhenoReader(pheno, minimum_maf=conf.get_assoc_min_maf())
+        with VariantFileWriter(get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False), binary=conf.should_use_binary_variant_files(), chrom_index=True) as writer:
+            pheno_reader = PhenoReader(pheno, minimum_maf=conf.get_assoc_min_maf(), sort=sort)
             variants = pheno_reader.get_variants()
             debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
             if debugging_limit_num_variants: variants = itertools.islice(variants, 0, debugging_limit_num_variants)
@@ -80,3 +93,115 @@ def convert(pheno:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
         yield {"succeeded": False, "exception_str": str(exc), "exception_tb": traceback.format_exc()}
     else:
         yield {"succeeded": True}
+
+
+def get_shards(pheno:Dict[str,Any]) -> Optional[List[Dict[str,Any]]]:
+    '''
+    Returns the shards (see `AssocFileReader`) to split this phenotype into, or `None` if it should be parsed all at once.
+    Only phenotypes with a single association file that is larger than `assoc_parse_shard_size` get split.
+    That file is split by chromosome if it is tabix-indexed, or else into byte ranges if it is BGZF.
+    '''
+    shard_size = conf.get_assoc_parse_shard_size()
+    if not shard_size or conf.get_debugging_limit_num_variants() or len(pheno['assoc_files']) != 1: return None
+    filepath = pheno['assoc_files'][0]
+    if os.path.getsize(filepath) <= shard_size: return None
+    if os.path.exists(filepath + '.tbi'):
+        import pysam
+        with pysam.TabixFile(filepath) as tabix_file:
+            shards = [{'contig': contig} for contig in tabix_file.contigs]
+    elif is_bgzf(filepath):
+        shards = get_bgzf_shards(filepath, shard_size)
+    else:
+        return None
+    return shards if len(shards) > 1 else None
+
+def convert_in_shards(phenos:List[Dict[str,Any]], shards_for_phenocode:Dict[str,List[Dict[str,Any]]]) -> Dict[str,Dict[str,Any]]:
+    '''
+    Parses every shard of every phenotype in parallel, and then concatenates the shards of each phenotype in order.
+    Returns results like `convert()`, with the first failure among each phenotype's shards.
+    '''
+    tasks:List[Dict[str,Any]] = []
+    for pheno in phenos:
+        for shard_idx, shard in enumerate(shards_for_phenocode[pheno['phenocode']]):
+            tmp_filepath = get_tmp_path('parsed-{}-shard{}'.format(pheno['phenocode'], shard_idx))
+            tasks.append({'pheno': pheno, 'shard': shard, 'shard_idx': shard_idx, 'tmp_filepath': tmp_filepath})
+    print("Processing {} large phenos in {} shards".format(len(phenos), len(tasks)))
+    shard_results: Dict[str,Dict[int,Dict[str,Any]]] = {pheno['phenocode']: {} for pheno in phenos}
+    for ret in Parallelizer().run_single_tasks(tasks, convert_shard, cmd='parse-input-files'):
+        shard_results[ret['task']['pheno']['phenocode']][ret['task']['shard_idx']] = ret['value']
+
+    results_by_phenocode = {}
+    for pheno in phenos:
+        pheno_tasks = [task for task in tasks if task['pheno']['phenocode'] == pheno['phenocode']]
+        results = [shard_results[pheno['phenocode']][task['shard_idx']] for task in pheno_tasks]
+        failed_results = [result for result in results if not result['succeeded']]
+        if failed_results:
+            results_by_phenocode[pheno['phenocode']] = failed_results[0]
+        else:
+            try:
+                concatenate_shards([task['tmp_filepath'] for task in pheno_tasks], get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False))
+            except Exception as exc:
+                import traceback
+                results_by_phenocode[pheno['phenocode']] = {"succeeded": False, "exception_str": str(exc), "exception_tb": traceback.format_exc()}
+            else:
+                results_by_phenocode[pheno['phenocode']] = {"succeeded": True}
+        for task in pheno_tasks:
+            if os.path.exists(task['tmp_filepath']): os.remove(task['tmp_filepath'])
+    return results_by_phenocode
+
+def convert_shard(task:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
+    # suppress Exceptions so that we can report back on which phenotypes succeeded and which didn't.
+    try:
+        with VariantFileWriter(task['tmp_filepath'], binary=conf.should_use_binary_variant_files()) as writer:
+            pheno_reader = PhenoReader(task['pheno'], minimum_maf=conf.get_assoc_min_maf(), shard=task['shard'])
+            writer.write_all(pheno_reader.get_variants())
+    except Exception as exc:
+        import traceback
+        yield {"succeeded": False, "exception_str": str(exc), "exception_tb": traceback.format_exc()}
+    else:
+        yield {"succeeded": True}
+
+def concatenate_shards(shard_filepaths:List[str], out_filepath:str) -> None:
+    '''
+    Concatenates the parsed files of a phenotype's shards without re-parsing them.
+    The first four columns (chrom, pos, ref, alt) of each line are passed through `PhenoReader._order_refalt_lexicographically()`
+    so that the ordering is checked across shard boundaries and tied variants that span a boundary are sorted.
+    '''
+    if conf.should_use_binary_variant_files():
+        # Binary files can't be concatenated line-by-line, but they are cheap to read.
+        def get_variants() -> Iterator[Dict[str,Any]]:
+            for shard_filepath in shard_filepaths:
+                if os.path.getsize(shard_filepath) == 0: continue # this shard had no variants
+                with VariantFileReader(shard_filepath) as reader:
+                    yield from reader
+        with VariantFileWriter(out_filepath, binary=True, chrom_index=True) as writer:
+            writer.write_all(PhenoReader._order_refalt_lexicographically(get_variants()))
+        return
+
+    header:Optional[str] = None
+    def get_lines() -> Iterator[Dict[str,Any]]:
+        nonlocal header
+        for shard_filepath in shard_filepaths:
+            with open(shard_filepath) as f:
+                shard_header = next(f, None)
+                if shard_header is None: continue # this shard had no variants
+                if header is None:
+                    header = shard_header
+                    assert header.startswith('chrom\tpos\tref\talt\t'), header
+                elif shard_header != header:
+                    raise PheWebError("Shards of one file were parsed with different columns: {!r} and {!r}".format(header, shard_header))
+                for line in f:
+                    chrom, pos, ref, alt, _ = line.split('\t', 4)
+                    yield {'chrom': chrom, 'pos': int(pos), 'ref': ref, 'alt': alt, 'line': line}
+    chrom_index:List[List[Any]] = []  # see `VariantFileWriter(..., chrom_index=True)`
+    with AtomicSaver(out_filepath, text_mode=True, part_file=get_tmp_path(out_filepath), overwrite_part=True, rm_part_on_exc=False) as f:
+        wrote_header = False
+        for v in PhenoReader._order_refalt_lexicographically(get_lines()):
+            if not wrote_header:
+                f.write(header)
+                wrote_header = True
+            if not chrom_index or v['chrom'] != chrom_index[-1][0]:
+                chrom_index.append([v['chrom'], f.tell(), 0])
+            chrom_index[-1][2] += 1
+            f.write(v['line'])
+    write_chrom_index(out_filepath, chrom_index)
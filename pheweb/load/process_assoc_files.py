@@ -14,15 +14,12 @@ phenolist verify
 parse_input_files
 sites
 make_gene_aliases_sqlite3
-add_rsids
-add_genes
+annotate_sites
 make_cpras_rsids_sqlite3
 augment_phenos
 matrix
 gather_pvalues_for_each_gene
-manhattan
 top_hits
-qq
 phenotypes
 pheno_correlation
 '''.split('\n')
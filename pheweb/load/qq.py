@@ -1,24 +1,25 @@
 
 '''
 This script creates json files which can be used to render QQ plots.
+`augment-phenos` makes these files (along with the manhattan plots) while it writes each pheno, so `pheweb qq` only needs to run to remake them.
 '''
 
-# TODO: share the `VariantFileReader` with `manhattan.py`.
 # TODO: make gc_lambda for maf strata, and show them if they're >1.1?
 # TODO: copy some changes from <https://github.com/statgen/encore/blob/master/plot-epacts-output/make_qq_json.py>
 
 # TODO: Reduce memory usage by binning the (twosigfigs(maf), rounded(neglogpval,2)) for all variants with neglogpval<2.
-#       If manhattan and qq were computed together, we could re-use some information from the first pass.
+#       Now that `augment-phenos` computes manhattan and qq together, we could re-use some information from the `Binner`.
 
 
 # NOTE: `qval` means `-log10(pvalue)`
 
 from ..utils import round_sig, approx_equal, get_phenolist, PheWebError
-from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
-from .load_utils import get_maf, parallelize_per_pheno, get_phenos_subset
+from ..file_utils import VariantFileReader, write_json, get_pheno_filepath, get_augmented_pheno_filepath
+from .load_utils import get_maf, maf_fields, parallelize_per_pheno, get_phenos_subset
 
-from typing import Dict,Any,List,Iterator,Set,Tuple
-import argparse, itertools
+from typing import Dict,Any,List,Iterator,Set,Tuple,Optional
+from array import array
+import argparse
 import boltons.mathutils
 import boltons.iterutils
 import math
@@ -44,49 +45,70 @@ def run(argv:List[str]) -> None:
         phenos = phenos,
     )
 
-def get_input_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath('pheno_gz', pheno['phenocode'])]
+def get_input_filepaths(pheno:dict) -> List[str]: return [get_augmented_pheno_filepath(pheno['phenocode'])]
 def get_output_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath('qq', pheno['phenocode'], must_exist=False)]
 
 def make_json_file(pheno:Dict[str,Any]) -> None:
     make_json_file_explicit(
-        get_pheno_filepath('pheno_gz', pheno['phenocode']),
+        get_augmented_pheno_filepath(pheno['phenocode']),
         get_pheno_filepath('qq', pheno['phenocode'], must_exist=False),
         pheno
     )
 
 def make_json_file_explicit(in_filepath:str, out_filepath:str, pheno:Dict[str,Any]) -> None:
-    # Store all variants in a dataframe with columns (qval, maf) or just (qval)
-    variants = get_variants_df(in_filepath, pheno)
-    rv: Dict[str,Any] = {}
-    if 'maf' in variants.dtype.fields:  # type:ignore
-        rv['by_maf'] = make_qq_stratified(variants)
-        rv['overall'] = make_qq_unstratified(variants, include_qq=False)  # Must run AFTER `_stratified()`, because it sorts by qval, which could bias the maf_range strata.
-        rv['ci'] = list(get_confidence_intervals(len(variants) / len(rv['by_maf'])))
-    else:
-        rv['overall'] = make_qq_unstratified(variants, include_qq=True)
-        rv['ci'] = list(get_confidence_intervals(len(variants)))
-    write_json(filepath=out_filepath, data=rv)
-
-def get_variants_df(in_filepath:str, pheno:Dict[str,Any]) -> np.ndarray:
-    # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
-    # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
-    # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
-    # And anyways pd.DataFrame() allows passing in an iterator, but then it just calls list() on it, so it temporarily uses python's list overhead.
-    # Instead, I'm using np.fromiter() to make a "structured array".
-    with VariantFileReader(in_filepath) as variant_dicts:
-        try: first_variant = next(iter(variant_dicts))
-        except StopIteration: raise PheWebError("No variants found in {}".format(in_filepath))
-    has_maf = get_maf(first_variant, pheno) is not None
-    if has_maf:
-        return np.fromiter(get_maf_qval_pairs(in_filepath, pheno), dtype=[('maf',np.float32),('qval',np.float32)])
-    else:
-        return np.fromiter((qval for maf,qval in get_maf_qval_pairs(in_filepath, pheno)), dtype=[('qval',np.float32)])
-def get_maf_qval_pairs(in_filepath:str, pheno:Dict[str,Any]) -> Iterator[Tuple[float,float]]:
-    with VariantFileReader(in_filepath) as variant_dicts:
-        for v in variant_dicts:
-            maf: float = get_maf(v, pheno) or 0
-            qval: float = 1000 if v['pval']==0 else -math.log10(v['pval'])
-            yield (maf, qval)
+    with VariantFileReader(in_filepath, columns=QQAccumulator.columns) as variants:
+        qq_accumulator = QQAccumulator(pheno)
+        for v in variants:
+            qq_accumulator.process_variant(v)
+    if not qq_accumulator: raise PheWebError("No variants found in {}".format(in_filepath))
+    write_json(filepath=out_filepath, data=qq_accumulator.get_result())
+
+
+class QQAccumulator:
+    '''
+    Collects the qval (and maf, if it can be calculated) of each variant of a phenotype, and then makes the data for its QQ plot.
+    `augment-phenos` feeds it the same variants as a `manhattan.Binner`, so that each phenotype is only read once.
+    '''
+    columns = ['pval'] + maf_fields  # the fields that QQAccumulator needs from every variant
+
+    def __init__(self, pheno:Dict[str,Any]):
+        self._pheno = pheno
+        self._has_maf: Optional[bool] = None  # decided by the first variant
+        # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
+        self._mafs = array('f')
+        self._qvals = array('f')
+
+    def process_variant(self, variant:Dict[str,Any]) -> None:
+        maf = get_maf(variant, self._pheno)
+        if self._has_maf is None: self._has_maf = maf is not None
+        if self._has_maf: self._mafs.append(maf or 0)
+        self._qvals.append(1000 if variant['pval']==0 else -math.log10(variant['pval']))
+
+    def __len__(self) -> int:
+        return len(self._qvals)
+
+    def get_result(self) -> Dict[str,Any]:
+        variants = self._get_variants_array()
+        rv: Dict[str,Any] = {}
+        if 'maf' in variants.dtype.fields:  # type:ignore
+            rv['by_maf'] = make_qq_stratified(variants)
+            rv['overall'] = make_qq_unstratified(variants, include_qq=False)  # Must run AFTER `_stratified()`, because it sorts by qval, which could bias the maf_range strata.
+            rv['ci'] = list(get_confidence_intervals(len(variants) / len(rv['by_maf'])))
+        else:
+            rv['overall'] = make_qq_unstratified(variants, include_qq=True)
+            rv['ci'] = list(get_confidence_intervals(len(variants)))
+        return rv
+
+    def _get_variants_array(self) -> np.ndarray:
+        # I'm making a "structured array" with either the columns [maf qval] or just [qval], depending on whether we can calculate maf from the fields we have.
+        # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
+        if self._has_maf:
+            variants = np.empty(len(self._qvals), dtype=[('maf',np.float32),('qval',np.float32)])
+            variants['maf'] = np.frombuffer(self._mafs, dtype=np.float32)
+        else:
+            variants = np.empty(len(self._qvals), dtype=[('qval',np.float32)])
+        variants['qval'] = np.frombuffer(self._qvals, dtype=np.float32)
+        return variants
 
 
 def make_qq_stratified(variants:np.ndarray) -> List[Dict[str,Any]]:
@@ -2,11 +2,12 @@
 from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
 from .. import parse_utils
 from .. import conf
-from ..file_utils import read_maybe_gzip
-from .load_utils import get_maf
+from ..file_utils import read_maybe_gzip, read_bgzf_shard
+from .load_utils import get_maf, sort_externally
 
 import itertools
 import re
+from contextlib import contextmanager
 import boltons.iterutils
 
 
@@ -15,17 +16,28 @@ class PhenoReader:
     Reads variants (in order) and other info for a phenotype.
     It only returns variants that have a pvalue.
     If `minimum_maf` is defined, variants that don't meet that threshold (via MAF, AF, or AC/NS) are dropped.
+    If `shard` is given (see `AssocFileReader`), only the variants in that shard of the phenotype's single association file are read.
+    If `sort` is True, variants don't need to be in order in the input files, because they get sorted with `sort_externally()`.
     '''
 
-    def __init__(self, pheno, minimum_maf=0):
+    def __init__(self, pheno, minimum_maf=0, shard=None, sort=False):
         self._pheno = pheno
         self._minimum_maf = minimum_maf or 0
-        self.fields, self.filepaths = self._get_fields_and_filepaths(pheno['assoc_files'])
+        self._shard = shard
+        self._sort = sort
+        if shard is None:
+            self.fields, self.filepaths = self._get_fields_and_filepaths(pheno['assoc_files'])
+        else:
+            assert len(pheno['assoc_files']) == 1, pheno
+            self.filepaths = pheno['assoc_files']
 
     def get_variants(self):
-        yield from self._order_refalt_lexicographically(
-            itertools.chain.from_iterable(
-                AssocFileReader(filepath, self._pheno).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
+        variants = itertools.chain.from_iterable(
+            AssocFileReader(filepath, self._pheno, self._shard).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths)
+        if self._sort:
+            yield from sort_externally(variants, key=self._variant_order_key, run_size=conf.get_assoc_sort_run_size())
+        else:
+            yield from self._order_refalt_lexicographically(variants)
 
     def get_info(self):
         infos = [AssocFileReader(filepath, self._pheno).get_info() for filepath in self.filepaths]
@@ -38,12 +50,13 @@ class PhenoReader:
                     "- parsed another line:\n    {}\n".format(info))
         return infos[0]
 
-    def _order_refalt_lexicographically(self, variants):
+    @staticmethod
+    def _order_refalt_lexicographically(variants):
         # Also assert that chrom and pos are in order
         cp_groups = itertools.groupby(variants, key=lambda v:(v['chrom'], v['pos']))
         prev_chrom_index, prev_pos = -1, -1
         for cp, tied_variants in cp_groups:
-            chrom_index = self._get_chrom_index(cp[0])
+            chrom_index = PhenoReader._get_chrom_index(cp[0])
             if chrom_index < prev_chrom_index:
                 raise PheWebError(
                     "The chromosomes in your file appear to be in the wrong order.\n" +
@@ -76,6 +89,9 @@ class PhenoReader:
         )
 
     @staticmethod
+    def _variant_order_key(v):
+        return (PhenoReader._get_chrom_index(v['chrom']), v['pos'], v['ref'], v['alt'])
+    @staticmethod
     def _variant_chrpos_order_key(v):
         return (PhenoReader._get_chrom_index(v['chrom']), v['pos'])
     @staticmethod
@@ -94,10 +110,31 @@ class AssocFileReader:
     # TODO: use `pandas.read_csv(src_filepath, usecols=[...], converters={...}, iterator=True, verbose=True, na_values='.', sep=None)
     #   - first without `usecols`, to parse the column names, and then a second time with `usecols`.
 
-    def __init__(self, filepath, pheno):
+    def __init__(self, filepath, pheno, shard=None):
+        # `shard` restricts reading to part of the file, and is either:
+        #  - {'contig': chrom} for a tabix-indexed file
+        #  - a shard from `file_utils.get_bgzf_shards()` for a BGZF file
         self.filepath = filepath
         self._pheno = pheno
-
+        self._shard = shard
+
+    @contextmanager
+    def _open_lines(self):
+        '''yields an iterator over the header line and then the lines in this reader's shard of the file'''
+        if self._shard is None:
+            with read_maybe_gzip(self.filepath) as f:
+                yield f
+            return
+        with read_maybe_gzip(self.filepath) as f:
+            header_lines = list(itertools.islice(f, 1))
+        if 'contig' in self._shard:
+            import pysam
+            with pysam.TabixFile(self.filepath, parser=None) as tabix_file:
+                yield itertools.chain(header_lines, tabix_file.fetch(self._shard['contig']))
+        else:
+            with read_bgzf_shard(self.filepath, self._shard) as lines:
+                if self._shard['prev_start'] is None: next(lines, None) # the first shard starts with the header
+                yield itertools.chain(header_lines, lines)
 
     def get_variants(self, minimum_maf=0, use_per_pheno_fields=False):
         if use_per_pheno_fields:
@@ -105,7 +142,7 @@ class AssocFileReader:
         else:
             fieldnames_to_check = [fieldname for fieldname,fieldval in itertools.chain(parse_utils.per_variant_fields.items(), parse_utils.per_assoc_fields.items()) if fieldval['from_assoc_files']]
 
-        with read_maybe_gzip(self.filepath) as f:
+        with self._open_lines() as f:
 
             try:
                 header_line = next(f)
@@ -131,17 +168,21 @@ class AssocFileReader:
                 # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
                 # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
             self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
+            parse_row = parse_utils.make_row_parser(colidx_for_field)
 
             if use_per_pheno_fields:
                 for line in f:
                     values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
+                    variant = self._parse_variant(values, colnames, colidx_for_field, parse_row)
                     yield variant
 
             else:
-                for line in f:
-                    values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
+                block_size = conf.get_assoc_parse_block_size()
+                if block_size:
+                    parsed_lines = self._parse_variants_in_blocks(f, delimiter, colnames, colidx_for_field, parse_row, block_size)
+                else:
+                    parsed_lines = self._parse_variants_by_line(f, delimiter, colnames, colidx_for_field, parse_row)
+                for values, variant in parsed_lines:
 
                     if variant['pval'] == '': continue
 
@@ -181,8 +222,36 @@ class AssocFileReader:
                     "- parsed from a later line:\n    {}".format(info))
         return infos[0]
 
-    def _parse_variant(self, values, colnames, colidx_for_field):
+    def _parse_variants_by_line(self, f, delimiter, colnames, colidx_for_field, parse_row):
+        for line in f:
+            values = line.rstrip('\n\r').split(delimiter)
+            yield values, self._parse_variant(values, colnames, colidx_for_field, parse_row)
+
+    def _parse_variants_in_blocks(self, f, delimiter, colnames, colidx_for_field, parse_row, block_size):
+        '''
+        Yields the same thing as `_parse_variants_by_line()`, but parses each column of `block_size` lines at once.
+        If anything in a block fails to parse, that block is re-parsed line-by-line so that the error is the same.
+        '''
+        mapped_fields = [(field, colidx) for field, colidx in colidx_for_field.items() if colidx is not None]
+        field_names = [field for field, colidx in mapped_fields]
+        while True:
+            lines = list(itertools.islice(f, block_size))
+            if not lines: return
+            rows = [line.rstrip('\n\r').split(delimiter) for line in lines]
+            try:
+                if any(len(values) != len(colnames) for values in rows): raise PheWebError('wrong number of values')
+                columns = list(zip(*rows))
+                parsed_columns = [parse_utils.column_parser_for_field[field](columns[colidx]) for field, colidx in mapped_fields]
+            except Exception:
+                for values in rows:
+                    yield values, self._parse_variant(values, colnames, colidx_for_field, parse_row)
+            else:
+                for values, parsed_values in zip(rows, zip(*parsed_columns)):
+                    yield values, dict(zip(field_names, parsed_values))
+
+    def _parse_variant(self, values, colnames, colidx_for_field, parse_row):
         # `values`: [str]
+        # `parse_row`: from `parse_utils.make_row_parser(colidx_for_field)`
 
         if len(values) != len(colnames):
             repr_values = repr(values)
@@ -193,6 +262,11 @@ class AssocFileReader:
                 "- The header: {!r}\n".format(colnames) +
                 "- In file: {!r}\n".format(self.filepath))
 
+        try:
+            return parse_row(values)
+        except Exception:
+            pass # parse field-by-field to find out which field failed
+
         variant = {}
         for field, colidx in colidx_for_field.items():
             if colidx is not None:
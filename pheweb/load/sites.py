@@ -1,18 +1,22 @@
 
 from ..utils import chrom_order, get_phenolist, PheWebError
 from .. import conf
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, make_basedir, get_dated_tmp_path, get_tmp_path
-from .load_utils import get_maf, mtime, indent, ProgressBar
+from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, make_basedir, get_dated_tmp_path, get_tmp_path, get_chrom_index, concatenate_variant_files, write_json
+from .load_utils import get_maf, indent, ProgressBar, Parallelizer
 
 import contextlib
+import collections
+import hashlib
+import json
 import os
 import random
 import multiprocessing
-import bisect
+import heapq
+import math
 import traceback
 
 
-MAX_NUM_FILES_TO_MERGE_AT_ONCE = 8 # I have no idea what's fastest.  Maybe #files / #cpus?
+MAX_NUM_FILES_TO_MERGE_AT_ONCE = 256 # VariantListMerger is a heap, so this is limited by open files rather than by merging speed.
 MIN_NUM_FILES_TO_MERGE_AT_ONCE = 4 # Try to avoid ever merging fewer than this many files at a time.
 
 def run(argv):
@@ -32,14 +36,77 @@ def run(argv):
         )
         exit(1)
 
-    manna = MergeManager()
-
-    # TODO: If a phenotype is removed, this still reports that the list of sites is up-to-date.  How to check that?
+    files = get_input_files()
+    manifest_filepath = get_filepath('unanno-manifest', must_exist=False)
+    manifest = None
     if os.path.exists(out_filepath) and not force:
-        if mtime(out_filepath) >= max(mtime(f['filepath']) for f in manna.files):
+        if os.path.exists(manifest_filepath):
+            with open(manifest_filepath) as f:
+                manifest = json.load(f)
+        else:
+            # This file was made before PheWeb kept a manifest, so we can't tell whether any phenotypes were removed.
+            print('{} has no manifest (because it was made by an old version of PheWeb), so it will be rebuilt once to make one.'.format(os.path.basename(out_filepath)))
+
+    file_infos = get_file_infos(files, manifest['files'] if manifest else {})
+    if manifest:
+        old_file_infos = manifest['files']
+        removed_phenocodes = [phenocode for phenocode in old_file_infos if phenocode not in file_infos]
+        changed_phenocodes = [phenocode for phenocode, info in file_infos.items() if phenocode in old_file_infos and info['md5'] != old_file_infos[phenocode]['md5']]
+        new_files = [f for f in files if f['pheno']['phenocode'] not in old_file_infos]
+        if removed_phenocodes or changed_phenocodes:
+            print('{} phenotypes were removed and {} were changed since {} was made, so it will be rebuilt.'.format(
+                len(removed_phenocodes), len(changed_phenocodes), os.path.basename(out_filepath)))
+        elif not new_files:
+            write_json(filepath=manifest_filepath, data={'files': file_infos}, indent=1, sort_keys=True)  # update mtimes so that we don't check md5s again
             print('The list of sites is up-to-date!')
             return
+        else:
+            print('Merging {} new phenotypes into {}.'.format(len(new_files), os.path.basename(out_filepath)))
+            files = [{'type': 'input', 'filepath': out_filepath}] + new_files
+
+    merge_files(files, out_filepath)
+    write_json(filepath=manifest_filepath, data={'files': file_infos}, indent=1, sort_keys=True)
+
+
+def get_input_files():
+    return [{'type': 'input', 'filepath': get_pheno_filepath('parsed', pheno['phenocode']), 'pheno': pheno} for pheno in get_phenolist()]
+
+# `sites-unannotated-manifest.json` is like {"files": {phenocode: {"filepath": ..., "size": 1234, "mtime_ns": 5678, "md5": "abc..."}, ...}},
+# with the parsed files that went into `sites-unannotated.tsv`.
+def get_file_infos(files, old_file_infos):
+    '''Returns the manifest entry of each file, only computing the md5 of files whose size or mtime doesn't match `old_file_infos`'''
+    file_infos, tasks = {}, []
+    for f in files:
+        phenocode = f['pheno']['phenocode']
+        stat = os.stat(f['filepath'])
+        file_infos[phenocode] = {'filepath': f['filepath'], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        old_info = old_file_infos.get(phenocode)
+        if old_info and all(old_info.get(key) == file_infos[phenocode][key] for key in ['filepath', 'size', 'mtime_ns']):
+            file_infos[phenocode]['md5'] = old_info['md5']
+        else:
+            tasks.append({'phenocode': phenocode, 'filepath': f['filepath']})
+    if tasks:
+        print('Computing checksums of {} parsed files'.format(len(tasks)))
+        for ret in Parallelizer().run_single_tasks(tasks, get_md5, cmd='sites'):
+            file_infos[ret['task']['phenocode']]['md5'] = ret['value']
+    return file_infos
+
+def get_md5(task):
+    md5 = hashlib.md5()
+    with open(task['filepath'], 'rb') as f:
+        for data in iter(lambda: f.read(2**20), b''):
+            md5.update(data)
+    return md5.hexdigest()
+
 
+def merge_files(files, out_filepath):
+    chrom_indexes = [get_chrom_index(f['filepath']) for f in files]
+    if all(chrom_index is not None for chrom_index in chrom_indexes):
+        merge_by_chrom(files, chrom_indexes, out_filepath)  # type: ignore
+        return
+    print('Some files don\'t have a chromosome index (because they were made by an old version of PheWeb), so all chromosomes will be merged together.')
+
+    manna = MergeManager(files)
     taskq = multiprocessing.Queue()
     retq  = multiprocessing.Queue()
     procs = [multiprocessing.Process(target=mp_target, args=(taskq, retq)) for _ in range(manna.n_procs)]
@@ -74,16 +141,11 @@ def run(argv):
 
 class MergeManager:
     '''Keeps track of what needs to get merged next.'''
-    def __init__(self):
+    def __init__(self, files):
         self.n_procs = conf.get_num_procs(cmd='sites')
-        self.files = []
-        for pheno in get_phenolist():
-            filepath = get_pheno_filepath('parsed', pheno['phenocode'])
-            self.files.append({
-                'type': 'input',
-                'filepath': filepath,
-                'pheno': pheno,
-            })
+        self.files = list(files)
+        # Spread the input files evenly across the processes (but merge at least 8 at a time), so that there are few rounds of merging.
+        self.num_files_to_merge_at_once = min(MAX_NUM_FILES_TO_MERGE_AT_ONCE, max(8, math.ceil(len(self.files) / max(1, self.n_procs))))
     def apply_ret(self, ret):
         if ret['type'] == 'task-completion':
             self.files.append({
@@ -116,9 +178,9 @@ class MergeManager:
             taskq.put({'exit':True})
         else:
             # MAKE A TASK FOR THE WORKER
-            files_to_merge = self.files[:MAX_NUM_FILES_TO_MERGE_AT_ONCE]
-            self.files =     self.files[MAX_NUM_FILES_TO_MERGE_AT_ONCE:]
-            out_filepath = get_tmp_path('merging-{}'.format(random.randrange(1e10)))
+            files_to_merge = self.files[:self.num_files_to_merge_at_once]
+            self.files =     self.files[self.num_files_to_merge_at_once:]
+            out_filepath = get_tmp_path('merging-{}'.format(random.randrange(10**10)))
             taskq.put({
                 'files_to_merge': files_to_merge,
                 'out_filepath': out_filepath,
@@ -148,19 +210,63 @@ def mp_target(taskq, retq):
                 "exception_tb": traceback.format_exc(),
             })
 
-def merge(files_to_merge, out_filepath):
+def merge_by_chrom(files, chrom_indexes, out_filepath):
+    '''
+    Merges each chromosome of all the parsed files in parallel (seeking to it with each file's chromosome index), and then concatenates the chromosomes.
+    The biggest chromosomes are started first, so that the processes all finish around the same time.
+    '''
+    num_variants_for_chrom = collections.Counter()
+    for file, chrom_index in zip(files, chrom_indexes):
+        if sum(num_variants for chrom, offset, num_variants in chrom_index) == 0:
+            print('Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.'.format(file['filepath']))
+        for chrom, offset, num_variants in chrom_index:
+            num_variants_for_chrom[chrom] += num_variants
+    tasks = []
+    for chrom, _ in num_variants_for_chrom.most_common():
+        if chrom not in chrom_order: raise PheWebError("Unknown chromosome {!r} in the chromosome indexes of {!r}".format(chrom, [f['filepath'] for f in files]))
+        tasks.append({
+            'chrom': chrom,
+            'files_to_merge': [dict(file, chrom=chrom) for file, chrom_index in zip(files, chrom_indexes)
+                               if any(indexed_chrom == chrom and num_variants > 0 for indexed_chrom, offset, num_variants in chrom_index)],
+            'out_filepath': get_tmp_path('sites-chrom-{}'.format(chrom)),
+        })
+    for ret in Parallelizer().run_single_tasks(tasks, merge_chrom, cmd='sites'):
+        print(ret['value']['warning_str'])
+
+    # The chromosome files have chromosome indexes, so `sites-unannotated.tsv` gets one too, and can be merged with new files by chromosome.
+    make_basedir(out_filepath)
+    concatenate_variant_files([task['out_filepath'] for task in sorted(tasks, key=lambda task: chrom_order[task['chrom']])], out_filepath)
+    for task in tasks:
+        os.remove(task['out_filepath'])
+        os.remove(task['out_filepath'] + '.chroms')
+
+def merge_chrom(task):
+    '''Merges one chromosome of many files, in rounds of at most `MAX_NUM_FILES_TO_MERGE_AT_ONCE` files to limit how many are open'''
+    files_to_merge = task['files_to_merge']
+    while len(files_to_merge) > MAX_NUM_FILES_TO_MERGE_AT_ONCE:
+        merged_files = []
+        for i in range(0, len(files_to_merge), MAX_NUM_FILES_TO_MERGE_AT_ONCE):
+            merged_filepath = get_tmp_path('merging-{}'.format(random.randrange(10**10)))
+            yield from merge(files_to_merge[i:i+MAX_NUM_FILES_TO_MERGE_AT_ONCE], merged_filepath)
+            merged_files.append({'type': 'merged', 'filepath': merged_filepath})
+        files_to_merge = merged_files
+    yield from merge(files_to_merge, task['out_filepath'], chrom_index=True)
+
+def merge(files_to_merge, out_filepath, chrom_index=False):
     # files_to_merge is like [
     #   {filepath: "/foo/bar", type:"input", pheno:pheno},
+    #   {filepath: "/foo/bar", type:"input", pheno:pheno, chrom:"1"}, # only merge chromosome 1 of this file
     #   {filepath: "/foo/bar", type:"merged"},
     # ]
     with contextlib.ExitStack() as exit_stack, \
-         VariantFileWriter(out_filepath) as writer:
+         VariantFileWriter(out_filepath, chrom_index=chrom_index) as writer:
 
         readers = []
         _reader_info = []
         vlm = VariantListMerger()
         for file_to_merge in files_to_merge:
-            reader = iter(exit_stack.enter_context(VariantFileReader(file_to_merge['filepath'], only_per_variant_fields=True)))
+            reader = iter(exit_stack.enter_context(VariantFileReader(file_to_merge['filepath'], only_per_variant_fields=True, records=conf.should_use_variant_records(),
+                                                                     chrom=file_to_merge.get('chrom'))))
             reader_id = len(readers)
             readers.append(reader)
             _reader_info.append(file_to_merge)
@@ -169,11 +275,13 @@ def merge(files_to_merge, out_filepath):
             try:
                 v = next(reader)
             except StopIteration:
+                readers[reader_id] = None
                 yield {
                     'type': 'warning',
                     'warning_str': 'Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.'.format(_reader_info[reader_id]['filepath']),
                 }
-            vlm.insert(v, reader_id)
+            else:
+                vlm.insert(v, reader_id)
 
         # each time we pop the leftmost variant from the VariantListMerger, fetch a new variant from each pheno that contained that variant
         n_variants = 0
@@ -204,10 +312,10 @@ class VariantListMerger:
     Variants must match EXACTLY.
     '''
     def __init__(self):
-        # self._q = blist.blist()  # TODO: see whether blist.blist() is more performant than [] (b/c blist1.3 raises DeprecationWarnings on py38)
-        self._q = []
-        # self._q is like sorted([(key, variant_dict, [reader_id, ...]), ...])
-        # key is like (chrom_idx, pos, ref, alt)
+        self._heap = []
+        # self._heap is a heap of keys, where each key is like (chrom_idx, pos, ref, alt)
+        self._entries = {}
+        # self._entries is like {key: (variant_dict, [reader_id, ...])}, with one entry for each key in self._heap
 
     def insert(self, variant, reader_id):
         # Delete extra keys that would cause two of the same variant to not look like a pair.
@@ -216,25 +324,26 @@ class VariantListMerger:
         for key in [key for key in variant.keys() if key not in ('chrom', 'pos', 'ref', 'alt')]:
             del variant[key]
         key = self._key_from_variant(variant)
-        idx = bisect.bisect_left(self._q, (key,)) # note: (a,) < (a,b)
-        if idx == len(self._q) or self._q[idx][0] != key:
+        entry = self._entries.get(key)
+        if entry is None:
             # new variant, so just insert
-            self._q.insert(idx, (key, variant, [reader_id]))
+            self._entries[key] = (variant, [reader_id])
+            heapq.heappush(self._heap, key)
         else:
             # key matches, so variant must too
-            if variant != self._q[idx][1]:
+            if variant != entry[0]:
                 raise PheWebError('trying to add {!r} to VariantMerger, but it already contains {!r} which has the same chrom-pos-ref-alt'.format(
-                    variant, self._q[idx][1]))
-            self._q[idx][2].append(reader_id)
+                    variant, entry[0]))
+            entry[1].append(reader_id)
 
     def pop(self):
-        return self._q.pop(0)[1:3] # return (item, [tag, ...])
+        return self._entries.pop(heapq.heappop(self._heap)) # return (item, [tag, ...])
 
     def __len__(self):
-        return len(self._q)
+        return len(self._heap)
 
     def __repr__(self):
-        return 'VariantMerger<_q={!r}>'.format(self._q)
+        return 'VariantMerger<_entries={!r}>'.format([(key, *self._entries[key]) for key in sorted(self._heap)])
 
     @staticmethod
     def _key_from_variant(v):
@@ -21,6 +21,7 @@ def scientific_int(s:str) -> int:
 
 
 null_values = ['', '.', 'NA', 'N/A', 'n/a', 'nan', '-nan', 'NaN', '-NaN', 'null', 'NULL']
+_null_values_set = set(null_values)
 
 default_field = {
     'aliases': [],
@@ -223,12 +224,178 @@ class Field:
         if 'decimals' in self._d:
             x = round(x, self._d['decimals'])
         return x
+
+    def make_parser(self) -> ty.Callable[[str],ty.Any]:
+        '''
+        Returns a function that does the same thing as `.parse()`, but only includes the steps that this field needs.
+        It looks up `conf.pval_is_neglog10()` now instead of on every value, so make a new one for each input file.
+        '''
+        d = self._d
+        convert = d['type']
+        steps: ty.List[ty.Callable[[Any],Any]] = []
+        if 'could_be_neglog10' in d and d['could_be_neglog10'] and conf.pval_is_neglog10():
+            steps.append(lambda x: 10**-x)
+        if 'range' in d:
+            low, high = d['range']
+            if low is not None and high is not None:
+                def check_range(x):
+                    assert x >= low
+                    assert x <= high
+                    return x
+                steps.append(check_range)
+            elif low is not None:
+                def check_low(x):
+                    assert x >= low
+                    return x
+                steps.append(check_low)
+            elif high is not None:
+                def check_high(x):
+                    assert x <= high
+                    return x
+                steps.append(check_high)
+        if 'sigfigs' in d:
+            sigfigs = d['sigfigs']
+            steps.append(lambda x: utils.round_sig(x, sigfigs))
+        if 'proportion_sigfigs' in d:
+            proportion_sigfigs = d['proportion_sigfigs']
+            def round_proportion(x):
+                if 0 <= x < 0.5:
+                    return utils.round_sig(x, proportion_sigfigs)
+                elif 0.5 <= x <= 1:
+                    return 1 - utils.round_sig(1-x, proportion_sigfigs)
+                raise utils.PheWebError('cannot use proportion_sigfigs on a number outside [0-1]')
+            steps.append(round_proportion)
+        if 'decimals' in d:
+            decimals = d['decimals']
+            steps.append(lambda x: round(x, decimals))
+
+        if not steps:
+            parse_nonnull = convert
+        elif len(steps) == 1:
+            step = steps[0]
+            def parse_nonnull(value): return step(convert(value))
+        elif len(steps) == 2:
+            step1, step2 = steps
+            def parse_nonnull(value): return step2(step1(convert(value)))
+        else:
+            def parse_nonnull(value):
+                x = convert(value)
+                for step in steps: x = step(x)
+                return x
+
+        if not d['nullable']:
+            return parse_nonnull
+        def parse(value):
+            if value in _null_values_set: return ''
+            return parse_nonnull(value)
+        return parse
+
+    def parse_column(self, values:ty.Sequence[str]) -> ty.List[Any]:
+        '''
+        parse a whole column from an input file at once.
+        Returns exactly `[self.parse(value) for value in values]`, but does the work with numpy.
+        Raises an exception if any value fails, so the caller should use `.parse()` on each value to find and report the bad one.
+        '''
+        if self._d['nullable']:
+            is_null = [value in _null_values_set for value in values]
+            nonnull_values = [value for value, null in zip(values, is_null) if not null] if any(is_null) else values
+        else:
+            is_null = None
+            nonnull_values = values
+
+        if self._d['type'] is str:
+            parsed = list(nonnull_values)
+        else:
+            x = self._to_array(nonnull_values)
+            if x is None:
+                # numpy can't convert these values (eg, `scientific_int`), so parse them one at a time.
+                parsed = [self.parse(value) for value in nonnull_values]
+            else:
+                parsed = self._parse_array(x, nonnull_values)
+
+        if is_null is None or len(parsed) == len(values):
+            return parsed
+        parsed_iter = iter(parsed)
+        return ['' if null else next(parsed_iter) for null in is_null]
+
+    def _to_array(self, values:ty.Sequence[str]):
+        # numpy converts a sequence of `str` using python's `float()` and `int()`, so it accepts and rejects the same values.
+        import numpy as np
+        if self._d['type'] is float:
+            return np.array(values, dtype=np.float64)
+        try:
+            return np.array(values, dtype=np.int64)
+        except (ValueError, OverflowError):
+            if self._d['type'] is int: raise
+            return None
+
+    def _parse_array(self, x, values:ty.Sequence[str]) -> ty.List[Any]:
+        # `needs_parse` marks values where numpy's result might differ from `.parse()`, which we then re-parse one at a time.
+        import numpy as np
+        needs_parse = np.zeros(len(x), dtype=bool)
+
+        if 'could_be_neglog10' in self._d and self._d['could_be_neglog10'] and conf.pval_is_neglog10():
+            with np.errstate(over='ignore'):
+                x = np.power(10.0, -x)
+
+        if 'range' in self._d:
+            if self._d['range'][0] is not None and not (x >= self._d['range'][0]).all(): raise ValueError('value below range')
+            if self._d['range'][1] is not None and not (x <= self._d['range'][1]).all(): raise ValueError('value above range')
+        if 'sigfigs' in self._d:
+            x = _round_sig_array(x, self._d['sigfigs'], needs_parse)
+        if 'proportion_sigfigs' in self._d:
+            if not ((0 <= x) & (x <= 1)).all(): raise utils.PheWebError('cannot use proportion_sigfigs on a number outside [0-1]')
+            is_low = x < 0.5
+            x = np.where(is_low, x, 1 - x)
+            x = _round_sig_array(x, self._d['proportion_sigfigs'], needs_parse)
+            x = np.where(is_low, x, 1 - x)
+        if 'decimals' in self._d:
+            x = _round_array(x, np.full(len(x), self._d['decimals']), needs_parse)
+
+        parsed = x.tolist()
+        for idx in np.flatnonzero(needs_parse).tolist():
+            parsed[idx] = self.parse(values[idx])
+        return parsed
+
     def read(self, value):
         '''read from internal file'''
         if self._d['nullable'] and value == '':
             return ''  # TODO: should this be None?
         return self._d['type'](value)
 
+
+# numpy rounds by computing `rint(x * 10**ndigits) / 10**ndigits`, but python's `round()` rounds the exact decimal value of `x`.
+# Those agree except when `x * 10**ndigits` is very close to a half-integer or when `10**ndigits` isn't exact.
+# These functions mark those values in `needs_parse` so that they can be handled by python instead.
+_exact_powers_of_ten = [10.0**i for i in range(23)]  # 10**22 is the largest power of ten that a float64 holds exactly
+
+def _round_sig_array(x, digits:int, needs_parse):
+    '''like `[utils.round_sig(v, digits) for v in x]`'''
+    import numpy as np
+    if not np.isfinite(x).all(): raise ValueError("Cannot round infinity or NaN")
+    is_zero = (x == 0)
+    needs_parse |= is_zero  # `utils.round_sig()` returns the int `0` for these
+    log = np.log10(np.where(is_zero, 1, np.abs(x)))
+    needs_parse |= np.abs(log - np.round(log)) < 1e-9  # `floor(log)` might disagree with `math.floor(math.log10())`
+    ndigits = digits - 1 - np.floor(log)
+    return _round_array(x, ndigits, needs_parse)
+
+def _round_array(x, ndigits, needs_parse):
+    '''like `[round(v, n) for v,n in zip(x, ndigits)]`'''
+    import numpy as np
+    needs_parse |= np.abs(ndigits) >= len(_exact_powers_of_ten)
+    ndigits = np.where(needs_parse, 0, ndigits).astype(np.int64)
+    scale = np.array(_exact_powers_of_ten)[np.abs(ndigits)]
+    is_positive = ndigits >= 0
+    # Huge or infinite values overflow (or become NaN) here, but then `rounded` is too big and they get parsed one at a time anyway.
+    with np.errstate(over='ignore', invalid='ignore'):
+        y = np.where(is_positive, x * scale, x / scale)
+        needs_parse |= np.abs(y - np.floor(y) - 0.5) < 1e-9 * np.maximum(1, np.abs(y))
+        rounded = np.where(is_positive, np.rint(y) / scale, np.rint(y) * scale)
+    needs_parse |= np.abs(rounded) >= 2**52
+    return rounded
+
+
 # Check that field_names are lowercase
 if any(not field_name.islower() for field_name in fields):
     raise PheWebError("All field names must be lowercase, but these aren't: {}".format([fn for fn in fields if not fn.islower()]))
@@ -249,12 +416,25 @@ for field_name, field_dict in fields.items():
 
 # Build readers/parsers
 parser_for_field: ty.Dict[str,ty.Callable[[str],ty.Any]] = {}
+column_parser_for_field: ty.Dict[str,ty.Callable[[ty.Sequence[str]],ty.List[ty.Any]]] = {}
 reader_for_field: ty.Dict[str,ty.Callable[[str],ty.Any]] = {}
 for field_name, field_dict in fields.items():
     obj = Field(field_dict)
     parser_for_field[field_name] = obj.parse
+    column_parser_for_field[field_name] = obj.parse_column
     reader_for_field[field_name] = obj.read
 
+def make_row_parser(colidx_for_field:ty.Dict[str,ty.Optional[int]]) -> ty.Callable[[ty.List[str]],ty.Dict[str,ty.Any]]:
+    '''
+    Returns a function that turns the values of one line of an input file into a variant dict,
+    like `{field: parser_for_field[field](values[colidx]) for field, colidx in colidx_for_field.items() if colidx is not None}`.
+    Fields mapped to `None` are skipped.
+    '''
+    parsers = [(field_name, colidx, Field(fields[field_name]).make_parser())
+               for field_name, colidx in colidx_for_field.items() if colidx is not None]
+    def parse_row(values:ty.List[str]) -> ty.Dict[str,ty.Any]:
+        return {field_name: parse(values[colidx]) for field_name, colidx, parse in parsers}
+    return parse_row
 
 
 def get_tooltip_underscoretemplate():
@@ -1,5 +1,5 @@
 
-from ..load.load_utils import get_maf
+from ..load.load_utils import get_maf, maf_fields
 from ..utils import get_phenolist, get_gene_tuples, pad_gene, PheWebError, vep_consqeuence_category
 from .. import conf
 from .. import parse_utils
@@ -152,12 +152,13 @@ def api_pheno_filtered(phenocode):
         try: max_maf = float(request.args['max_maf'])
         except Exception: abort(404, description="Failed to parse GET parameter `max_maf=`.")
     # Get variants according to filter
-    chosen_variants = []  # TODO: stream straight from VariantFileReader() -> Binner() without this intermediate list
+    from pheweb.load.manhattan import Binner
     weakest_pval_seen = 0
     num_variants = 0
     try: filepath = get_pheno_filepath('best_of_pheno', phenocode)
     except Exception: abort(404, description="Failed to find a best_of_pheno file.  Perhaps `pheweb best-of-pheno` wasn't run.")
-    with VariantFileReader(filepath) as vfr:
+    with VariantFileReader(filepath, columns=Binner.columns + ['ref', 'alt', 'consequence'] + maf_fields) as vfr:
+        binner = Binner(get_full_variant=vfr.get_full_variant)
         for v in vfr:
             num_variants += 1
             if v['pval'] > weakest_pval_seen: weakest_pval_seen = v['pval']
@@ -171,14 +172,10 @@ def api_pheno_filtered(phenocode):
                 csq = vep_consqeuence_category.get(v.get('consequence',''), '')
                 if consequence_category == 'lof' and csq != 'lof': continue
                 if consequence_category == 'nonsyn' and not csq: continue
-            chosen_variants.append(v)
-    from pheweb.load.manhattan import Binner
-    binner = Binner()
-    for variant in chosen_variants:
-        binner.process_variant(variant)
-    manhattan_data = binner.get_result()
+            binner.process_variant(v)
+        manhattan_data = binner.get_result()
     manhattan_data['weakest_pval'] = weakest_pval_seen
-    #print(f'indel={indel} maf={min_maf}-{max_maf} #chosen={len(chosen_variants)} #bins={len(manhattan_data["variant_bins"])} #unbinned={len(manhattan_data["unbinned_variants"])} weakest_pval={weakest_pval_seen}')
+    #print(f'indel={indel} maf={min_maf}-{max_maf} #bins={len(manhattan_data["variant_bins"])} #unbinned={len(manhattan_data["unbinned_variants"])} weakest_pval={weakest_pval_seen}')
     return jsonify(manhattan_data)
 
 
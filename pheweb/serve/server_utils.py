@@ -65,13 +65,13 @@ class _ParseVariant:
 parse_variant = _ParseVariant().parse_variant
 
 class _GetVariant:
+    _matrix_reader:Optional[MatrixReader] = None
     def get_variant(self, query:str) -> Optional[Dict[str,Any]]:
         chrom, pos, ref, alt = parse_variant(query)
         assert None not in [chrom, pos, ref, alt]
-        if not hasattr(self, '_matrix_reader'):
-            self._matrix_reader = MatrixReader()
-        with self._matrix_reader.context() as mr:
-            v = mr.get_variant(chrom, pos, ref, alt)
+        if self._matrix_reader is None or not self._matrix_reader.is_up_to_date():
+            self._matrix_reader = MatrixReader()  # `pheweb matrix` can replace the matrix (and its cpra index) while we're serving it
+        v = self._matrix_reader.get_variant(chrom, pos, ref, alt)
         if v is None: return None
         v['phenos'] = list(v['phenos'].values())
         v['variant_name'] = '{} : {:,} {} / {}'.format(chrom, pos, ref, alt)
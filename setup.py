@@ -74,7 +74,6 @@ setup(
         'Flask-Login~=0.5',
         'rauth~=0.7',
         'pysam~=0.16',
-        'intervaltree~=3.1',
         'tqdm~=4.56',
         'scipy~=1.5',
         'numpy~=1.19',
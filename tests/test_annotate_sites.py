@@ -0,0 +1,114 @@
+import gzip
+import os
+import random
+
+import pytest
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_chrom_index
+from pheweb.load import add_rsids, annotate_sites, make_rsids_index
+from pheweb.utils import PheWebError
+
+
+def _write_genes(genes):
+    with open(get_filepath('genes', must_exist=False), 'w') as f:
+        for chrom, start, end, gene in genes:
+            f.write('{}\t{}\t{}\t{}\tENSG{}\n'.format(chrom, start, end, gene, start))
+
+
+def test_add_rsids_matches_every_rsid_at_each_position(tmpdir, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    _write_genes([('1', 1, 2, 'A')])
+    rng = random.Random(0)
+    rsid_rows = []
+    with gzip.open(get_filepath('rsids', must_exist=False), 'wt') as f:
+        f.write('##fileformat=VCFv4.0\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom in ['1', '2', 'X']:
+            for pos in sorted(rng.sample(range(1, 300), 100)):
+                for _ in range(rng.choice([1, 1, 2, 3])):
+                    ref = rng.choice(['A', 'C', 'AC', 'N'])
+                    alts = [rng.choice(['A', 'G', 'T', 'N', 'GN', 'TT', '.']) for _ in range(rng.choice([1, 2]))]
+                    rsid = 'rs{}'.format(rng.randrange(1, 10**9))
+                    f.write('{}\t{}\t{}\t{}\t{}\n'.format(chrom, pos, rsid, ref, ','.join(alts)))
+                    rsid_rows.extend((chrom, pos, ref, alt, rsid) for alt in alts if alt != '.')
+    variants = sorted({(chrom, rng.randrange(1, 300), rng.choice(['A', 'C', 'AC']), rng.choice(['A', 'G', 'T', 'GA', 'TT']))
+                       for chrom in ['1', '2', 'Y'] for _ in range(300)}, key=lambda v: (v[0] == 'Y', v[0], v[1]))
+    with VariantFileWriter(get_filepath('unanno', must_exist=False)) as writer:
+        writer.write_all({'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt} for chrom, pos, ref, alt in variants)
+
+    annotate_sites.run([])
+    with VariantFileReader(get_filepath('sites')) as reader:
+        annotated = list(reader)
+    expected = [','.join(rsid for rsid_chrom, rsid_pos, rsid_ref, rsid_alt, rsid in rsid_rows
+                         if (rsid_chrom, rsid_pos, rsid_ref) == (chrom, pos, ref) and add_rsids.are_match(alt, rsid_alt))
+                for chrom, pos, ref, alt in variants]
+    assert [v['rsids'] for v in annotated] == expected
+    assert sum(bool(rsids) for rsids in expected) > 20
+    assert [chrom for chrom, offset, num_variants in get_chrom_index(get_filepath('sites'))] == ['1', '2', 'Y']
+
+
+def test_make_rsids_index_rejects_malformed_rsids_and_recovers(tmpdir):
+    rsids_filepath, index_dirpath = str(tmpdir.join('rsids.vcf.gz')), str(tmpdir.join('rsids-index'))
+    def write_rsids(rsid):
+        with gzip.open(rsids_filepath, 'wt') as f:
+            f.write('##fileformat=VCFv4.0\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            f.write('1\t5\t{}\tA\tG\n'.format(rsid))
+    write_rsids('rs12a')
+    with pytest.raises(PheWebError, match='rs12a'):
+        make_rsids_index.make_rsids_index(rsids_filepath, index_dirpath)
+    # The failed build leaves its tmp directory behind, and the next build must replace it.
+    write_rsids('rs12')
+    make_rsids_index.make_rsids_index(rsids_filepath, index_dirpath)
+    assert make_rsids_index.is_rsids_index_up_to_date(rsids_filepath, index_dirpath)
+    assert sorted(os.listdir(str(tmpdir))) == ['rsids-index', 'rsids.vcf.gz']
+
+
+def test_annotate_sites_adds_nearest_genes_and_vep_consequences(tmpdir, monkeypatch, capsys):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    _write_genes([('1', 100, 200, 'A'), ('1', 150, 300, 'B'), ('1', 500, 600, 'C'), ('2', 100, 200, 'D')])
+    with gzip.open(get_filepath('rsids', must_exist=False), 'wt') as f:
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n1\t160\trs5\tA\tG\n')
+    cpras = [('1', 50, 'A', 'G'), ('1', 160, 'A', 'G'), ('1', 160, 'A', 'T'), ('1', 390, 'C', 'G'), ('1', 410, 'C', 'G'), ('2', 1000, 'A', 'G'), ('X', 5, 'A', 'G')]
+    with VariantFileWriter(get_filepath('unanno', must_exist=False), chrom_index=True) as writer:
+        writer.write_all({'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt} for chrom, pos, ref, alt in cpras)
+    def get_sites():
+        annotate_sites.run([])
+        with VariantFileReader(get_filepath('sites')) as reader:
+            return [(v['rsids'], v['nearest_genes'], v.get('consequence')) for v in reader]
+
+    assert get_sites() == [('', 'A', None), ('rs5', 'A,B', None), ('', 'A,B', None), ('', 'B', None), ('', 'C', None), ('', 'D', None), ('', '', None)]
+    capsys.readouterr()
+    annotate_sites.run([])
+    assert 'up-to-date' in capsys.readouterr().out
+
+    vep_filepath = str(tmpdir / 'out-raw-vep.tsv')
+    with open(vep_filepath, 'w') as f:
+        f.write('## ENSEMBL VARIANT EFFECT PREDICTOR\n#Uploaded_variation\tLocation\tConsequence\n')
+        for chrom, pos, ref, alt, csq in [('1', 160, 'A', 'G', 'missense_variant'), ('1', 390, 'C', 'G', 'intron_variant'), ('X', 5, 'A', 'G', 'stop_gained')]:
+            f.write('{0}:{1}:{2}:{3}\t{0}:{1}\t{4}\n'.format(chrom, pos, ref, alt, csq))
+    monkeypatch.setitem(conf.overrides, 'vep_consequences_file', vep_filepath)
+    assert [csq for rsids, genes, csq in get_sites()] == ['', 'missense_variant', '', 'intron_variant', '', '', 'stop_gained']
+    monkeypatch.delitem(conf.overrides, 'vep_consequences_file')
+    assert [csq for rsids, genes, csq in get_sites()] == [None] * 7
+
+
+def test_gene_annotator_sweeps_forward_and_backward():
+    from pheweb.load.add_genes import GeneAnnotator
+    rng = random.Random(0)
+    coords = rng.sample(range(1, 10_000), 200)  # no ties, so that the nearest gene is unambiguous
+    genes = [('1', min(coords[i], coords[i+1]), max(coords[i], coords[i+1]), rng.choice('ABCDEFGH')) for i in range(0, len(coords), 2)]
+    def get_overlapping(pos):
+        return sorted({gene for chrom, start, end, gene in genes if start <= pos < end})
+    def get_nearest(pos):
+        if get_overlapping(pos): return ','.join(get_overlapping(pos))
+        before = max([(end, gene) for chrom, start, end, gene in genes if end <= pos], default=None)
+        after = min([(start, gene) for chrom, start, end, gene in genes if start > pos], default=None)
+        if before is None or after is None: return (before or after)[1]
+        return before[1] if pos - before[0] < after[0] - pos else after[1]
+    positions = sorted(rng.sample(range(0, 11_000), 2000))
+    ga = GeneAnnotator(genes)
+    assert ga.annotate_positions('1', positions) == [get_nearest(pos) for pos in positions]
+    rng.shuffle(positions)
+    assert [ga.annotate_position('1', pos) for pos in positions] == [get_nearest(pos) for pos in positions]
+    assert [ga.get_overlapping_genes('1', pos) for pos in positions] == [get_overlapping(pos) for pos in positions]
+    assert ga.annotate_positions('2', [5]) == [''] and ga.get_overlapping_genes('2', 5) == []
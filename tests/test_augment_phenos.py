@@ -0,0 +1,76 @@
+import random
+
+import pytest
+
+
+def test_join_lines_matches_convert_variants(tmpdir, monkeypatch):
+    import gzip
+    import pysam
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter
+    from pheweb.load import augment_phenos
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    rng = random.Random(0)
+    sites_filepath, parsed_filepath = str(tmpdir / 'sites.tsv'), str(tmpdir / 'parsed.tsv')
+    with VariantFileWriter(sites_filepath) as sites_writer, VariantFileWriter(parsed_filepath) as parsed_writer:
+        for chrom in ['1', '2', '10', 'X']:
+            for pos in sorted(rng.sample(range(1, 10**6), 3000)):  # enough for many BGZF blocks
+                v = {'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'}
+                sites_writer.write(dict(v, rsids='rs{}'.format(pos) if pos % 3 else '', nearest_genes='GENE{}'.format(pos // 10**5)))
+                if rng.random() < 0.7:
+                    # `parse-input-files` writes a pval of 0 as "0", which `augment-phenos` writes as "0.0"
+                    parsed_writer.write(dict(v, pval=0 if pos % 10 == 0 else rng.random(), beta=rng.gauss(0, 1), num_cases=rng.randrange(100, 1000)))
+    fields = augment_phenos.get_joined_fields(augment_phenos._read_header(sites_filepath), augment_phenos._read_header(parsed_filepath))
+    assert fields == ['chrom', 'pos', 'ref', 'alt', 'rsids', 'nearest_genes', 'pval', 'beta', 'num_cases']
+    pheno = {'phenocode': 'a'}
+    augment_phenos.convert_variants(pheno, sites_filepath, parsed_filepath, str(tmpdir / 'variants.gz'))
+    augment_phenos.join_lines(pheno, sites_filepath, parsed_filepath, str(tmpdir / 'lines.gz'), fields, fields[6:])
+    with gzip.open(str(tmpdir / 'variants.gz'), 'rb') as f1, gzip.open(str(tmpdir / 'lines.gz'), 'rb') as f2:
+        assert f1.read() == f2.read()
+    with pysam.TabixFile(str(tmpdir / 'variants.gz')) as tabix_file1, pysam.TabixFile(str(tmpdir / 'lines.gz')) as tabix_file2:
+        for chrom in ['1', '2', '10', 'X']:
+            assert list(tabix_file1.fetch(chrom)) == list(tabix_file2.fetch(chrom))
+            for start in range(0, 10**6, 10**5 - 1):
+                assert list(tabix_file1.fetch(chrom, start, start + 5000)) == list(tabix_file2.fetch(chrom, start, start + 5000))
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_augment_phenos_makes_the_same_summaries_as_each_step(tmpdir, monkeypatch, binary):
+    import json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import augment_phenos, manhattan, qq, best_of_pheno
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 1)
+    monkeypatch.setitem(conf.overrides, 'binary_variant_files', binary)
+    monkeypatch.setitem(conf.overrides, 'show_manhattan_filter_button', True)
+    monkeypatch.setattr(best_of_pheno, 'NUM_VARIANTS', 50)
+    with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+        json.dump([{'phenocode': 'a', 'assoc_files': [], 'num_samples': 1000}], f)
+    rng = random.Random(0)
+    with VariantFileWriter(get_filepath('sites', must_exist=False)) as sites_writer, \
+         VariantFileWriter(get_pheno_filepath('parsed', 'a', must_exist=False), binary=binary) as parsed_writer:
+        for chrom in ['1', '2', 'X']:
+            for pos in sorted(rng.sample(range(1, 10**7), 500)):
+                v = {'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'}
+                sites_writer.write(dict(v, rsids='', nearest_genes='GENE{}'.format(pos // 10**6)))
+                parsed_writer.write(dict(v, pval=rng.random() ** 10, af=rng.random()))  # with some peaks
+    with monkeypatch.context() as m:
+        m.setattr(augment_phenos, 'summarize_augmented_pheno', None)  # the summaries are made while `pheno_gz/a` is written, without reading it
+        augment_phenos.run([])
+    summary_filepaths = augment_phenos.get_summary_filepaths({'phenocode': 'a'})
+    def pop_summaries():
+        summaries = []
+        for filepath in summary_filepaths:
+            with open(filepath) as f: summaries.append(f.read())
+            os.remove(filepath)
+        return summaries
+    summaries = pop_summaries()
+    pheno_gz_mtime = os.stat(get_pheno_filepath('pheno_gz', 'a')).st_mtime_ns
+    augment_phenos.run([])  # only the summaries are missing, so they're made from `pheno_gz/a` (or `pheno_bin/a`)
+    assert os.stat(get_pheno_filepath('pheno_gz', 'a')).st_mtime_ns == pheno_gz_mtime
+    assert pop_summaries() == summaries
+    manhattan.make_manhattan_json_file({'phenocode': 'a'})
+    qq.make_json_file({'phenocode': 'a', 'num_samples': 1000})
+    best_of_pheno.make_bestof_file({'phenocode': 'a'})
+    assert pop_summaries() == summaries
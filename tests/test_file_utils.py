@@ -0,0 +1,166 @@
+import gzip
+
+import pysam
+import pytest
+
+from pheweb import conf
+from pheweb.file_utils import read_maybe_gzip, is_bgzf, _BgzfReader
+from pheweb.utils import PheWebError
+
+
+def _make_bgzf(tmpdir, text):
+    src, dst = str(tmpdir / 'a.tsv'), str(tmpdir / 'a.tsv.gz')
+    with open(src, 'w') as f:
+        f.write(text)
+    pysam.tabix_compress(src, dst, force=True)
+    return dst
+
+TEXT = ''.join('1\t{}\tA\tG\t{}\n'.format(pos, pos / 1e6) for pos in range(200_000))
+
+
+@pytest.mark.parametrize('num_threads', [0, 1, 3])
+def test_read_bgzf(tmpdir, monkeypatch, num_threads):
+    filepath = _make_bgzf(tmpdir, TEXT)
+    assert is_bgzf(filepath)
+    monkeypatch.setitem(conf.overrides, 'bgzf_decompression_threads', num_threads)
+    monkeypatch.setattr(_BgzfReader, '_blocks_per_task', 2)
+    with read_maybe_gzip(filepath) as f:
+        assert f.read() == TEXT
+
+
+def test_plain_gzip_is_not_bgzf(tmpdir):
+    filepath = str(tmpdir / 'a.gz')
+    with gzip.open(filepath, 'wt') as f:
+        f.write(TEXT)
+    assert not is_bgzf(filepath)
+    with read_maybe_gzip(filepath) as f:
+        assert f.read() == TEXT
+
+
+def test_read_corrupt_bgzf(tmpdir, monkeypatch):
+    filepath = _make_bgzf(tmpdir, TEXT)
+    with open(filepath, 'r+b') as f:
+        f.seek(-36, 2)  # the CRC of the last block with data, just before the 28-byte EOF block
+        f.write(b'\0\0\0\0')
+    monkeypatch.setitem(conf.overrides, 'bgzf_decompression_threads', 2)
+    with pytest.raises(PheWebError):
+        with read_maybe_gzip(filepath) as f:
+            f.read()
+
+
+def test_binary_variant_file_reads_like_tsv(tmpdir, monkeypatch):
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter, is_binary_variant_file, _bvfw
+    monkeypatch.setattr(_bvfw, 'max_chunk_size', 3)
+    variants = [
+        {'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'GT', 'rsids': 'rs{}'.format(pos) if pos % 2 else '',
+         'pval': 0 if pos == 3 else pos / 1e9, 'beta': '' if pos % 3 else -0.5, 'num_cases': '' if pos == 5 else pos}
+        for chrom, pos in [('1', 1), ('1', 3), ('1', 5), ('1', 7), ('1', 9), ('2', 4), ('X', 5)]
+    ]
+    with VariantFileWriter(str(tmpdir / 'a.tsv')) as writer:
+        writer.write_all(variants)
+    with VariantFileWriter(str(tmpdir / 'a.bin'), binary=True) as writer:
+        writer.write_all(variants)
+    assert is_binary_variant_file(str(tmpdir / 'a.bin')) and not is_binary_variant_file(str(tmpdir / 'a.tsv'))
+    for only_per_variant_fields in [False, True]:
+        with VariantFileReader(str(tmpdir / 'a.tsv'), only_per_variant_fields) as tsv_reader, \
+             VariantFileReader(str(tmpdir / 'a.bin'), only_per_variant_fields) as binary_reader:
+            assert binary_reader.fields == tsv_reader.fields
+            tsv_variants, binary_variants = list(tsv_reader), list(binary_reader)
+        assert [[(k, type(v), v) for k, v in variant.items()] for variant in binary_variants] == \
+               [[(k, type(v), v) for k, v in variant.items()] for variant in tsv_variants]
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_variant_records_act_like_dicts(tmpdir, binary):
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter
+    variants = [{'chrom': '1', 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': pos / 10, 'beta': -0.5} for pos in range(1, 6)]
+    with VariantFileWriter(str(tmpdir / 'a'), binary=binary) as writer:
+        writer.write_all(variants)
+    for only_per_variant_fields in [False, True]:
+        with VariantFileReader(str(tmpdir / 'a'), only_per_variant_fields) as reader:
+            expected = list(reader)
+        with VariantFileReader(str(tmpdir / 'a'), only_per_variant_fields, records=True) as reader:
+            records = list(reader)
+        assert records == expected and [dict(r) for r in records] == expected
+    record = records[0]
+    record['chrom_idx'] = 0
+    del record['pos']
+    record.update({'rsids': 'rs1', 'chrom': 'X'})
+    assert 'pos' not in record and record.get('pos') is None and record['rsids'] == 'rs1'
+    assert list(record.items()) == [('chrom', 'X'), ('ref', 'A'), ('alt', 'G'), ('chrom_idx', 0), ('rsids', 'rs1')]
+    with pytest.raises(KeyError): record['pos']
+    with VariantFileWriter(str(tmpdir / 'b')) as writer:
+        writer.write(record)
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_variant_file_reader_columns(tmpdir, binary):
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter
+    variants = [{'chrom': '1', 'pos': pos, 'ref': 'A', 'alt': 'G', 'nearest_genes': 'A"B\tC\\D' if pos == 3 else 'ABC', 'pval': pos / 10, 'beta': -0.5}
+                for pos in range(1, 6)]
+    with VariantFileWriter(str(tmpdir / 'a'), binary=binary) as writer:
+        writer.write_all(variants)
+    with VariantFileReader(str(tmpdir / 'a')) as reader:
+        expected = list(reader)
+    for columns in [['pval'], ['pos', 'pval', 'af'], ['beta', 'chrom'], []]:
+        with VariantFileReader(str(tmpdir / 'a'), columns=columns) as reader:
+            assert reader.fields == [field for field in expected[0] if field in columns]
+            projected = list(reader)
+            assert projected == [{field: v[field] for field in reader.fields} for v in expected]
+            projected[2]['peak'] = True
+            assert [reader.get_full_variant(v) for v in reversed(projected)] == list(reversed(expected[:2] + [dict(expected[2], peak=True)] + expected[3:]))
+
+
+@pytest.mark.parametrize('num_threads', [0, 3])
+def test_indexed_variant_file_writer_matches_tabix(tmpdir, monkeypatch, num_threads):
+    import random
+    from pheweb.file_utils import VariantFileWriter, convert_VariantFile_to_IndexedVariantFile, _BgzfWriter
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'bgzf_compression_threads', num_threads)
+    monkeypatch.setattr(_BgzfWriter, 'block_size', 5000)  # make lots of blocks
+    monkeypatch.setattr(_BgzfWriter, '_blocks_per_task', 2)
+    rng = random.Random(0)
+    variants = []
+    for chrom in ['1', '10', 'X']:
+        pos = 1
+        for _ in range(5000):
+            pos += rng.choice([0, 1, 50, 3000, 40000])
+            variants.append({'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': rng.random()})
+    with VariantFileWriter(str(tmpdir / 'a.tsv')) as writer:
+        writer.write_all(variants)
+    convert_VariantFile_to_IndexedVariantFile(str(tmpdir / 'a.tsv'), str(tmpdir / 'expected.gz'))
+    with VariantFileWriter(str(tmpdir / 'a.gz'), indexed=True) as writer:
+        writer.write_all(variants)
+    assert is_bgzf(str(tmpdir / 'a.gz'))
+    with read_maybe_gzip(str(tmpdir / 'a.gz')) as f, open(str(tmpdir / 'a.tsv')) as f_expected:
+        assert f.read() == f_expected.read()
+    expected, actual = pysam.TabixFile(str(tmpdir / 'expected.gz')), pysam.TabixFile(str(tmpdir / 'a.gz'))
+    assert actual.contigs == expected.contigs
+    for _ in range(500):
+        chrom, start = rng.choice(['1', '10', 'X']), rng.randint(0, 10**8)
+        end = start + rng.choice([1, 1000, 10**5, 10**7])
+        assert list(actual.fetch(chrom, start, end)) == list(expected.fetch(chrom, start, end))
+
+    with pytest.raises(PheWebError):
+        with VariantFileWriter(str(tmpdir / 'b.gz'), indexed=True) as writer:
+            writer.write_all(variants[::-1])
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_variant_file_reader_chrom(tmpdir, monkeypatch, binary):
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter, get_chrom_index, _bvfw
+    monkeypatch.setattr(_bvfw, 'max_chunk_size', 3)
+    variants = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'nearest_genes': 'A"B\tC' if pos == 2 else 'ABC', 'pval': pos / 10}
+                for chrom, num_variants in [('1', 7), ('2', 1), ('10', 3), ('X', 4)] for pos in range(1, num_variants + 1)]
+    with VariantFileWriter(str(tmpdir / 'a'), binary=binary, chrom_index=True) as writer:
+        writer.write_all(variants)
+    assert [(chrom, num_variants) for chrom, offset, num_variants in get_chrom_index(str(tmpdir / 'a'))] == [('1', 7), ('2', 1), ('10', 3), ('X', 4)]
+    for chrom in ['1', '2', '10', 'X', 'Y']:
+        expected = [v for v in variants if v['chrom'] == chrom]
+        with VariantFileReader(str(tmpdir / 'a'), chrom=chrom) as reader:
+            assert list(reader) == expected
+        with VariantFileReader(str(tmpdir / 'a'), chrom=chrom, columns=['pos']) as reader:
+            assert list(reader) == [{'pos': v['pos']} for v in expected]
+    with pytest.raises(PheWebError):
+        with VariantFileWriter(str(tmpdir / 'b'), binary=binary, chrom_index=True) as writer:
+            writer.write_all(variants + variants[:1])
@@ -0,0 +1,221 @@
+import random
+
+import pytest
+
+
+def test_matrix_by_chrom_matches_whole_file(tmpdir, monkeypatch):
+    import gzip, json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import augment_phenos, matrix
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    rng = random.Random(0)
+    phenocodes = ['a', 'b', 'c']
+    with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+        json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in phenocodes], f)
+    sites = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'} for chrom in ['1', '2', '10', 'X'] for pos in sorted(rng.sample(range(1, 10**6), 100))]
+    with VariantFileWriter(get_filepath('sites', must_exist=False), chrom_index=True) as writer:
+        for v in sites: writer.write(dict(v, rsids='', nearest_genes='GENE'))
+    for phenocode in phenocodes:
+        with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False)) as writer:
+            for v in sites:
+                if v['chrom'] == '2' and phenocode == 'b': continue  # a pheno without a chromosome
+                if rng.random() < 0.5 or v is sites[-1]: writer.write(dict(v, pval=rng.random()))
+    augment_phenos.run([])
+    matrix.run([])
+    with gzip.open(get_filepath('matrix'), 'rt') as f:
+        by_chrom = f.read()
+    lines = by_chrom.splitlines()
+    assert len(lines) == len(sites) + 1
+    header, last_row = lines[0].split('\t'), lines[-1].split('\t')
+    assert all(last_row[header.index('pval@' + phenocode)] != '' for phenocode in phenocodes)  # the last line of every pheno is kept
+    for phenocode in phenocodes:
+        os.remove(get_pheno_filepath('pheno_gz', phenocode) + '.tbi')
+    os.remove(get_filepath('matrix'))
+    matrix.run([])  # without the `.tbi`s, the matrix is made in a single process
+    with gzip.open(get_filepath('matrix'), 'rt') as f:
+        assert f.read() == by_chrom
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_matrix_update_matches_rebuild(tmpdir, monkeypatch, capsys, sparse):
+    import gzip, json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import augment_phenos, matrix
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    monkeypatch.setitem(conf.overrides, 'sparse_matrix', sparse)
+    rng = random.Random(0)
+    sites = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'} for chrom in ['1', '2', 'X'] for pos in sorted(rng.sample(range(1, 10**6), 100))]
+    with VariantFileWriter(get_filepath('sites', must_exist=False), chrom_index=True) as writer:
+        for v in sites: writer.write(dict(v, rsids='', nearest_genes='GENE'))
+    def write_phenos(phenocodes, changed_phenocodes):
+        with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+            json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in phenocodes], f)
+        for phenocode in changed_phenocodes:
+            with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False)) as writer:
+                for v in sites:
+                    if rng.random() < 0.5: writer.write(dict(v, pval=rng.random(), beta=rng.gauss(0, 1)))
+        augment_phenos.run([])
+    def get_matrix():
+        capsys.readouterr()
+        matrix.run([])
+        with gzip.open(get_filepath('matrix'), 'rt') as f:
+            return f.read(), capsys.readouterr().out
+
+    write_phenos(['a', 'b', 'c'], ['a', 'b', 'c'])
+    get_matrix()
+    assert 'up-to-date' in get_matrix()[1]
+    for remove_tbi in [False, True]:
+        write_phenos(['a', 'c', 'd', 'e'], ['c', 'd', 'e'])  # drops b, adds d and e, and changes c
+        if remove_tbi: os.remove(get_filepath('matrix') + '.tbi')  # then the old matrix is read in a single process
+        updated, out = get_matrix()
+        assert '- reusing 1 phenos' in out and '- dropping 1 phenos' in out
+        assert updated.splitlines()[int(sparse)].endswith('\tpval@e\tbeta@e')
+        os.remove(get_filepath('matrix'))
+        assert get_matrix()[0] == updated
+        write_phenos(['a', 'b', 'c'], ['b'])
+        get_matrix()
+
+
+def test_sparse_matrix_reads_like_dense_matrix(tmpdir, monkeypatch):
+    import gzip, json
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, MatrixReader, get_filepath, get_pheno_filepath
+    from pheweb.load import augment_phenos, matrix
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    rng = random.Random(0)
+    sites = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'} for chrom in ['1', '2', 'X'] for pos in sorted(rng.sample(range(1, 10**6), 100))]
+    with VariantFileWriter(get_filepath('sites', must_exist=False), chrom_index=True) as writer:
+        for v in sites: writer.write(dict(v, rsids='', nearest_genes='GENE'))
+    with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+        json.dump([{'phenocode': phenocode, 'assoc_files': [], 'num_samples': 100} for phenocode in 'abcd'], f)
+    for phenocode in 'abcd':
+        with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False)) as writer:
+            for v in sites:
+                if rng.random() < 0.2: writer.write(dict(v, pval=rng.random(), **({'beta': rng.gauss(0, 1)} if phenocode in 'ac' else {})))
+    augment_phenos.run([])
+    def read_matrix():
+        matrix.run([])
+        with gzip.open(get_filepath('matrix'), 'rt') as f:
+            text = f.read()
+        with MatrixReader().context() as matrix_reader:
+            return text, [v for chrom in ['1', '2', 'X'] for v in matrix_reader.get_region(chrom, 1, 10**6)]
+    dense_text, dense_variants = read_matrix()
+    assert len(dense_variants) == len(sites) and any(v['phenos'] for v in dense_variants)
+    monkeypatch.setitem(conf.overrides, 'sparse_matrix', True)
+    sparse_text, sparse_variants = read_matrix()  # converts the old dense matrix
+    assert sparse_text.startswith('##pheweb_matrix_format=sparse\n') and len(sparse_text) < len(dense_text)
+    assert sparse_variants == dense_variants
+    for v in sparse_variants + dense_variants:
+        assert dict(v['phenos'].iter_pvals(below=0.5)) == {phenocode: pheno['pval'] for phenocode, pheno in v['phenos'].items() if pheno['pval'] < 0.5}
+    monkeypatch.setitem(conf.overrides, 'sparse_matrix', False)
+    assert read_matrix()[0] == dense_text  # converts the sparse matrix back
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_matrix_merged_in_blocks_matches_single_merge(tmpdir, monkeypatch, capsys, sparse):
+    import gzip, json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import augment_phenos, matrix
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    monkeypatch.setitem(conf.overrides, 'sparse_matrix', sparse)
+    rng = random.Random(0)
+    phenocodes = ['p{}'.format(i) for i in range(10)]
+    sites = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'} for chrom in ['1', '2', 'X'] for pos in sorted(rng.sample(range(1, 10**6), 100))]
+    with VariantFileWriter(get_filepath('sites', must_exist=False), chrom_index=True) as writer:
+        for v in sites: writer.write(dict(v, rsids='', nearest_genes='GENE'))
+    def write_phenos(phenocodes, changed_phenocodes):
+        with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+            json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in phenocodes], f)
+        for phenocode in changed_phenocodes:
+            with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False)) as writer:
+                for v in sites:
+                    if v['chrom'] == '2' and phenocode == 'p3': continue  # a pheno without a chromosome
+                    if rng.random() < 0.3: writer.write(dict(v, pval=rng.random(), **({'beta': rng.gauss(0, 1)} if phenocode < 'p5' else {})))
+        augment_phenos.run([])
+    def get_matrix(max_open_files):
+        monkeypatch.setitem(conf.overrides, 'matrix_max_open_files', max_open_files)
+        capsys.readouterr()
+        matrix.run([])
+        with gzip.open(get_filepath('matrix'), 'rt') as f:
+            return f.read(), capsys.readouterr().out
+    write_phenos(phenocodes, phenocodes)
+    single_merge = get_matrix(1000)[0]
+    os.remove(get_filepath('matrix'))
+    in_blocks, out = get_matrix(3)  # 10 phenos -> 5 sub-matrices -> 3 sub-matrices -> 2 sub-matrices -> matrix
+    assert out.count('sub-matrices') == 3 and in_blocks == single_merge
+    assert os.listdir(str(tmpdir / 'generated-by-pheweb' / 'tmp')) == []
+    write_phenos(phenocodes + ['p10', 'p11', 'p12', 'p13'], ['p2', 'p10', 'p11', 'p12', 'p13'])  # the old matrix is the base of the final merge
+    updated, out = get_matrix(3)
+    assert '- reusing 9 phenos' in out and out.count('sub-matrices') == 2
+    os.remove(get_filepath('matrix'))
+    assert get_matrix(1000)[0] == updated
+
+
+@pytest.mark.parametrize('num_procs', [1, 2])
+def test_cpra_index_finds_the_same_variants_as_tabix(tmpdir, monkeypatch, num_procs):
+    import json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, MatrixReader, get_filepath, get_pheno_filepath, _ivfr
+    from pheweb.load import augment_phenos, matrix
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', num_procs)
+    monkeypatch.setitem(conf.overrides, 'sparse_matrix', num_procs == 2)
+    rng = random.Random(0)
+    sites = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': alt} for chrom in ['1', '2', 'X'] for pos in sorted(rng.sample(range(1, 10**6), 500))
+             for alt in (['C', 'G', 'T'] if pos % 5 == 0 else ['G'])]  # some positions have several variants
+    with VariantFileWriter(get_filepath('sites', must_exist=False), chrom_index=True) as writer:
+        for v in sites: writer.write(dict(v, rsids='', nearest_genes='GENE'))
+    with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+        json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in 'ab'], f)
+    for phenocode in 'ab':
+        with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False)) as writer:
+            for v in sites:
+                if rng.random() < 0.5: writer.write(dict(v, pval=rng.random(), beta=rng.gauss(0, 1)))
+    augment_phenos.run([])
+    if num_procs == 1: os.remove(get_pheno_filepath('pheno_gz', 'a') + '.tbi')  # the matrix is made in one file
+    matrix.run([])
+    with open(get_filepath('matrix') + '.cpra', 'rb') as f: cpra_index = f.read()
+    os.remove(get_filepath('matrix') + '.cpra')
+    matrix.run([])  # the matrix is up-to-date, but its cpra index gets remade
+    with open(get_filepath('matrix') + '.cpra', 'rb') as f: assert f.read() == cpra_index
+    matrix_reader = MatrixReader()
+    with matrix_reader.context() as mr:
+        for v in sites[::7] + [dict(sites[0], alt='C'), dict(sites[0], pos=sites[0]['pos']+1), dict(sites[0], chrom='Y')]:
+            variant = matrix_reader.get_variant(v['chrom'], v['pos'], v['ref'], v['alt'])
+            assert variant == _ivfr.get_variant(mr, v['chrom'], v['pos'], v['ref'], v['alt'])
+            assert (variant is None) == (v not in sites)
+
+
+def test_server_notices_when_the_matrix_is_replaced(tmpdir, monkeypatch):
+    import json
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import augment_phenos, matrix
+    from pheweb.serve.server_utils import _GetVariant
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 1)
+    rng = random.Random(0)
+    sites = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G'} for chrom in ['1', '2'] for pos in sorted(rng.sample(range(1, 10**6), 300))]
+    with VariantFileWriter(get_filepath('sites', must_exist=False), chrom_index=True) as writer:
+        for v in sites: writer.write(dict(v, rsids='', nearest_genes='GENE'))
+    with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+        json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in 'ab'], f)
+    def make_matrix(pval):
+        for phenocode in 'ab':
+            with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False)) as writer:
+                for v in sites: writer.write(dict(v, pval=pval, beta=rng.gauss(0, 1)))  # the betas change the length of every line
+        augment_phenos.run([])
+        matrix.run([])
+    make_matrix(0.5)
+    get_variant = _GetVariant().get_variant
+    query = '{chrom}-{pos}-{ref}-{alt}'.format(**sites[-1])
+    assert [p['pval'] for p in get_variant(query)['phenos']] == [0.5, 0.5]
+    make_matrix(0.25)
+    assert [p['pval'] for p in get_variant(query)['phenos']] == [0.25, 0.25]
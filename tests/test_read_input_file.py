@@ -0,0 +1,146 @@
+"""Check that parsing association files a block at a time matches parsing them a line at a time"""
+
+import glob
+import os
+
+import pytest
+
+from pheweb import conf, parse_utils
+from pheweb.utils import chrom_order, PheWebError
+from pheweb.load.read_input_file import AssocFileReader
+
+
+ASSOC_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'input_files/assoc-files/*')))
+
+# values near rounding boundaries, nulls, zeros, and numbers that numpy can't represent exactly
+TRICKY_LINES = '''\
+chrom\tpos\tref\talt\tpval\tbeta\tsebeta\tmaf\tac\tr2
+1\t100\tA\tG\t0.5\t0.125\t0.00125\t0.25\t0.05\tNA
+1\t1.01e2\tA\tG\t1\t-2.5\t0\t0.5\t0.15\t1
+1\t102\tA\tG\t0\t1e30\t.\t0.05\t2.25\t0.995
+1\t103\tA\tG\t5e-324\t-0.0015\tNA\t0.35\t1000000\t0.005
+chr2\t104\tA\tG\t1e-320\t0.1\t1e-5\t0.45\t0\t0
+X\t105\tA\tG\tNA\t3.5\t4.5\t0.15\t7\t0.5
+'''
+
+
+def _parse(filepath, block_size, monkeypatch, pval_is_neglog10=False):
+    monkeypatch.setitem(conf.overrides, 'assoc_parse_block_size', block_size)
+    monkeypatch.setitem(conf.overrides, 'pval_is_neglog10', pval_is_neglog10)
+    variants = []
+    try:
+        for v in AssocFileReader(filepath, {'phenocode': 'a'}).get_variants():
+            variants.append([(k, type(val), val) for k, val in v.items()])  # 0 == 0.0, so compare types too
+    except Exception as exc:
+        variants.append(('error', type(exc), str(exc)))
+    return variants
+
+
+@pytest.mark.parametrize('filepath', ASSOC_FILES, ids=os.path.basename)
+def test_blocks_match_lines_for_input_files(filepath, monkeypatch):
+    assert _parse(filepath, 0, monkeypatch) == _parse(filepath, 7, monkeypatch)
+
+
+@pytest.mark.parametrize('pval_is_neglog10', [False, True])
+def test_blocks_match_lines_for_tricky_values(tmpdir, monkeypatch, pval_is_neglog10):
+    filepath = str(tmpdir / 'tricky.tsv')
+    with open(filepath, 'w') as f:
+        f.write(TRICKY_LINES)
+    by_line = _parse(filepath, 0, monkeypatch, pval_is_neglog10)
+    assert len(by_line) == 5  # the last line has no pval
+    assert by_line == _parse(filepath, 3, monkeypatch, pval_is_neglog10)
+    assert [t for k, t, val in by_line[1]] == [str, int, str, str, float, float, int, float, float, int]
+
+
+def test_parse_column_does_not_warn_about_huge_values():
+    import warnings
+    field = parse_utils.Field(parse_utils.fields['ac'])
+    values = ['inf', '1e308', '1.5e300', '2.25']
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)  # numpy overflows while rounding these, but they still parse like `.parse()`
+        assert field.parse_column(values) == [field.parse(value) for value in values]
+
+
+def test_blocks_raise_the_same_error(tmpdir, monkeypatch):
+    filepath = str(tmpdir / 'bad.tsv')
+    with open(filepath, 'w') as f:
+        f.write(TRICKY_LINES)
+        f.write('1\t106\tA\tG\t0.1\t0.1\t0.1\t0.7\t1\t0.1\n')  # maf is out of range
+        f.write('1\t107\tA\tG\t0.1\t0.1\n')
+    by_line = _parse(filepath, 0, monkeypatch)
+    assert by_line[-1][0] == 'error'
+    assert "failed on field 'maf'" in by_line[-1][2]
+    assert by_line == _parse(filepath, 4, monkeypatch)
+    assert by_line == _parse(filepath, 1000, monkeypatch)
+
+
+@pytest.mark.parametrize('pval_is_neglog10', [False, True])
+def test_row_parser_matches_parser_for_field(monkeypatch, pval_is_neglog10):
+    monkeypatch.setitem(conf.overrides, 'pval_is_neglog10', pval_is_neglog10)
+    lines = TRICKY_LINES.splitlines()
+    colidx_for_field = {field: idx for idx, field in enumerate(lines[0].split('\t'))}
+    colidx_for_field['marker_id'] = None
+    parse_row = parse_utils.make_row_parser(colidx_for_field)
+    for line in lines[1:]:
+        values = line.split('\t')
+        try:
+            expected = [(field, type(val), val) for field, val in
+                        ((field, parse_utils.parser_for_field[field](values[colidx])) for field, colidx in colidx_for_field.items() if colidx is not None)]
+        except Exception as exc:
+            with pytest.raises(type(exc)):
+                parse_row(values)
+        else:
+            assert [(field, type(val), val) for field, val in parse_row(values).items()] == expected
+
+
+def test_shards_match_whole_file(tmpdir, monkeypatch):
+    import filecmp, random
+    import pysam
+    from pheweb.file_utils import VariantFileWriter, get_bgzf_shards, get_chrom_index
+    from pheweb.load.read_input_file import PhenoReader
+    from pheweb.load.parse_input_files import concatenate_shards
+    rng = random.Random(0)
+    src = str(tmpdir / 'assoc.tsv')
+    with open(src, 'w') as f:
+        f.write('chrom\tpos\tref\talt\tpval\tbeta\n')
+        for chrom in ['1', '2', 'X']:
+            pos = 1
+            for _ in range(20_000):
+                pos += rng.choice([0, 0, 1, 7])  # lots of variants share a position, and they might span two shards
+                f.write('{}\t{}\t{}\t{}\t{:.3g}\t{:.3f}\n'.format(chrom, pos, rng.choice('ACGT'), rng.choice(['A', 'C', 'GT']), rng.random(), rng.gauss(0, 1)))
+    pysam.tabix_compress(src, src + '.gz', force=True)
+    pheno = {'phenocode': 'a', 'assoc_files': [src + '.gz']}
+
+    with VariantFileWriter(str(tmpdir / 'whole'), chrom_index=True) as writer:
+        writer.write_all(PhenoReader(pheno).get_variants())
+
+    shards = get_bgzf_shards(src + '.gz', 50_000)
+    assert len(shards) > 5
+    for shard_idx, shard in enumerate(shards):
+        with VariantFileWriter(str(tmpdir / 'shard{}'.format(shard_idx))) as writer:
+            writer.write_all(PhenoReader(pheno, shard=shard).get_variants())
+    concatenate_shards([str(tmpdir / 'shard{}'.format(shard_idx)) for shard_idx in range(len(shards))], str(tmpdir / 'concatenated'))
+    assert filecmp.cmp(str(tmpdir / 'whole'), str(tmpdir / 'concatenated'), shallow=False)
+    assert get_chrom_index(str(tmpdir / 'concatenated')) == get_chrom_index(str(tmpdir / 'whole'))
+
+
+def test_sort_matches_sorted_file(tmpdir, monkeypatch):
+    import os, random
+    from pheweb.load.read_input_file import PhenoReader
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'assoc_sort_run_size', 1000)
+    rng = random.Random(0)
+    cpras = {(chrom, rng.randint(1, 2000), rng.choice('ACGT'), rng.choice(['A', 'C', 'GT'])) for chrom in ['1', '2', '10', 'X'] for _ in range(3000)}
+    lines = ['{}\t{}\t{}\t{}\t{:.3g}\n'.format(*cpra, rng.random()) for cpra in sorted(cpras)]
+    sorted_lines = sorted(lines, key=lambda line: (chrom_order[line.split('\t')[0]], int(line.split('\t')[1])))
+    rng.shuffle(lines)
+    for name, body in [('sorted.tsv', sorted_lines), ('shuffled.tsv', lines)]:
+        with open(str(tmpdir / name), 'w') as f:
+            f.write('chrom\tpos\tref\talt\tpval\n')
+            f.writelines(body)
+
+    expected = list(PhenoReader({'phenocode': 'a', 'assoc_files': [str(tmpdir / 'sorted.tsv')]}).get_variants())
+    with pytest.raises(PheWebError):
+        list(PhenoReader({'phenocode': 'a', 'assoc_files': [str(tmpdir / 'shuffled.tsv')]}).get_variants())
+    assert list(PhenoReader({'phenocode': 'a', 'assoc_files': [str(tmpdir / 'shuffled.tsv')]}, sort=True).get_variants()) == expected
+    assert os.listdir(str(tmpdir / 'generated-by-pheweb' / 'tmp')) == []
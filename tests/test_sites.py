@@ -0,0 +1,118 @@
+import random
+
+from pheweb.load.sites import VariantListMerger
+
+
+def test_variant_list_merger_merges_many_readers():
+    rng = random.Random(0)
+    cpras = [(chrom, pos, ref, 'G') for chrom in ['1', '2', '10', 'X'] for pos in range(1, 30) for ref in 'AC']
+    readers = [[cpra for cpra in cpras if rng.random() < 0.3] for _ in range(300)]
+    iterators = [iter(reader) for reader in readers]
+    vlm = VariantListMerger()
+    for reader_id, iterator in enumerate(iterators):
+        chrom, pos, ref, alt = next(iterator)
+        vlm.insert({'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt, 'pval': 0.5}, reader_id)
+    merged = []
+    while vlm:
+        assert len(vlm) <= len(readers)
+        v, reader_ids = vlm.pop()
+        assert list(v) == ['chrom', 'pos', 'ref', 'alt']
+        merged.append(((v['chrom'], v['pos'], v['ref'], v['alt']), sorted(reader_ids)))
+        for reader_id in reader_ids:
+            cpra = next(iterators[reader_id], None)
+            if cpra is not None:
+                vlm.insert(dict(zip(['chrom', 'pos', 'ref', 'alt'], cpra), pval=0.5), reader_id)
+    assert merged == [(cpra, [reader_id for reader_id, reader in enumerate(readers) if cpra in reader])
+                      for cpra in cpras if any(cpra in reader for reader in readers)]
+
+
+def test_sites_by_chrom_matches_whole_files(tmpdir, monkeypatch):
+    import json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import sites
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    monkeypatch.setattr(sites, 'MAX_NUM_FILES_TO_MERGE_AT_ONCE', 3)
+    rng = random.Random(0)
+    phenos = [{'phenocode': str(i), 'assoc_files': []} for i in range(10)]
+    with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+        json.dump(phenos, f)
+    for pheno in phenos:
+        with VariantFileWriter(get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False), chrom_index=True) as writer:
+            for chrom in ['1', '2', '10', 'X']:
+                if rng.random() < 0.3: continue
+                for pos in sorted(rng.sample(range(1, 100), 20)):
+                    writer.write({'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': rng.random()})
+    sites.run([])
+    with open(get_filepath('unanno')) as f:
+        by_chrom = f.read()
+    for pheno in phenos:
+        os.remove(get_pheno_filepath('parsed', pheno['phenocode']) + '.chroms')
+    sites.run(['-f'])
+    with open(get_filepath('unanno')) as f:
+        assert f.read() == by_chrom
+
+
+def test_sites_merges_new_phenos_and_rebuilds_for_removed_phenos(tmpdir, monkeypatch, capsys):
+    import json
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import sites
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    def write_phenos(phenocodes, chrom_index=True):
+        with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+            json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in phenocodes], f)
+        for phenocode in phenocodes:
+            rng = random.Random(phenocode)
+            with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False), chrom_index=chrom_index) as writer:
+                for chrom in ['1', '2', 'X']:
+                    for pos in sorted(rng.sample(range(1, 100), 10)):
+                        writer.write({'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': rng.random()})
+    def get_sites(argv):
+        capsys.readouterr()
+        sites.run(argv)
+        with open(get_filepath('unanno')) as f:
+            return f.read(), capsys.readouterr().out
+
+    for chrom_index in [True, False]:
+        write_phenos(['a', 'b', 'c'], chrom_index)
+        get_sites([])
+        write_phenos(['a', 'b', 'c', 'd', 'e'], chrom_index)
+        merged, out = get_sites([])
+        assert 'Merging 2 new phenotypes' in out and merged == get_sites(['-f'])[0]
+        write_phenos(['a', 'c', 'd', 'e'], chrom_index)  # the files are rewritten without changes, so only their mtimes change
+        merged, out = get_sites([])
+        assert '1 phenotypes were removed and 0 were changed' in out and merged == get_sites(['-f'])[0]
+        assert 'up-to-date' in get_sites([])[1]
+        with VariantFileWriter(get_pheno_filepath('parsed', 'c'), chrom_index=chrom_index) as writer:
+            writer.write({'chrom': '1', 'pos': 1, 'ref': 'A', 'alt': 'G', 'pval': 0.5})
+        merged, out = get_sites([])
+        assert '0 phenotypes were removed and 1 were changed' in out and merged == get_sites(['-f'])[0]
+
+
+def test_sites_without_manifest_is_rebuilt_once(tmpdir, monkeypatch, capsys):
+    import json, os
+    from pheweb import conf
+    from pheweb.file_utils import VariantFileWriter, get_filepath, get_pheno_filepath
+    from pheweb.load import sites
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmpdir))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 2)
+    def write_pheno_list(phenocodes):
+        with open(str(tmpdir / 'pheno-list.json'), 'w') as f:
+            json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in phenocodes], f)
+    write_pheno_list(['a', 'b'])
+    for phenocode, positions in [('a', [1, 2]), ('b', [3])]:
+        with VariantFileWriter(get_pheno_filepath('parsed', phenocode, must_exist=False), chrom_index=True) as writer:
+            for pos in positions: writer.write({'chrom': '1', 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': 0.5})
+    sites.run([])
+    os.remove(get_filepath('unanno-manifest'))  # like a `sites-unannotated.tsv` made by an old version of PheWeb
+    write_pheno_list(['a'])  # `b` is removed, but `sites-unannotated.tsv` is still newer than every parsed file
+    capsys.readouterr()
+    sites.run([])
+    assert 'rebuilt once' in capsys.readouterr().out
+    with open(get_filepath('unanno')) as f:
+        assert [line.split('\t')[1] for line in f.read().splitlines()[1:]] == ['1', '2']
+    sites.run([])
+    assert 'up-to-date' in capsys.readouterr().out